@@ -0,0 +1,44 @@
+"""owner_id indexes
+
+Revision ID: 9c4e2d7b1a60
+Revises: 5b1f3c9a7d42
+Create Date: 2024-03-27 23:41:52.118306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e2d7b1a60'
+down_revision = '5b1f3c9a7d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Indexes are built concurrently to not lock the tables, it can't be done inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_pains_owner_id_date', 'pains', ['owner_id', sa.text('date DESC')], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_druguses_owner_id_date', 'druguses', ['owner_id', sa.text('date DESC')], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_druguses_paincase_id', 'druguses', ['paincase_id'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_druguses_owner_id_date_standalone', 'druguses', ['owner_id', sa.text('date DESC')],
+                        unique=False, postgresql_where=sa.text('paincase_id IS NULL'),
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_pressures_owner_id_datetime', 'pressures', ['owner_id', 'datetime'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index(op.f('ix_drugs_owner_id'), 'drugs', ['owner_id'], unique=False,
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index(op.f('ix_drugs_owner_id'), table_name='drugs', postgresql_concurrently=True)
+        op.drop_index('ix_pressures_owner_id_datetime', table_name='pressures', postgresql_concurrently=True)
+        op.drop_index('ix_druguses_owner_id_date_standalone', table_name='druguses', postgresql_concurrently=True)
+        op.drop_index('ix_druguses_paincase_id', table_name='druguses', postgresql_concurrently=True)
+        op.drop_index('ix_druguses_owner_id_date', table_name='druguses', postgresql_concurrently=True)
+        op.drop_index('ix_pains_owner_id_date', table_name='pains', postgresql_concurrently=True)
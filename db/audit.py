@@ -0,0 +1,130 @@
+"""
+Index audit of the per-user queries
+
+Fills the test database with synthetic data (see db/synthetic.py), runs the hot per-user queries from db/sql,
+captures the statements they send and runs EXPLAIN ANALYZE for each of them.
+Exits with code 1 if any of the statements scans a table sequentially.
+
+Covered are all the reading functions of db/sql, run for a single user or item (see audited_calls).
+Not covered:
+    - admin statistics over whole tables (get_users, get_users_where, get_all_, get_db_summary),
+      they scan the tables by design
+    - writes (report_*, change_user_props, delete_user, import_paincases, ...): only SELECT statements are captured
+
+Usage (drops and recreates all tables in db_test):
+    python -m db.audit [n_users]
+"""
+import os
+import sys
+
+os.environ["IS_TESTING"] = '1'
+
+import asyncio
+import datetime
+import orjson
+from sqlalchemy import event, text
+
+from db.models import Base
+from db import sql
+from db.synthetic import fill_database
+from db.redis.crud import invalidate_month_days, invalidate_user
+from src.config import logger
+
+
+async def consume(stream) -> list:
+    return [item async for item in stream]
+
+
+async def get_user_profile(user_id: int):
+    # Served from Redis, if cached
+    await invalidate_user(user_id)
+    return await sql.get_user_profile(user_id)
+
+
+# Statements, checked by the audit, are sent by these calls. user_id is an existing user with data,
+# pain_id is one of his paincases
+def audited_calls(user_id: int, pain_id: int) -> dict:
+    today = datetime.date.today()
+    return {
+        'get_user': lambda: sql.get_user(telegram_id=user_id),
+        'get_user_profile': lambda: get_user_profile(user_id),
+        'get_user_pains': lambda: sql.get_user_pains(user_id, period_days=31),
+        'get_user_pains (date)': lambda: sql.get_user_pains(user_id, date=today),
+        'get_user_pains (all)': lambda: sql.get_user_pains(user_id),
+        'stream_user_pains': lambda: consume(sql.stream_user_pains(user_id)),
+        'get_user_druguses': lambda: sql.get_user_druguses(user_id, period_days=31),
+        'get_user_druguses (date)': lambda: sql.get_user_druguses(user_id, date=today),
+        'stream_user_druguses': lambda: consume(sql.stream_user_druguses(user_id)),
+        'get_user_pressures': lambda: sql.get_user_pressures(user_id, period_days=31),
+        'get_user_pressures (date)': lambda: sql.get_user_pressures(user_id, date=today),
+        'stream_user_pressures': lambda: consume(sql.stream_user_pressures(user_id)),
+        'user_pain_days': lambda: sql.user_pain_days(user_id, today.month, today.year),
+        'user_druguse_days': lambda: sql.user_druguse_days(user_id, today.month, today.year),
+        'get_user_month_days': lambda: sql.get_user_month_days(user_id, today.month, today.year),
+        'get_user_day_entries': lambda: sql.get_user_day_entries(user_id, today),
+        'get_item_by_id': lambda: sql.get_item_by_id('paincase', pain_id),
+        'get_drugs': lambda: sql.get_drugs(owner=user_id),
+        'users_due_for_notification': lambda: sql.users_due_for_notification(datetime.datetime.utcnow()),
+        'users_by_notif_hour': lambda: sql.users_by_notif_hour(datetime.datetime.utcnow().hour),
+    }
+
+
+def seq_scans(plan: dict) -> list[str]:
+    """
+    Names of the tables, scanned sequentially in the plan (recursively)
+    """
+    tables = []
+    if plan.get('Node Type') == 'Seq Scan':
+        tables.append(plan.get('Relation Name'))
+    for subplan in plan.get('Plans', []):
+        tables += seq_scans(subplan)
+    return tables
+
+
+async def audit(n_users: int) -> bool:
+    await fill_database(n_users)
+    # Some synthetic users never report anything, the audit is run for the one with the most pains
+    async with sql.use_engine.connect() as conn:
+        user_id = await conn.scalar(text('SELECT owner_id FROM pains GROUP BY owner_id ORDER BY count(*) DESC LIMIT 1'))
+        pain_id = await conn.scalar(text('SELECT max(id) FROM pains WHERE owner_id = :user_id'), {'user_id': user_id})
+    await invalidate_month_days(user_id)
+
+    captured: list[tuple[str, tuple]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+
+    event.listen(sql.use_engine.sync_engine, 'before_cursor_execute', capture)
+    passed = True
+    for name, call in audited_calls(user_id, pain_id).items():
+        captured.clear()
+        await call()
+        statements = list(captured)
+        if not statements:
+            logger.warning(f'{name}: no statements captured')
+            continue
+        for statement, parameters in statements:
+            async with sql.use_engine.connect() as conn:
+                result = await conn.exec_driver_sql(f'EXPLAIN (ANALYZE, FORMAT JSON) {statement}', parameters)
+                plan = result.scalar()
+                await conn.rollback()
+            plan = orjson.loads(plan) if isinstance(plan, str) else plan
+            tables = seq_scans(plan[0]['Plan'])
+            execution_time = plan[0]['Execution Time']
+            if tables:
+                passed = False
+                logger.error(f'{name}: Seq Scan on {", ".join(tables)} ({execution_time:.2f} ms)\n{statement}')
+            else:
+                logger.info(f'{name}: OK ({execution_time:.2f} ms)')
+    event.remove(sql.use_engine.sync_engine, 'before_cursor_execute', capture)
+
+    async with sql.use_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    return passed
+
+
+if __name__ == '__main__':
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    ok = asyncio.get_event_loop().run_until_complete(audit(n_users))
+    sys.exit(0 if ok else 1)
@@ -1,5 +1,5 @@
 from sqlalchemy import \
-    Boolean, Column, ForeignKey, \
+    Boolean, Column, ForeignKey, Index, \
     Integer, Float, String, DateTime, Time, Date, BigInteger, SmallInteger
 from sqlalchemy.orm import relationship
 import datetime
@@ -24,12 +24,19 @@ class User(Base):
     utc_notify_at = Column(Time, default=datetime.time(18, 0))
     latitude = Column(Float)
     longitude = Column(Float)
+    next_notify_at = Column(DateTime)   # UTC, the closest utc_notify_at after notify_every days passed. Null if not notifiable
 
     paincases = relationship("PainCase", cascade="all, delete-orphan")
     druguses = relationship("DrugUse", cascade="all, delete-orphan")
     drugs = relationship("Drug", cascade="all, delete-orphan")
     pressures = relationship("Pressure", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Hourly notification schedule
+        Index('ix_users_notification_schedule', 'utc_notify_at', 'next_notify_at',
+              postgresql_where=notify_every != -1),
+    )
+
 
 class PainCase(Base):
     __tablename__ = "pains"
@@ -46,6 +53,10 @@ class PainCase(Base):
     owner_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete='CASCADE'))
     medecine_taken = relationship("DrugUse", lazy='joined', cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index('ix_pains_owner_id_date', owner_id, date.desc()),
+    )
+
 
 class DrugUse(Base):
     __tablename__ = "druguses"
@@ -58,6 +69,13 @@ class DrugUse(Base):
     owner_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete='CASCADE'))
     paincase_id = Column(Integer, ForeignKey("pains.id", ondelete='CASCADE'))
 
+    __table_args__ = (
+        Index('ix_druguses_owner_id_date', owner_id, date.desc()),
+        Index('ix_druguses_paincase_id', paincase_id),
+        # Druguses, not associated with paincases
+        Index('ix_druguses_owner_id_date_standalone', owner_id, date.desc(), postgresql_where=paincase_id.is_(None)),
+    )
+
 
 class Pressure(Base):
     __tablename__ = "pressures"
@@ -70,6 +88,10 @@ class Pressure(Base):
 
     owner_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete='CASCADE'))
 
+    __table_args__ = (
+        Index('ix_pressures_owner_id_datetime', owner_id, datetime),
+    )
+
 
 class Drug(Base):
     __tablename__ = "drugs"
@@ -80,7 +102,7 @@ class Drug(Base):
     is_painkiller = Column(Boolean)
     is_temp_reducer = Column(Boolean)
 
-    owner_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete='CASCADE'))
+    owner_id = Column(BigInteger, ForeignKey("users.telegram_id", ondelete='CASCADE'), index=True)
 
 
 # Tables with information from deleted users, for statistics and reports
@@ -2,16 +2,23 @@ import orjson
 import datetime
 import pytz
 
+from aioredis.exceptions import ResponseError
+
 from src.config import logger, redis_conn
-from db.redis.models import PydanticUser, EverydayReport, StateUpdate
+from db.redis.models import PydanticUser, EverydayReport, EverydayReportUpdate, StateUpdate, MonthDays, UserProfile
 
 
-### Language:
-# User language is stored under the key 'user_id'
+### Users:
+# User profile (see UserProfile) is cached in the 'user:{user_id}' hash: 'profile' field is orjson of the profile,
+# 'language' field is the user language for i18n middleware (set alone for the users not in DB yet)
+# The key is deleted when the user is created, changed or deleted
+# On language change or deletion of the key, user_id is sent to 'channel:language',
+# so the workers drop the language from their in-process caches
 
 ### States:
 # User's current_state (within fsm forms) is stored under the key 'user_state:user_id'
-# All user states are stored under the keys 'state:*'. List of all available states are in fsm_forms/__init__.py
+# Users in a state are stored in the sets under the keys 'state:*'. Names of all available states are in the 'states'
+# set (list of all available states are in fsm_forms/__init__.py)
 # # Channels:
 # If some state is changing, a message is sent to 'channel:states' to reflect the changes:
 # {
@@ -23,42 +30,73 @@ from db.redis.models import PydanticUser, EverydayReport, StateUpdate
 # Each subsequent message increments 'incr_value' by 1. Current increment value is stored under the 'incr_value' key
 # If 'incr_value' == 0, then it is needed to request all the states from API
 
+### Calendar:
+# Days of the month with user's entries are cached under the keys 'cal:{user_id}:{yyyy-mm}'
+# Hash with 'pain', 'druguse', 'pressure' fields, each is a bitmask of days (see MonthDays)
+# The key is deleted when an entry of the month is added or deleted
+
+### Purge queue:
+# Users who blocked the bot or were deactivated are added to the 'purge_queue' set to be deleted in background
+
 ### Everyday report:
-# If everyday report is changed, message is sent to 'channel:report' to reflect the changes:
+# Counters are stored in the 'everyday_report' hash, new and deleted users (PydanticUser json) -
+# in the 'everyday_report:new_users' and 'everyday_report:deleted_users' lists
+# On each change a delta is sent to 'channel:report' (zero counters and empty lists are omitted):
 # {
-#         "n_notified_users": 0,
+#         "action": "update", (or "reset" when a new report is started)
+#         "n_pains": 1,
 #         "new_users": [list of PydanticUser],
-#         "deleted_users": [list of PydanticUser],
-#         "n_pains": 0,
-#         "n_druguses": 0,
-#         "n_pressures": 0,
-#         "n_medications": 0
+#         ...
 # }
 
+REPORT_KEY = 'everyday_report'
+REPORT_NEW_USERS_KEY = 'everyday_report:new_users'
+REPORT_DELETED_USERS_KEY = 'everyday_report:deleted_users'
+REPORT_COUNTERS = ['n_notified_users', 'n_pains', 'n_druguses', 'n_pressures', 'n_medications']
+
 
 async def init_everyday_report():
-    report = EverydayReport(
-        n_notified_users=0,
-        new_users=[],
-        deleted_users=[],
-        n_pains=0,
-        n_druguses=0,
-        n_pressures=0,
-        n_medications=0
-    )
-    await redis_conn.set('everyday_report', report.json())
-    await redis_conn.publish('channel:report', report.json())
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete(REPORT_KEY, REPORT_NEW_USERS_KEY, REPORT_DELETED_USERS_KEY)
+        pipe.hset(REPORT_KEY, mapping={counter: 0 for counter in REPORT_COUNTERS})
+        pipe.publish('channel:report', EverydayReportUpdate(action='reset').json(exclude_defaults=True))
+        await pipe.execute()
+
+
+async def _migrate_legacy_report() -> None:
+    """
+    Report used to be stored as a json string under the 'everyday_report' key, move it to the hash and lists
+    """
+    legacy_report = await redis_conn.get(REPORT_KEY)
+    report = EverydayReport(**orjson.loads(legacy_report))
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete(REPORT_KEY, REPORT_NEW_USERS_KEY, REPORT_DELETED_USERS_KEY)
+        pipe.hset(REPORT_KEY, mapping={counter: getattr(report, counter) for counter in REPORT_COUNTERS})
+        if report.new_users:
+            pipe.rpush(REPORT_NEW_USERS_KEY, *[user.json() for user in report.new_users])
+        if report.deleted_users:
+            pipe.rpush(REPORT_DELETED_USERS_KEY, *[user.json() for user in report.deleted_users])
+        await pipe.execute()
+    logger.info('Everyday report migrated to the hash')
 
 
 async def get_current_report() -> EverydayReport:
-    current_report = await redis_conn.get('everyday_report')
-    if current_report:
-        current_report = orjson.loads(current_report)
-        return EverydayReport(**current_report)
-    else:
+    if await redis_conn.type(REPORT_KEY) == 'string':
+        await _migrate_legacy_report()
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.hgetall(REPORT_KEY)
+        pipe.lrange(REPORT_NEW_USERS_KEY, 0, -1)
+        pipe.lrange(REPORT_DELETED_USERS_KEY, 0, -1)
+        counters, new_users, deleted_users = await pipe.execute()
+    if not counters:
         await init_everyday_report()
         logger.info('New everyday report initialized in Redis')
         return await get_current_report()
+    return EverydayReport(
+        **{counter: int(counters.get(counter, 0)) for counter in REPORT_COUNTERS},
+        new_users=[PydanticUser(**orjson.loads(user)) for user in new_users],
+        deleted_users=[PydanticUser(**orjson.loads(user)) for user in deleted_users]
+    )
 
 
 async def update_everyday_report(n_notified_users: int = 0,
@@ -70,6 +108,7 @@ async def update_everyday_report(n_notified_users: int = 0,
                                  n_medications: int = 0):
     """
     Update everyday report in Redis, each function call appends users or increment counters
+    All the changes are applied atomically (MULTI), so concurrent calls don't overwrite each other
     :param n_notified_users: increment value
     :param new_users: extend list of new users
     :param deleted_users: extend list of deleted users
@@ -78,111 +117,305 @@ async def update_everyday_report(n_notified_users: int = 0,
     :param n_pressures: increment value
     :param n_medications: increment value
     """
-    current_report = await get_current_report()
-    current_report.n_notified_users += n_notified_users
-    if new_users:
-        current_report.new_users += new_users
-    if deleted_users:
-        current_report.deleted_users += deleted_users
-    current_report.n_pains += n_pains
-    current_report.n_druguses += n_druguses
-    current_report.n_pressures += n_pressures
-    current_report.n_medications += n_medications
-    await redis_conn.set('everyday_report', current_report.json())
-    await redis_conn.publish('channel:report', current_report.json())
-
-
-async def send_state_update(user_id: int, user_state: str, action: str) -> None:
-    if action not in ['set', 'unset']:
-        logger.error(f'Invalid action {action} for user {user_id} and state {user_state}')
+    delta = EverydayReportUpdate(
+        action='update',
+        n_notified_users=n_notified_users,
+        new_users=new_users or [],
+        deleted_users=deleted_users or [],
+        n_pains=n_pains,
+        n_druguses=n_druguses,
+        n_pressures=n_pressures,
+        n_medications=n_medications
+    )
+    increments = {counter: getattr(delta, counter) for counter in REPORT_COUNTERS if getattr(delta, counter)}
+    if not increments and not delta.new_users and not delta.deleted_users:
         return
-    # Get current increment value, set the next incr to current_incr + 1
-    current_incr = await redis_conn.get('incr_value')
-    if not current_incr:
-        next_incr = 0
-        await redis_conn.set('incr_value', next_incr)
-    else:
-        current_incr = int(current_incr)
-        next_incr = current_incr + 1
-        await redis_conn.set('incr_value', next_incr)
-    await redis_conn.publish('channel:states',
-                             StateUpdate(
-                                 user_id=user_id,
-                                 user_state=user_state,
-                                 action=action,
-                                 incr_value=next_incr)
-                             .json())
+    try:
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            for counter, value in increments.items():
+                pipe.hincrby(REPORT_KEY, counter, value)
+            if delta.new_users:
+                pipe.rpush(REPORT_NEW_USERS_KEY, *[user.json() for user in delta.new_users])
+            if delta.deleted_users:
+                pipe.rpush(REPORT_DELETED_USERS_KEY, *[user.json() for user in delta.deleted_users])
+            pipe.publish('channel:report', delta.json(exclude_defaults=True))
+            await pipe.execute()
+    except ResponseError as e:
+        if 'WRONGTYPE' not in str(e):
+            raise
+        await _migrate_legacy_report()
+        await update_everyday_report(n_notified_users, new_users, deleted_users,
+                                     n_pains, n_druguses, n_pressures, n_medications)
+
+
+# States used to be json arrays of user ids, such a state is converted to the set before it is used
+_AS_SET_LUA = """
+local function as_set(state_key)
+    if redis.call('TYPE', state_key).ok == 'string' then
+        local state_users = cjson.decode(redis.call('GET', state_key))
+        redis.call('DEL', state_key)
+        for _, state_user_id in ipairs(state_users) do
+            redis.call('SADD', state_key, string.format('%d', state_user_id))
+        end
+    end
+    return state_key
+end
+"""
+
+# Converts the legacy state to the set, if it is not yet
+# KEYS: state:{state_name}
+_MIGRATE_STATE_LUA = _AS_SET_LUA + """
+as_set(KEYS[1])
+return 1
+"""
+_migrate_state = redis_conn.register_script(_MIGRATE_STATE_LUA)
+
+# Moves user from the current state to the new one (or just removes from the current one if new state is '')
+# and publishes StateUpdate for each change. Atomic, one round-trip
+# KEYS: user_state:{user_id}, incr_value
+# ARGV: user_id, new state name or '', from_state or '' (remove only if user is in this state), channel
+_STATE_TRANSITION_LUA = _AS_SET_LUA + """
+local user_state_key, incr_key = KEYS[1], KEYS[2]
+local user_id, new_state, from_state, channel = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local function publish(state, action)
+    local incr = redis.call('INCR', incr_key)
+    redis.call('PUBLISH', channel, '{"user_id": ' .. user_id .. ', "user_state": ' .. cjson.encode(state) ..
+                                   ', "action": "' .. action .. '", "incr_value": ' .. incr .. '}')
+end
+local current_state = redis.call('GET', user_state_key)
+if current_state and from_state ~= '' and current_state ~= from_state then
+    return 0
+end
+if current_state then
+    redis.call('SREM', as_set('state:' .. current_state), user_id)
+    redis.call('DEL', user_state_key)
+    publish(current_state, 'unset')
+end
+if new_state ~= '' then
+    redis.call('SADD', as_set('state:' .. new_state), user_id)
+    redis.call('SET', user_state_key, new_state)
+    publish(new_state, 'set')
+end
+return 1
+"""
+_state_transition = redis_conn.register_script(_STATE_TRANSITION_LUA)
 
 
 async def add_user_to_state(state_name: str, user_id: int):
     """
     States are used to store users who are in the process of filling out a form
-    State: state_name, Value: list[int] of user_ids
+    State: state_name, Value: set of user_ids
+    Previous state of the user is cleared
     :param state_name:
     :param user_id:
     :return:
     """
-    # Clear previous state
-    await remove_user_state(user_id)
-    # Add user to state
-    if not await redis_conn.exists(f'state:{state_name}'):
-        logger.warning(f'No state {state_name} found in Redis')
-        state_users = [user_id]
-    else:
-        state_users = await redis_conn.get(f'state:{state_name}')
-        state_users = orjson.loads(state_users)
-        state_users.append(user_id)
-    await redis_conn.set(f'state:{state_name}', orjson.dumps(state_users))
-    # Add current_state to user_state
-    await redis_conn.set(f'user_state:{user_id}', state_name)
-    await send_state_update(user_id, state_name, 'set')
+    await _state_transition(keys=[f'user_state:{user_id}', 'incr_value'],
+                            args=[user_id, state_name, '', 'channel:states'])
 
 
 async def remove_user_state(user_id: int, from_state: str | None = None) -> None:
     """
     Used to remove user from state when user has finished filling out the form or to clear previous state
+    We don't remove from the state if it's not in the `from_state` that we want
     """
-    # Remove current_state from user_state
-    if not await redis_conn.exists(f'user_state:{user_id}'):
-        return
-    current_state = await redis_conn.get(f'user_state:{user_id}')
+    await _state_transition(keys=[f'user_state:{user_id}', 'incr_value'],
+                            args=[user_id, '', from_state or '', 'channel:states'])
 
-    # We don't remove from the state if it's not in the `from_state` that we want
-    if from_state and current_state != from_state:
-        return
 
-    # Remove user_id from state
-    if not await redis_conn.exists(f'state:{current_state}'):
-        logger.warning(f'No state {current_state} found in Redis')
-        return
+async def _migrate_legacy_states() -> None:
+    """
+    States used to be stored as json arrays of user ids under the 'state:*' keys, convert them to the sets
+    """
+    keys = [key async for key in redis_conn.scan_iter(match='state:*')]
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.type(key)
+        types = await pipe.execute()
+    legacy_keys = [key for key, key_type in zip(keys, types) if key_type == 'string']
+    for key in legacy_keys:
+        await _migrate_state(keys=[key])
+    if legacy_keys:
+        logger.info(f'{len(legacy_keys)} states migrated to the sets')
+
 
-    state_users = await redis_conn.get(f'state:{current_state}')
-    state_users = orjson.loads(state_users)
-    while user_id in state_users:
-        state_users.remove(user_id)
-    await redis_conn.delete(f'user_state:{user_id}')
-    await redis_conn.set(f'state:{current_state}', orjson.dumps(state_users))
-    await send_state_update(user_id, current_state, 'unset')
+async def get_state_users(state_name: str) -> list[int]:
+    if await redis_conn.type(f'state:{state_name}') == 'string':
+        await _migrate_legacy_states()
+    return [int(user_id) for user_id in await redis_conn.smembers(f'state:{state_name}')]
 
 
 async def init_states(fsm_states) -> None:
     """
     Initialize states in Redis, prefixed with 'state:'
+    Names of all available states are stored in the 'states' set, states are empty sets (i.e. absent keys)
+    """
+    keys = [key async for key in redis_conn.scan_iter(match='state:*')]
+    keys += [key async for key in redis_conn.scan_iter(match='user_state:*')]
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete('states', *keys)
+        if fsm_states:
+            pipe.sadd('states', *fsm_states)
+        pipe.set('incr_value', 0)
+        # Publish update to channel, incr_value = 0 to trigger update of all states on client side
+        pipe.publish('channel:states',
+                     StateUpdate(user_id=0,
+                                 user_state='null',
+                                 action='refresh',
+                                 incr_value=0).json())
+        await pipe.execute()
+    logger.debug(f'Initialized {len(fsm_states)} states')
+
+
+async def register_states(fsm_states) -> None:
+    """
+    Replace the names of available states in the 'states' set, users in the states are kept.
+    Safe to call while other workers are serving users, unlike init_states.
+    States left by the previous version as json arrays are converted to the sets
+    """
+    await _migrate_legacy_states()
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete('states')
+        if fsm_states:
+            pipe.sadd('states', *fsm_states)
+        await pipe.execute()
+
+
+async def add_to_purge_queue(*telegram_ids: int) -> None:
+    if telegram_ids:
+        await redis_conn.sadd('purge_queue', *telegram_ids)
+
+
+async def pop_from_purge_queue(count: int) -> list[int]:
+    return [int(telegram_id) for telegram_id in await redis_conn.spop('purge_queue', count) or []]
+
+
+USER_CACHE_TTL = 6 * 3600
+user_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _user_key(user_id: int) -> str:
+    return f'user:{user_id}'
+
+
+async def get_cached_user(user_id: int) -> UserProfile | None:
+    """
+    Get user profile from the cache, None if not cached
+    """
+    profile = await redis_conn.hget(_user_key(user_id), 'profile')
+    if profile is None:
+        user_cache_stats['misses'] += 1
+        return None
+    user_cache_stats['hits'] += 1
+    return UserProfile(**orjson.loads(profile))
+
+
+async def cache_user(profile: UserProfile) -> None:
+    key = _user_key(profile.telegram_id)
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping={
+            'profile': orjson.dumps(profile.dict()),
+            'language': profile.language or ''
+        })
+        pipe.expire(key, USER_CACHE_TTL)
+        await pipe.execute()
+
+
+async def invalidate_user(user_id: int) -> None:
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.delete(_user_key(user_id))
+        pipe.publish('channel:language', user_id)
+        await pipe.execute()
+
+
+async def get_cached_language(user_id: int) -> str | None:
+    return await redis_conn.hget(_user_key(user_id), 'language') or None
+
+
+async def cache_language(user_id: int, language: str, publish: bool = False) -> None:
+    """
+    :param publish: notify the workers that the language was changed
+    """
+    key = _user_key(user_id)
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        pipe.hset(key, 'language', language)
+        pipe.expire(key, USER_CACHE_TTL)
+        if publish:
+            pipe.publish('channel:language', user_id)
+        await pipe.execute()
+
+
+CALENDAR_CACHE_TTL = 7 * 24 * 3600
+
+# The month is cached only if no entry of the user was changed while it was read from the DB,
+# otherwise a reader could put the calendar from before the change back after the invalidation.
+# 'cal_version:{user_id}' is incremented on each invalidation and compared to the one read before the query
+# KEYS: calendar key, version key
+# ARGV: version, pain, druguse, pressure bitmasks, ttl
+_CACHE_MONTH_DAYS_LUA = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'pain', ARGV[2], 'druguse', ARGV[3], 'pressure', ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+_cache_month_days = redis_conn.register_script(_CACHE_MONTH_DAYS_LUA)
+
+
+def _calendar_key(user_id: int, month: int, year: int) -> str:
+    return f'cal:{user_id}:{year}-{month:02d}'
+
+
+def _calendar_version_key(user_id: int) -> str:
+    return f'cal_version:{user_id}'
+
+
+async def get_cached_month_days(user_id: int, month: int, year: int) -> MonthDays | None:
+    """
+    Get days with entries for the month from the cache, None if not cached
+    """
+    cached = await redis_conn.hgetall(_calendar_key(user_id, month, year))
+    if not cached:
+        return None
+    return MonthDays(**{field: MonthDays.from_bitmask(int(mask)) for field, mask in cached.items()})
+
+
+async def month_days_version(user_id: int) -> str:
+    """
+    Version of the user's calendar, to be read before the month is fetched from the DB, see cache_month_days
+    """
+    return await redis_conn.get(_calendar_version_key(user_id)) or '0'
+
+
+async def cache_month_days(user_id: int, month: int, year: int, month_days: MonthDays, version: str) -> bool:
+    """
+    :param version: month_days_version before the month was fetched
+    :return: False if the calendar was invalidated since then, and the month is not cached
+    """
+    return bool(await _cache_month_days(
+        keys=[_calendar_key(user_id, month, year), _calendar_version_key(user_id)],
+        args=[version,
+              MonthDays.to_bitmask(month_days.pain),
+              MonthDays.to_bitmask(month_days.druguse),
+              MonthDays.to_bitmask(month_days.pressure),
+              CALENDAR_CACHE_TTL]
+    ))
+
+
+async def invalidate_month_days(user_id: int, date: datetime.date | None = None) -> None:
+    """
+    Delete cached calendar of the month of the date, or all the cached months of the user if no date is given
     """
-    for state in fsm_states:
-        key = f'state:{state}'
-        await redis_conn.set(key, '[]')
-        logger.debug(f'Initialized state {state}')
-    # Publish update to channel, incr_value = 0 to trigger update of all states on client side
-    await redis_conn.publish('channel:states',
-                             StateUpdate(user_id=0,
-                                         user_state='null',
-                                         action='refresh',
-                                         incr_value=0).json())
-    await redis_conn.set('incr_value', 0)
-    keys = await redis_conn.keys('user_state:*')
-    if keys:
-        await redis_conn.delete(*keys)
+    keys = [_calendar_key(user_id, date.month, date.year)] if date is not None else \
+        [key async for key in redis_conn.scan_iter(match=f'cal:{user_id}:*')]
+    async with redis_conn.pipeline(transaction=True) as pipe:
+        # Months being read from the DB right now are not cached
+        pipe.incr(_calendar_version_key(user_id))
+        pipe.expire(_calendar_version_key(user_id), CALENDAR_CACHE_TTL)
+        if keys:
+            pipe.delete(*keys)
+        await pipe.execute()
 
 
 async def pain_started(user_id: int) -> None:
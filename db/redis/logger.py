@@ -1,38 +1,136 @@
 import logging
 import aioredis
 import asyncio
-from db.redis.models import LogUpdate
+from collections import deque
+
+
+# Pushes the batch of records, trims the list and publishes LogUpdate for each record, as it was done
+# before the batching, so the subscribers of the channel are not changed. Atomic, one round-trip
+# The increment value ('log_incr_value' for logs) is shared by all the processes writing to the list,
+# each record increments it by 1
+# KEYS: logs list, increment value
+# ARGV: max_len, channel, records...
+_PUSH_LOGS_LUA = """
+local records = {}
+for i = 3, #ARGV do
+    records[#records + 1] = ARGV[i]
+end
+redis.call('LPUSH', KEYS[1], unpack(records))
+redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+local incr = redis.call('INCRBY', KEYS[2], #records)
+for i, record in ipairs(records) do
+    redis.call('PUBLISH', ARGV[2], cjson.encode({log_record = record, log_incr_value = incr - #records + i}))
+end
+return incr
+"""
 
 
 class RedisLogHandler(logging.Handler):
     """
     Custom logging handler that pushes log records to a Redis list.
-    Along with pushing log record, sends a message to 'channel:logs' to reflect the changes
+    Along with pushing log records, sends a message to the channel ('channel:logs') to reflect the changes
+
+    Records are put into a bounded queue and pushed by a single background task in batches,
+    every `batch_size` records or every `flush_interval` seconds, each batch with one script call.
+    If the queue is full, new records are dropped and counted
     """
     def __init__(self,
                  redis_conn: aioredis.Redis,
                  key: str,
-                 max_len: int):
+                 max_len: int,
+                 batch_size: int = 100,
+                 flush_interval: float = 0.5,
+                 max_queue_len: int = 10000,
+                 incr_key: str = 'log_incr_value',
+                 channel: str = 'channel:logs'):
         super().__init__()
         self.key = key
+        self.incr_key = incr_key
+        self.channel = channel
         self.redis_conn = redis_conn
         self.max_len = max_len
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_len = max_queue_len
         self.loop = None
-        self.incr_value = -1
+        self._push_logs = redis_conn.register_script(_PUSH_LOGS_LUA)
+        self.queue: deque[str] = deque()
+        self._wakeup: asyncio.Event | None = None
+        self._flusher: asyncio.Task | None = None
+        # Metrics
+        self.n_dropped = 0    # queue was full
+        self.n_flushed = 0    # records pushed to Redis
+        self.n_failed = 0     # records lost because of Redis errors
+        self.n_batches = 0
 
     def emit(self, record):
+        try:
+            log_entry = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if '_client.py:1758' in log_entry:   # Skip yadisk entries
+            return
+        if len(self.queue) >= self.max_queue_len:
+            self.n_dropped += 1
+            return
+        self.queue.append(log_entry)
         if self.loop is None:
             self.loop = asyncio.get_event_loop()
-        self.loop.create_task(self._async_emit(record))
-
-    async def _async_emit(self, record):
-        log_entry = self.format(record)
-        if isinstance(log_entry, str):
-            if '_client.py:1758' in log_entry:   # Skip yadisk entries
-                return
-        await self.redis_conn.lpush(self.key, log_entry.encode('utf-8'))
-        await self.redis_conn.ltrim(self.key, 0, self.max_len - 1)
-        self.incr_value += 1
-        log_update = LogUpdate(log_record=log_entry, log_incr_value=self.incr_value)
-        await self.redis_conn.publish('channel:logs', log_update.json())
-        await self.redis_conn.set('log_incr_value', self.incr_value)
+            self._wakeup = asyncio.Event()
+            self._flusher = self.loop.create_task(self._flush_loop())
+        if len(self.queue) >= self.batch_size:
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self.queue:
+                await self.flush_batch()
+
+    async def flush_batch(self) -> None:
+        """
+        Push up to batch_size queued records with one pipeline
+        """
+        batch = []
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+        if not batch:
+            return
+        try:
+            await self._push_logs(keys=[self.key, self.incr_key],
+                                  args=[self.max_len, self.channel, *batch])
+        except Exception:
+            self.n_failed += len(batch)
+            return
+        self.n_flushed += len(batch)
+        self.n_batches += 1
+
+    async def aclose(self) -> None:
+        """
+        Stop the background task and push everything queued, on shutdown.
+        logging.Handler.close() is sync and is called by logging at exit, when the loop is gone
+        """
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        while self.queue:
+            await self.flush_batch()
+        self.close()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'queued': len(self.queue),
+            'flushed': self.n_flushed,
+            'batches': self.n_batches,
+            'dropped': self.n_dropped,
+            'failed': self.n_failed
+        }
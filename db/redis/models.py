@@ -1,3 +1,4 @@
+import datetime
 from pydantic import BaseModel
 
 
@@ -31,6 +32,54 @@ class EverydayReport(BaseModel):
     n_medications: int
 
 
+class EverydayReportUpdate(BaseModel):
+    """
+    Change of the everyday report, sent to 'channel:report'
+    """
+    action: str    # 'update' or 'reset'
+    n_notified_users: int = 0
+    new_users: list[PydanticUser] = []
+    deleted_users: list[PydanticUser] = []
+    n_pains: int = 0
+    n_druguses: int = 0
+    n_pressures: int = 0
+    n_medications: int = 0
+
+
+class UserProfile(BaseModel):
+    """
+    User columns needed by most of the handlers, cached in Redis (see get_user_profile)
+    """
+    telegram_id: int
+    first_name: str | None
+    user_name: str | None
+    timezone: str | None
+    language: str | None
+    notify_every: int | None
+    utc_notify_at: datetime.time | None
+
+
+class MonthDays(BaseModel):
+    """
+    Days of the month with user's entries, used to draw the calendar
+    Cached in Redis as bitmasks (bit N is set if there is an entry on day N)
+    """
+    pain: list[int] = []
+    druguse: list[int] = []
+    pressure: list[int] = []
+
+    @staticmethod
+    def to_bitmask(days: list[int]) -> int:
+        mask = 0
+        for day in days:
+            mask |= 1 << day
+        return mask
+
+    @staticmethod
+    def from_bitmask(mask: int) -> list[int]:
+        return [day for day in range(1, 32) if mask >> day & 1]
+
+
 class StateUpdate(BaseModel):
     """
     State update, sent to 'channel:states' to reflect the changes
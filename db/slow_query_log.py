@@ -0,0 +1,166 @@
+"""
+Slow query log
+
+Statements longer than SLOW_QUERY_MS are logged with the shape of their parameters (types only, values are
+users' health data), the calling function and, for a share of them, the query plan. Entries are pushed to the
+Redis list 'slow_queries' in the same format as 'logs' (updates in 'channel:slow_queries'), the log viewer
+can show them as well. A line with the duration and the caller also goes to the main log
+"""
+import asyncio
+import logging
+import random
+import re
+import sys
+import time
+from contextvars import ContextVar
+from pathlib import Path
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.config import BASE_DIR, logger, redis_conn, LOG_FORMAT, LOG_DATEFMT, \
+    SLOW_QUERY_MS, SLOW_QUERY_EXPLAIN_RATE, SLOW_QUERY_LOG_LEN
+from db.redis.logger import RedisLogHandler
+
+
+MAX_STATEMENT_LEN = 2000
+
+slow_query_handler = RedisLogHandler(redis_conn, key='slow_queries', max_len=SLOW_QUERY_LOG_LEN,
+                                     incr_key='slow_queries_incr_value', channel='channel:slow_queries')
+slow_query_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+slow_query_logger = logging.getLogger('slow_queries')
+slow_query_logger.setLevel(logging.INFO)
+slow_query_logger.addHandler(slow_query_handler)
+slow_query_logger.propagate = False
+
+# Set in the EXPLAIN tasks, their own statements are not logged
+_explaining: ContextVar[bool] = ContextVar('explaining', default=False)
+
+
+def params_shape(parameters, executemany: bool = False) -> str:
+    """
+    Types of the parameters: "(int, str, NoneType)", "{id: int}", "100 x (int, str)" for executemany
+    """
+    if executemany:
+        parameters = list(parameters)
+        first = params_shape(parameters[0]) if parameters else '()'
+        return f'{len(parameters)} x {first}'
+    if isinstance(parameters, dict):
+        return '{' + ', '.join(f'{key}: {type(value).__name__}' for key, value in parameters.items()) + '}'
+    if isinstance(parameters, (list, tuple)):
+        return '(' + ', '.join(type(value).__name__ for value in parameters) + ')'
+    return type(parameters).__name__
+
+
+def _project_frame(frame) -> str | None:
+    # First frame of the project's code, e.g. db/sql/users.py:get_users
+    while frame is not None:
+        path = Path(frame.f_code.co_filename)
+        installed = 'site-packages' in path.parts or 'dist-packages' in path.parts
+        if path.is_relative_to(BASE_DIR) and not installed and path != Path(__file__):
+            return f'{path.relative_to(BASE_DIR)}:{frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+def find_caller() -> str:
+    """
+    Function of the project, which executed the statement
+
+    With the async engine, the statement is executed in a greenlet, whose stack starts in SQLAlchemy.
+    The awaiting coroutines are in the stack of the parent greenlet, suspended while the statement runs
+    """
+    caller = _project_frame(sys._getframe(1))
+    if caller is None:
+        try:
+            from greenlet import getcurrent
+        except ImportError:
+            return 'unknown'
+        parent = getcurrent().parent
+        if parent is not None:
+            caller = _project_frame(parent.gr_frame)
+    return caller or 'unknown'
+
+
+def _one_line(statement: str) -> str:
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return statement if len(statement) <= MAX_STATEMENT_LEN else statement[:MAX_STATEMENT_LEN] + '...'
+
+
+class SlowQueryLog:
+    """
+    Listens to the statements of the engine, logs the slow ones and explains some of them
+    on a separate connection, at most one at a time
+    """
+    def __init__(self,
+                 engine: AsyncEngine,
+                 threshold_ms: float = SLOW_QUERY_MS,
+                 explain_rate: float = SLOW_QUERY_EXPLAIN_RATE):
+        self.engine = engine
+        self.threshold = threshold_ms / 1000
+        self.explain_rate = explain_rate
+        self.explain_task: asyncio.Task | None = None
+        # Metrics
+        self.n_slow = 0
+        self.n_explained = 0
+
+    def install(self) -> None:
+        event.listen(self.engine.sync_engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(self.engine.sync_engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def remove(self) -> None:
+        event.remove(self.engine.sync_engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.remove(self.engine.sync_engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        # A connection executes one statement at a time
+        conn.info['slow_query_started_at'] = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info.pop('slow_query_started_at')
+        if duration < self.threshold or _explaining.get():
+            return
+        self.n_slow += 1
+        caller = find_caller()
+        shape = params_shape(parameters, executemany)
+        logger.warning(f'Slow query: {duration * 1000:.0f} ms in {caller}')
+        entry = f'{duration * 1000:.0f} ms in {caller}\n{_one_line(statement)}\nparams: {shape}'
+        if not executemany and self.should_explain():
+            self.explain_task = asyncio.get_running_loop().create_task(
+                self.explain(entry, statement, parameters))
+        else:
+            slow_query_logger.warning(entry)
+
+    def should_explain(self) -> bool:
+        if self.explain_task is not None and not self.explain_task.done():
+            return False
+        return random.random() < self.explain_rate
+
+    async def explain(self, entry: str, statement: str, parameters) -> None:
+        """
+        Log the entry with the plan. SELECTs are run again with ANALYZE, other statements are only planned.
+        Everything is rolled back anyway
+        """
+        _explaining.set(True)
+        analyze = re.match(r'\s*(SELECT|WITH)\b', statement, re.IGNORECASE) and \
+            not re.search(r'\b(INSERT|UPDATE|DELETE)\b', statement, re.IGNORECASE)
+        explain = 'EXPLAIN (ANALYZE, BUFFERS)' if analyze else 'EXPLAIN'
+        args = list(parameters.values()) if isinstance(parameters, dict) else list(parameters or ())
+        try:
+            async with self.engine.connect() as sa_conn:
+                conn = (await sa_conn.get_raw_connection()).driver_connection
+                transaction = conn.transaction()
+                await transaction.start()
+                try:
+                    rows = await conn.fetch(f'{explain} {statement}', *args)
+                finally:
+                    await transaction.rollback()
+        except Exception as e:
+            slow_query_logger.warning(f'{entry}\nEXPLAIN failed: {e!r}')
+            return
+        self.n_explained += 1
+        plan = '\n'.join(row[0] for row in rows)
+        slow_query_logger.warning(f'{entry}\n{plan}')
+
+    def stats(self) -> dict[str, int]:
+        return {'slow': self.n_slow, 'explained': self.n_explained}
@@ -5,3 +5,4 @@ from db.sql.druguses import *
 from db.sql.pressures import *
 from db.sql.medications import *
 from db.sql.statistics import *
+from db.sql.calendar_days import *
@@ -0,0 +1,138 @@
+import calendar
+import datetime
+
+from pydantic import BaseModel
+from sqlalchemy import select, and_, union_all, literal, literal_column, extract, cast, func, null, \
+    Integer, SmallInteger, String, DateTime
+
+from db.sql import get_session
+from db.models import PainCase, DrugUse, Pressure
+from db.redis.crud import get_cached_month_days, cache_month_days, month_days_version
+from db.redis.models import MonthDays
+
+
+async def get_user_month_days(user_id: int,
+                              month: int,
+                              year: int) -> MonthDays:
+    """
+    Days of the month with paincases, druguses and pressures of the user
+    Served from Redis cache, on cache miss all three are fetched from DB with one query and cached
+    (unless an entry of the user was changed meanwhile)
+    """
+    month_days = await get_cached_month_days(user_id, month, year)
+    if month_days is not None:
+        return month_days
+    version = await month_days_version(user_id)
+
+    date_from = datetime.date(year, month, 1)
+    # Get the last day of the month
+    __, last_day = calendar.monthrange(year, month)
+    date_to = datetime.date(year, month, last_day)
+    stmt = union_all(
+        select(literal('pain').label('kind'), cast(extract('day', PainCase.date), Integer).label('day'))
+        .where(and_(
+            PainCase.owner_id == user_id,
+            PainCase.date >= date_from,
+            PainCase.date <= date_to
+        )),
+        select(literal('druguse'), cast(extract('day', DrugUse.date), Integer))
+        .where(and_(
+            DrugUse.owner_id == user_id,
+            DrugUse.date >= date_from,
+            DrugUse.date <= date_to
+        )),
+        select(literal('pressure'), cast(extract('day', Pressure.datetime), Integer))
+        .where(and_(
+            Pressure.owner_id == user_id,
+            Pressure.datetime >= date_from,
+            Pressure.datetime < date_to + datetime.timedelta(days=1)
+        ))
+    )
+    days = {'pain': set(), 'druguse': set(), 'pressure': set()}
+    fetched = False
+    async with get_session() as session:
+        result = await session.execute(stmt)
+        for kind, day in result.all():
+            days[kind].add(day)
+        fetched = True
+    month_days = MonthDays(**{kind: sorted(kind_days) for kind, kind_days in days.items()})
+    if fetched:   # Do not cache empty calendar on DB error
+        await cache_month_days(user_id, month, year, month_days, version)
+    return month_days
+
+
+class DayEntry(BaseModel):
+    """
+    Paincase, druguse (not associated with a paincase) or pressure of the day, as shown in the calendar
+    """
+    kind: str    # 'paincase', 'druguse' or 'pressure'
+    id: int
+    durability: int | None = None
+    intensity: int | None = None
+    n_meds: int | None = None      # number of druguses of the paincase
+    drugname: str | None = None    # druguse drugname, or the first one of the paincase
+    amount: str | None = None
+    systolic: int | None = None
+    diastolic: int | None = None
+    pulse: int | None = None
+
+
+async def get_user_day_entries(user_id: int,
+                               date: datetime.date,
+                               page: int = 0,
+                               page_size: int = 10) -> tuple[list[DayEntry], int]:
+    """
+    One page of the user's entries of the day: paincases, then druguses without paincases, then pressures
+    All the kinds are fetched with one query
+    :return: entries of the page, total number of entries of the day
+    """
+    paincase_druguses = select(DrugUse).where(DrugUse.paincase_id == PainCase.id)
+    paincases = (
+        select(literal_column("'paincase'").label('kind'),
+               literal_column('0').label('kind_order'),
+               PainCase.id.label('id'),
+               cast(PainCase.date, DateTime).label('sort_time'),
+               PainCase.durability.label('durability'),
+               PainCase.intensity.label('intensity'),
+               paincase_druguses.with_only_columns(func.count()).scalar_subquery().label('n_meds'),
+               paincase_druguses.with_only_columns(func.min(DrugUse.drugname)).scalar_subquery().label('drugname'),
+               cast(null(), String).label('amount'),
+               cast(null(), SmallInteger).label('systolic'),
+               cast(null(), SmallInteger).label('diastolic'),
+               cast(null(), SmallInteger).label('pulse'))
+        .where(and_(
+            PainCase.owner_id == user_id,
+            PainCase.date == date
+        ))
+    )
+    druguses = (
+        select(literal_column("'druguse'"), literal_column('1'), DrugUse.id, cast(DrugUse.date, DateTime),
+               null(), null(), null(), DrugUse.drugname, DrugUse.amount, null(), null(), null())
+        .where(and_(
+            DrugUse.owner_id == user_id,
+            DrugUse.date == date,
+            DrugUse.paincase_id.is_(None)
+        ))
+    )
+    pressures = (
+        select(literal_column("'pressure'"), literal_column('2'), Pressure.id, Pressure.datetime,
+               null(), null(), null(), null(), null(), Pressure.systolic, Pressure.diastolic, Pressure.pulse)
+        .where(and_(
+            Pressure.owner_id == user_id,
+            Pressure.datetime >= date,
+            Pressure.datetime < date + datetime.timedelta(days=1)
+        ))
+    )
+    entries = union_all(paincases, druguses, pressures).subquery('entries')
+    stmt = (
+        select(entries, func.count().over().label('n_total'))
+        .order_by(entries.c.kind_order, entries.c.sort_time, entries.c.id)
+        .limit(page_size)
+        .offset(page * page_size)
+    )
+    async with get_session() as session:
+        result = await session.execute(stmt)
+        rows = result.mappings().all()
+    if not rows:
+        return [], 0
+    return [DayEntry(**row) for row in rows], rows[0]['n_total']
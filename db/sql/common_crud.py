@@ -2,19 +2,16 @@ import traceback
 from contextlib import asynccontextmanager
 from sqlalchemy import select
 from sqlalchemy import text as raw_query
-from sqlalchemy.ext.asyncio import async_sessionmaker, async_scoped_session
-import asyncio
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 
 from db.models import PainCase, DrugUse, Drug, Pressure
-from db.database import engine, test_engine
+from db.database import get_engine, pool_stats
+from db.redis.crud import invalidate_month_days
 from src.config import logger
 
-from src.config import IS_TESTING
 
-if IS_TESTING:
-    use_engine = test_engine
-else:
-    use_engine = engine
+# Engine for the test database if IS_TESTING, the other one is never created
+use_engine = get_engine()
 
 async_session_factory = async_sessionmaker(
     use_engine,
@@ -32,10 +29,10 @@ async_session_factory = async_sessionmaker(
 
 
 @asynccontextmanager
-async def get_session() -> async_scoped_session:
-    session = async_scoped_session(session_factory=async_session_factory, scopefunc=asyncio.current_task)
+async def get_session() -> AsyncSession:
+    session = async_session_factory()
     try:
-        yield session()
+        yield session
     except Exception:
         await session.rollback()
         logger.error(f'Error while CRUD: {traceback.format_exc()}')
@@ -49,6 +46,23 @@ async def get_session() -> async_scoped_session:
         await session.close()
 
 
+@asynccontextmanager
+async def stream_session() -> AsyncSession:
+    """
+    Session for the streaming generators (stream_user_* functions)
+    Unlike get_session, errors are re-raised: a stream broken in the middle must not look like a complete one
+    """
+    session = async_session_factory()
+    try:
+        yield session
+    except Exception:
+        await session.rollback()
+        logger.error(f'Error while streaming: {traceback.format_exc()}')
+        raise
+    finally:
+        await session.close()
+
+
 async def healthcheck():
     async with get_session() as session:
         try:
@@ -81,3 +95,8 @@ async def get_item_by_id(item_type: str, item_id: int) -> PainCase | DrugUse | P
 async def delete_item(item) -> None:
     async with get_session() as session:
         await session.delete(item)
+    # Keep the calendar cache consistent
+    if isinstance(item, PainCase | DrugUse):
+        await invalidate_month_days(item.owner_id, item.date)
+    elif isinstance(item, Pressure):
+        await invalidate_month_days(item.owner_id, item.datetime.date())
@@ -1,10 +1,11 @@
 import calendar
 import datetime
+from typing import AsyncIterator
 from sqlalchemy import select, and_, func
 
-from db.sql import get_session
+from db.sql import get_session, stream_session
 from db.models import DrugUse
-from db.redis.crud import update_everyday_report
+from db.redis.crud import update_everyday_report, invalidate_month_days
 
 
 async def report_druguse(date: datetime.date | str,
@@ -18,6 +19,7 @@ async def report_druguse(date: datetime.date | str,
         db_druguse = DrugUse(date=date, amount=amount, owner_id=owner_id, drugname=drugname, paincase_id=paincase_id)
         session.add(db_druguse)
         await update_everyday_report(n_druguses=1)
+    await invalidate_month_days(owner_id, date)
     return db_druguse
 
 
@@ -54,6 +56,28 @@ async def get_user_druguses(user_id: int,
     return db_druguses
 
 
+async def stream_user_druguses(user_id: int,
+                               period_days: int = -1,
+                               batch_size: int = 1000) -> AsyncIterator[DrugUse]:
+    """
+    Same as get_user_druguses(user_id, period_days), but fetches druguses from a server-side cursor
+    in batches of batch_size, so only one batch is kept in memory
+    """
+    stmt = (
+        select(DrugUse)
+        .where(DrugUse.owner_id == user_id)
+        .order_by(DrugUse.date.desc())
+        .execution_options(yield_per=batch_size)
+    )
+    if period_days != -1:
+        date_from = datetime.date.today() - datetime.timedelta(days=period_days)
+        stmt = stmt.where(DrugUse.date >= date_from)
+    async with stream_session() as session:
+        result = await session.stream_scalars(stmt)
+        async for db_druguse in result:
+            yield db_druguse
+
+
 async def user_druguse_days(user_id: int,
                             month: int,
                             year: int) -> list[int]:
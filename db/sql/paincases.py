@@ -1,11 +1,14 @@
 import calendar
 import datetime
+from typing import AsyncIterator
 
+from pydantic import BaseModel
 from sqlalchemy import select, and_
+from sqlalchemy.orm import selectinload
 
-from db.sql import get_session
+from db.sql import get_session, stream_session, use_engine
 from db.models import PainCase, DrugUse
-from db.redis.crud import update_everyday_report
+from db.redis.crud import update_everyday_report, invalidate_month_days
 
 
 async def report_paincase(owner_id: int,
@@ -36,7 +39,8 @@ async def report_paincase(owner_id: int,
                 db_pain.medecine_taken.append(db_druguse)
         session.add(db_pain)
         await update_everyday_report(n_pains=1)
-        return db_pain
+    await invalidate_month_days(owner_id, date)
+    return db_pain
 
 
 async def get_user_pains(user_id: int,
@@ -75,6 +79,29 @@ async def get_user_pains(user_id: int,
     return db_pains
 
 
+async def stream_user_pains(user_id: int,
+                            period_days: int = -1,
+                            batch_size: int = 500) -> AsyncIterator[PainCase]:
+    """
+    Same as get_user_pains(user_id, period_days), but fetches paincases from a server-side cursor
+    in batches of batch_size, so only one batch is kept in memory
+    """
+    stmt = (
+        select(PainCase)
+        .where(PainCase.owner_id == user_id)
+        .options(selectinload(PainCase.medecine_taken))   # joined eager load can't be used with yield_per
+        .order_by(PainCase.date.desc())
+        .execution_options(yield_per=batch_size)
+    )
+    if period_days != -1:
+        date_from = datetime.date.today() - datetime.timedelta(days=period_days)
+        stmt = stmt.where(PainCase.date >= date_from)
+    async with stream_session() as session:
+        result = await session.stream_scalars(stmt)
+        async for db_pain in result:
+            yield db_pain
+
+
 async def user_pain_days(user_id: int,
                          month: int,
                          year: int) -> list[int]:
@@ -93,3 +120,65 @@ async def user_pain_days(user_id: int,
                 )))
         db_pains = result.all()
     return [el.day for el in db_pains]
+
+
+class ImportedPain(BaseModel):
+    """
+    Paincase from an imported table, with its druguses as (drugname, amount)
+    """
+    date: datetime.date
+    durability: int
+    intensity: int
+    aura: bool = False
+    provocateurs: str | None = None
+    symptoms: str | None = None
+    description: str | None = None
+    druguses: list[tuple[str, str]] = []
+
+
+class ImportStats(BaseModel):
+    n_pains: int = 0
+    n_druguses: int = 0
+    n_skipped: int = 0      # pains on the dates, which already have one
+
+
+async def import_paincases(owner_id: int, pains: list[ImportedPain]) -> ImportStats:
+    """
+    Insert the pains with their druguses with COPY, in one transaction
+    Ids of the pains are taken from the sequence beforehand, so druguses are linked without reading the pains back.
+    Pains on the dates, which already have one, are skipped: the same file may be imported twice.
+    The everyday report is updated once, cached calendars of the affected months are invalidated
+    """
+    stats = ImportStats()
+    async with use_engine.connect() as sa_conn:
+        conn = (await sa_conn.get_raw_connection()).driver_connection
+        async with conn.transaction():
+            existing = {row['date'] for row in await conn.fetch(
+                "SELECT DISTINCT date FROM pains WHERE owner_id = $1 AND date = ANY($2::date[])",
+                owner_id, list({pain.date for pain in pains}))}
+            new_pains = [pain for pain in pains if pain.date not in existing]
+            stats.n_skipped = len(pains) - len(new_pains)
+            if not new_pains:
+                return stats
+            pain_ids = [row[0] for row in await conn.fetch(
+                "SELECT nextval(pg_get_serial_sequence('pains', 'id')) FROM generate_series(1, $1)", len(new_pains))]
+            pain_rows = []
+            druguse_rows = []
+            for pain_id, pain in zip(pain_ids, new_pains):
+                pain_rows.append((pain_id, pain.date, pain.durability, pain.intensity, pain.aura,
+                                  pain.provocateurs, pain.symptoms, pain.description, owner_id))
+                for drugname, amount in pain.druguses:
+                    druguse_rows.append((pain.date, amount, drugname, owner_id, pain_id))
+            await conn.copy_records_to_table(
+                'pains', records=pain_rows,
+                columns=['id', 'date', 'durability', 'intensity', 'aura', 'provocateurs', 'symptoms', 'description',
+                         'owner_id'])
+            await conn.copy_records_to_table(
+                'druguses', records=druguse_rows,
+                columns=['date', 'amount', 'drugname', 'owner_id', 'paincase_id'])
+    stats.n_pains = len(pain_rows)
+    stats.n_druguses = len(druguse_rows)
+    await update_everyday_report(n_pains=stats.n_pains, n_druguses=stats.n_druguses)
+    for month_date in {pain.date.replace(day=1) for pain in new_pains}:
+        await invalidate_month_days(owner_id, month_date)
+    return stats
@@ -1,9 +1,10 @@
 import datetime
+from typing import AsyncIterator
 
 from sqlalchemy import select, and_
 
-from db.sql import get_session
-from db.redis.crud import update_everyday_report
+from db.sql import get_session, stream_session
+from db.redis.crud import update_everyday_report, invalidate_month_days
 from db.models import Pressure
 
 
@@ -19,6 +20,7 @@ async def report_pressure(systolic: int,
                                owner_id=owner_id)
         session.add(db_pressure)
         await update_everyday_report(n_pressures=1)
+    await invalidate_month_days(owner_id, db_pressure.datetime.date())
     return db_pressure
 
 
@@ -56,3 +58,25 @@ async def get_user_pressures(user_id: int,
                 .order_by(Pressure.datetime.desc()))
             db_pressures = result.all()
     return db_pressures
+
+
+async def stream_user_pressures(user_id: int,
+                                period_days: int = -1,
+                                batch_size: int = 1000) -> AsyncIterator[Pressure]:
+    """
+    Same as get_user_pressures(user_id, period_days), but fetches pressures from a server-side cursor
+    in batches of batch_size, so only one batch is kept in memory
+    """
+    stmt = (
+        select(Pressure)
+        .where(Pressure.owner_id == user_id)
+        .order_by(Pressure.datetime.desc())
+        .execution_options(yield_per=batch_size)
+    )
+    if period_days != -1:
+        date_from = datetime.date.today() - datetime.timedelta(days=period_days)
+        stmt = stmt.where(Pressure.datetime >= date_from)
+    async with stream_session() as session:
+        result = await session.stream_scalars(stmt)
+        async for db_pressure in result:
+            yield db_pressure
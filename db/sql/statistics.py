@@ -1,13 +1,27 @@
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, true
+from pydantic import BaseModel
 from typing import Type
 import datetime
 
 from db.sql import get_session
-from db.sql.users import get_users
-from db.models import Base, Statistics
+from db.models import Base, Statistics, User, PainCase, DrugUse, Pressure, Drug
 from db.redis.models import EverydayReport
 
 
+class DBSummary(BaseModel):
+    """
+    Overall counters for the everyday report
+    """
+    n_users: int
+    n_notifiable_users: int     # users who have regular notification
+    n_active_users: int         # users with at least one row in Pains table
+    n_superactive_users: int    # users with a pain recorded within the last 31 days
+    n_pains: int
+    n_druguses: int
+    n_pressures: int
+    n_medications: int
+
+
 async def get_all_(table: Type[Base],
                    date_lt: datetime.date = None,
                    date_gt: datetime.date = None,
@@ -30,17 +44,55 @@ async def get_all_(table: Type[Base],
             return entities
 
 
-async def report_everyday_stats(report: EverydayReport) -> None:
+async def get_db_summary() -> DBSummary:
+    """
+    All the counters of DBSummary in a single query
+    """
+    date_from = datetime.date.today() - datetime.timedelta(days=31)
+    users_agg = (
+        select(
+            func.count().label('n_users'),
+            func.count().filter(User.notify_every != -1).label('n_notifiable_users')
+        )
+        .select_from(User)
+        .cte('users_agg')
+    )
+    pains_agg = (
+        select(
+            func.count().label('n_pains'),
+            func.count(PainCase.owner_id.distinct()).label('n_active_users'),
+            func.count(PainCase.owner_id.distinct()).filter(PainCase.date >= date_from).label('n_superactive_users')
+        )
+        .select_from(PainCase)
+        .cte('pains_agg')
+    )
+    stmt = (
+        select(
+            users_agg,
+            pains_agg,
+            select(func.count()).select_from(DrugUse).scalar_subquery().label('n_druguses'),
+            select(func.count()).select_from(Pressure).scalar_subquery().label('n_pressures'),
+            select(func.count()).select_from(Drug).scalar_subquery().label('n_medications'),
+        )
+        .select_from(users_agg.join(pains_agg, true()))
+    )
+    async with get_session() as session:
+        result = await session.execute(stmt)
+        row = result.one()
+    return DBSummary(**row._asdict())
+
+
+async def report_everyday_stats(report: EverydayReport, summary: DBSummary = None) -> None:
+    if summary is None:
+        summary = await get_db_summary()
     async with get_session() as session:
-        n_active_users = await get_users(active=True, return_count=True)
-        n_super_active_users = await get_users(super_active=True, return_count=True)
         session.add(
             Statistics(
                 date=datetime.date.today(),
                 new_users=len(report.new_users),
                 deleted_users=len(report.deleted_users),
-                active_users=n_active_users,
-                super_active_users=n_super_active_users,
+                active_users=summary.n_active_users,
+                super_active_users=summary.n_superactive_users,
                 paincases=report.n_pains,
                 druguses=report.n_druguses,
                 pressures=report.n_pressures,
@@ -1,11 +1,48 @@
 import datetime
 
-from sqlalchemy import select, func, and_, delete, update
+from sqlalchemy import select, func, and_, delete, update, insert, case, cast, literal, Date, DateTime, Interval, Row
 
 from db.sql import get_session
-from db.redis.crud import update_everyday_report
+from db.redis.crud import update_everyday_report, invalidate_month_days, get_cached_user, cache_user, invalidate_user
 from db.models import User, PainCase, DrugUse, Pressure, SavedPainCase, SavedDrugUse, SavedUser, SavedPressure, Drug
-from db.redis.models import PydanticUser
+from db.redis.models import PydanticUser, UserProfile
+
+
+# Notification is sent a bit earlier than exactly notify_every days, as the hourly job may be slightly delayed
+NOTIFY_SAFETY_INTERVAL = datetime.timedelta(minutes=65)
+
+
+def next_notification_time(last_notified: datetime.datetime | None,
+                           notify_every: int,
+                           utc_notify_at: datetime.time) -> datetime.datetime | None:
+    """
+    Returns the first utc_notify_at moment, when notify_every days have passed since last_notified
+    None if the user has not chosen the notification period yet
+    All the times are naive UTC, as stored in the users table
+    """
+    if notify_every is None or notify_every == -1:
+        return None
+    last_notified = max(last_notified or datetime.datetime.min, datetime.datetime(2000, 1, 1))
+    earliest = last_notified + datetime.timedelta(days=notify_every) - NOTIFY_SAFETY_INTERVAL
+    candidate = datetime.datetime.combine(earliest.date(), utc_notify_at)
+    if candidate < earliest:
+        candidate += datetime.timedelta(days=1)
+    return candidate
+
+
+def _next_notification_time_sql(last_notified):
+    """
+    Same as next_notification_time, but as an SQL expression over users columns
+    """
+    earliest = (last_notified
+                + cast(func.make_interval(0, 0, 0, User.notify_every), Interval)
+                - NOTIFY_SAFETY_INTERVAL)
+    candidate = cast(earliest, Date) + User.utc_notify_at
+    return case(
+        (User.notify_every == -1, None),
+        (candidate >= earliest, candidate),
+        else_=candidate + datetime.timedelta(days=1)
+    )
 
 
 async def create_user(telegram_id: int,
@@ -32,6 +69,8 @@ async def create_user(telegram_id: int,
                 language=language
             )
         ])
+    # Drop the language, cached for the user before he was added
+    await invalidate_user(telegram_id)
     return db_user
 
 
@@ -43,6 +82,27 @@ async def get_user(telegram_id: int) -> User | None:
     return db_user
 
 
+async def get_user_profile(telegram_id: int) -> UserProfile | None:
+    """
+    Columns of the user, needed by most of the handlers
+    Served from Redis cache, on cache miss fetched from DB and cached
+    """
+    profile = await get_cached_user(telegram_id)
+    if profile is not None:
+        return profile
+    row = None
+    async with get_session() as session:
+        stmt = select(*[getattr(User, field) for field in UserProfile.__fields__]) \
+            .where(User.telegram_id == telegram_id)
+        result = await session.execute(stmt)
+        row = result.first()
+    if row is None:
+        return None
+    profile = UserProfile(**row._mapping)
+    await cache_user(profile)
+    return profile
+
+
 async def get_users(active: bool = False,
                     super_active: bool = False,
                     return_count: bool = False) -> list[User] | int:
@@ -115,6 +175,27 @@ async def users_by_notif_hour(notif_hour_utc: int) -> list[User]:
     return user_list
 
 
+async def users_due_for_notification(now: datetime.datetime) -> list[Row]:
+    """
+    Users to be notified at the hour of `now` (naive UTC, datetime.utcnow())
+    Only the columns needed for the notification are returned: telegram_id, language, notify_every
+    """
+    async with get_session() as session:
+        stmt = (
+            select(User.telegram_id, User.language, User.notify_every)
+            .where(
+                and_(
+                    User.notify_every != -1,
+                    User.utc_notify_at == datetime.time(now.hour, 0),
+                    User.next_notify_at <= now
+                )
+            )
+        )
+        result = await session.execute(stmt)
+        rows = result.all()
+    return rows
+
+
 async def change_user_props(telegram_id: int,
                             first_name: str = None,
                             user_name: str = None,
@@ -139,78 +220,139 @@ async def change_user_props(telegram_id: int,
             db_user.notify_every = notify_every
         if utc_notify_at:
             db_user.utc_notify_at = utc_notify_at
+        if notify_every or utc_notify_at:
+            db_user.next_notify_at = next_notification_time(db_user.last_notified,
+                                                            db_user.notify_every,
+                                                            db_user.utc_notify_at)
         if latitude and longitude:
             db_user.latitude = latitude
             db_user.longitude = longitude
+    await invalidate_user(telegram_id)
     return db_user
 
 
-async def delete_user(telegram_id: int) -> bool:
+async def delete_user(telegram_id: int, report: bool = True) -> PydanticUser | None:
+    """
+    Move user with all the pains, druguses and pressures to the "Saved..." tables and delete him from the main ones
+    Everything is copied with INSERT ... SELECT statements in one transaction, rows are not loaded into the app
+    :param telegram_id:
+    :param report: add the user to deleted users of the everyday report
+    :return: deleted user info, None if not deleted
+    """
+    deleted = None
     async with get_session() as session:
-        result = await session.scalars(select(User).where(User.telegram_id == telegram_id))
-        db_user: User = result.first()
-
-        # Get all user pains, druguses, pressures
-        result = await session.scalars(select(PainCase).where(PainCase.owner_id == telegram_id))
-        user_pains: list[PainCase] = result.unique().all()
-        associated_druguses: list[DrugUse] = []
-        for pain in user_pains:
-            for du in pain.medecine_taken:
-                associated_druguses.append(du)
-        # Child druguses of paincases
-        associated_druguses_ids: list[int] = [el.id for el in associated_druguses]
-        # Druguses, nonassociated with paincases
-        result = await session.scalars(
-            select(DrugUse)
-            .where(and_(
-                DrugUse.owner_id == telegram_id,
-                DrugUse.id.not_in(associated_druguses_ids))
-            ))
-        nonassoc_druguses: list[DrugUse] = result.all()
-        # Pressures
-        result = await session.scalars(select(Pressure).where(Pressure.owner_id == telegram_id))
-        pressures: list[Pressure] = result.all()
-
-        # Drugs
-        result = await session.scalars(select(Drug).where(Drug.owner_id == telegram_id))
-        drugs: list[Drug] = result.all()
-
-        # Save them to "Saved..." tables
-        to_add: list[SavedPainCase | SavedDrugUse | SavedUser] = []
-        to_add += [SavedUser.copy_from(db_user)]
-        to_add += [SavedPainCase.copy_from(el) for el in user_pains]
-        to_add += [SavedDrugUse.copy_from(el) for el in nonassoc_druguses]
-        to_add += [SavedPressure.copy_from(el) for el in pressures]
-        session.add_all(to_add)
-
-        await update_everyday_report(
-            deleted_users=[
-                PydanticUser(
-                    telegram_id=db_user.telegram_id,
-                    first_name=db_user.first_name,
-                    last_name=None,
-                    user_name=db_user.user_name,
-                    language=db_user.language,
-                    n_paincases=len(user_pains),
-                    n_druguses=len(associated_druguses) + len(nonassoc_druguses),
-                    n_pressures=len(pressures),
-                    n_medications=len(drugs)
-                )]
+        # Saved user
+        result = await session.execute(
+            insert(SavedUser.__table__)
+            .from_select(
+                ['telegram_id', 'first_name', 'last_name', 'user_name', 'joined', 'deleted', 'timezone', 'language',
+                 'latitude', 'longitude'],
+                select(User.telegram_id, User.first_name, User.last_name, User.user_name, User.joined,
+                       literal(datetime.date.today(), Date), User.timezone, User.language,
+                       User.latitude, User.longitude)
+                .where(User.telegram_id == telegram_id)
+            )
+            .returning(*SavedUser.__table__.c['first_name', 'last_name', 'user_name', 'language'])
+        )
+        saved_user = result.first()
+        if saved_user is None:
+            raise ValueError(f'User {telegram_id} not found')
+
+        # Saved pains and all the druguses. Ids of saved pains are taken from the sequence beforehand
+        # to link saved druguses to them in the same statement
+        pains = (
+            select(PainCase.id.label('old_id'),
+                   func.nextval(func.pg_get_serial_sequence(SavedPainCase.__tablename__, 'id')).label('new_id'),
+                   PainCase.date, PainCase.durability, PainCase.intensity, PainCase.aura, PainCase.provocateurs,
+                   PainCase.symptoms, PainCase.description, PainCase.owner_id)
+            .where(PainCase.owner_id == telegram_id)
+            .cte('pains_to_save')
+            .prefix_with('MATERIALIZED')   # nextval() should be called exactly once per pain
+        )
+        saved_pains = (
+            insert(SavedPainCase.__table__)
+            .from_select(
+                ['id', 'date', 'durability', 'intensity', 'aura', 'provocateurs', 'symptoms', 'description',
+                 'owner_id'],
+                select(pains.c.new_id, pains.c.date, pains.c.durability, pains.c.intensity, pains.c.aura,
+                       pains.c.provocateurs, pains.c.symptoms, pains.c.description, pains.c.owner_id)
+            )
+            .returning(SavedPainCase.__table__.c.id)
+            .cte('saved_pains')
+        )
+        saved_druguses = (
+            insert(SavedDrugUse.__table__)
+            .from_select(
+                ['date', 'amount', 'drugname', 'owner_id', 'paincase_id'],
+                select(DrugUse.date, DrugUse.amount, DrugUse.drugname, DrugUse.owner_id, pains.c.new_id)
+                .select_from(DrugUse)
+                .outerjoin(pains, DrugUse.paincase_id == pains.c.old_id)
+                .where(DrugUse.owner_id == telegram_id)
+            )
+            .returning(SavedDrugUse.__table__.c.id)
+            .cte('saved_druguses')
+        )
+        result = await session.execute(
+            select(select(func.count()).select_from(saved_pains).scalar_subquery(),
+                   select(func.count()).select_from(saved_druguses).scalar_subquery())
+        )
+        n_paincases, n_druguses = result.one()
+
+        # Saved pressures
+        result = await session.execute(
+            insert(SavedPressure.__table__)
+            .from_select(
+                ['datetime', 'systolic', 'diastolic', 'pulse', 'owner_id'],
+                select(Pressure.datetime, Pressure.systolic, Pressure.diastolic, Pressure.pulse, Pressure.owner_id)
+                .where(Pressure.owner_id == telegram_id)
+            )
+        )
+        n_pressures = result.rowcount
+
+        # Drugs are not saved, only counted
+        n_medications = await session.scalar(
+            select(func.count()).select_from(Drug).where(Drug.owner_id == telegram_id)
         )
+
         # Cascade delete user and associated objects from the main tables
         await session.execute(
             delete(User)
             .where(User.telegram_id == telegram_id)
         )
-        return True
+        # Committed here to know the result, get_session only logs a failed commit
+        await session.commit()
+        deleted = saved_user, n_paincases, n_druguses, n_pressures, n_medications
+    if deleted is None:
+        return None
+    saved_user, n_paincases, n_druguses, n_pressures, n_medications = deleted
+    deleted_user = PydanticUser(
+        telegram_id=telegram_id,
+        first_name=saved_user.first_name,
+        last_name=saved_user.last_name,
+        user_name=saved_user.user_name,
+        language=saved_user.language,
+        n_paincases=n_paincases,
+        n_druguses=n_druguses,
+        n_pressures=n_pressures,
+        n_medications=n_medications
+    )
+    await invalidate_month_days(telegram_id)
+    await invalidate_user(telegram_id)
+    if report:
+        await update_everyday_report(deleted_users=[deleted_user])
+    return deleted_user
 
 
 async def batch_change_last_notified(telegram_ids: list[int],
                                      time_notified: datetime.datetime) -> None:
+    """
+    :param time_notified: naive UTC, e.g. datetime.utcnow() or the slot of the hourly job
+    """
     async with get_session() as session:
         stmt = (
             update(User)
             .where(User.telegram_id.in_(telegram_ids))
-            .values(last_notified=time_notified)
+            .values(last_notified=time_notified,
+                    next_notify_at=_next_notification_time_sql(literal(time_notified, DateTime)))
         )
         await session.execute(stmt)
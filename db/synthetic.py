@@ -0,0 +1,200 @@
+"""
+Synthetic data for benchmarks
+
+Fills the test database with n users and years of their history, loaded with COPY in batches of users.
+Distributions are rough, but not uniform:
+- users joined at any moment of the period, ~10% of them never reported anything
+- most users have episodic headaches (~4 a month, varies from user to user), ~20% are chronic (~15 a month)
+- durability is mostly a few hours, sometimes days; intensity peaks at 6; ~25% of users have auras
+- ~65% of pains come with 1-2 druguses, plus standalone druguses ~1-2 a month
+- ~30% of users track their pressure, ~10 times a month
+- each user has 1-4 own drugs, common drugs belong to the user -1
+
+Usage (drops and recreates all tables in db_test):
+    python -m db.synthetic [n_users] [years]
+"""
+import os
+import sys
+
+os.environ["IS_TESTING"] = '1'
+
+import asyncio
+import datetime
+import math
+import random
+import time
+from typing import Iterator
+
+from db.models import Base, PainCase, DrugUse, Pressure, Drug
+from db.database import get_engine
+from db.sql.users import next_notification_time
+from src.config import logger
+
+
+BATCH_SIZE = 1000   # users generated and copied at a time
+
+DRUGNAMES = ['Ибупрофен', 'Парацетамол', 'Суматриптан', 'Аспирин', 'Нурофен', 'Цитрамон', 'Элетриптан',
+             'Золмитриптан', 'Напроксен', 'Кеторолак']
+AMOUNTS = ['200', '400', '500', '1000', '1 таб.', '2 таб.']
+PROVOCATEURS = ['Стресс', 'Недостаточный сон', 'Погода', 'Алкоголь', 'Кофе', 'Пропуск приёма пищи', 'Гормоны']
+SYMPTOMS = ['Тошнота', 'Рвота', 'Светочувствительность', 'Чувствительность к звукам', 'Боль в шее']
+TIMEZONES = ['Europe/Moscow', 'Europe/Kiev', 'Europe/Paris', 'Europe/Madrid', 'Asia/Yekaterinburg', 'America/New_York']
+LANGUAGES = ['ru', 'en', 'uk', 'es', 'fr']
+
+USER_COLUMNS = ['telegram_id', 'last_notified', 'notify_every', 'first_name', 'last_name', 'user_name', 'joined',
+                'timezone', 'language', 'utc_notify_at', 'latitude', 'longitude', 'next_notify_at']
+PAIN_COLUMNS = ['id', 'date', 'durability', 'intensity', 'aura', 'provocateurs', 'symptoms', 'description',
+                'owner_id']
+DRUGUSE_COLUMNS = ['id', 'date', 'amount', 'drugname', 'owner_id', 'paincase_id']
+PRESSURE_COLUMNS = ['id', 'datetime', 'systolic', 'diastolic', 'pulse', 'owner_id']
+DRUG_COLUMNS = ['id', 'name', 'daily_max', 'is_painkiller', 'is_temp_reducer', 'owner_id']
+
+
+class Generator:
+    """
+    Rows of the tables for the users, ids are sequential across batches
+    """
+    def __init__(self, years: int, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.today = datetime.datetime.utcnow().date()   # notification times are UTC
+        self.n_days = years * 365
+        self.pain_id = 0
+        self.druguse_id = 0
+        self.pressure_id = 0
+        self.drug_id = 0
+
+    def n_events(self, days: int, per_month: float) -> int:
+        # Poisson-like number of events in the period
+        mean = days * per_month / 30
+        return max(0, min(days, round(self.rng.gauss(mean, math.sqrt(mean)))))
+
+    def event_days(self, joined: datetime.date, per_month: float) -> list[datetime.date]:
+        days = (self.today - joined).days + 1
+        return sorted(joined + datetime.timedelta(days=i) for i in self.rng.sample(range(days),
+                                                                                  self.n_events(days, per_month)))
+
+    def subset(self, values: list[str], p: float) -> str | None:
+        chosen = [value for value in values if self.rng.random() < p]
+        return ', '.join(chosen) if chosen else None
+
+    def common_drugs(self) -> list[tuple]:
+        rows = []
+        for name in DRUGNAMES[:5]:
+            self.drug_id += 1
+            rows.append((self.drug_id, name, 1000., True, name in ('Парацетамол', 'Аспирин'), -1))
+        return rows
+
+    def user_rows(self, user_id: int) -> dict[str, list[tuple]]:
+        rng = self.rng
+        rows = {'users': [], 'pains': [], 'druguses': [], 'pressures': [], 'drugs': []}
+        joined = self.today - datetime.timedelta(days=rng.randrange(self.n_days))
+        notify_every = rng.choices([-1, 1, 2, 3, 7], weights=[40, 30, 10, 10, 10])[0]
+        utc_notify_at = datetime.time(rng.randrange(24))
+        last_notified = datetime.datetime.combine(self.today - datetime.timedelta(days=rng.randrange(1, 8)),
+                                                  utc_notify_at)
+        rows['users'].append((
+            user_id, last_notified, notify_every, f'user{user_id}', None, f'user_{user_id}', joined,
+            rng.choice(TIMEZONES), rng.choices(LANGUAGES, weights=[60, 15, 10, 10, 5])[0], utc_notify_at,
+            None, None, next_notification_time(last_notified, notify_every, utc_notify_at)
+        ))
+
+        kind = rng.choices(['silent', 'episodic', 'chronic'], weights=[10, 70, 20])[0]
+        if kind == 'silent':
+            return rows
+        drugnames = rng.sample(DRUGNAMES, rng.randint(1, 4))
+        for name in drugnames:
+            self.drug_id += 1
+            rows['drugs'].append((self.drug_id, name, rng.choice([1000., 2000., 4000.]), True, False, user_id))
+
+        pains_per_month = rng.gammavariate(4, 1) if kind == 'episodic' else rng.gauss(15, 3)
+        has_aura = rng.random() < 0.25
+        for date in self.event_days(joined, max(pains_per_month, 0.3)):
+            self.pain_id += 1
+            rows['pains'].append((
+                self.pain_id, date,
+                rng.choices([1, 2, 4, 6, 8, 12, 24, 48, 72], weights=[5, 15, 25, 20, 10, 10, 10, 4, 1])[0],
+                round(rng.triangular(1, 10, 6)),
+                has_aura and rng.random() < 0.8,
+                self.subset(PROVOCATEURS, 0.15),
+                self.subset(SYMPTOMS, 0.25),
+                'заметка' if rng.random() < 0.05 else None,
+                user_id
+            ))
+            if rng.random() < 0.65:
+                for _ in range(rng.choices([1, 2], weights=[80, 20])[0]):
+                    self.druguse_id += 1
+                    rows['druguses'].append((self.druguse_id, date, rng.choice(AMOUNTS), rng.choice(drugnames),
+                                             user_id, self.pain_id))
+        for date in self.event_days(joined, rng.uniform(0.5, 2)):
+            self.druguse_id += 1
+            rows['druguses'].append((self.druguse_id, date, rng.choice(AMOUNTS), rng.choice(drugnames),
+                                     user_id, None))
+
+        if rng.random() < 0.3:
+            for date in self.event_days(joined, 10):
+                self.pressure_id += 1
+                rows['pressures'].append((
+                    self.pressure_id,
+                    datetime.datetime.combine(date, datetime.time(rng.randrange(7, 23), rng.randrange(60))),
+                    round(rng.gauss(125, 15)), round(rng.gauss(80, 10)), round(rng.gauss(72, 10)),
+                    user_id
+                ))
+        return rows
+
+    def batches(self, n_users: int) -> Iterator[dict[str, list[tuple]]]:
+        for first in range(1, n_users + 1, BATCH_SIZE):
+            batch = {'users': [], 'pains': [], 'druguses': [], 'pressures': [], 'drugs': []}
+            for user_id in range(first, min(first + BATCH_SIZE, n_users + 1)):
+                for table, rows in self.user_rows(user_id).items():
+                    batch[table] += rows
+            yield batch
+
+
+COLUMNS = {
+    'users': USER_COLUMNS,
+    'drugs': DRUG_COLUMNS,
+    'pains': PAIN_COLUMNS,
+    'druguses': DRUGUSE_COLUMNS,
+    'pressures': PRESSURE_COLUMNS,
+}
+
+
+async def fill_database(n_users: int, years: int = 2, seed: int = 0) -> dict[str, int]:
+    """
+    Drop and recreate all the tables, fill them with synthetic data
+    :return: number of rows in each table
+    """
+    engine = get_engine()
+    assert 'db_test' in engine.url.database, f'Synthetic data only goes to db_test, not {engine.url.database}'
+    t0 = time.time()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    generator = Generator(years, seed)
+    counts = dict.fromkeys(COLUMNS, 0)
+    async with engine.connect() as sa_conn:
+        conn = (await sa_conn.get_raw_connection()).driver_connection
+        await conn.copy_records_to_table('users', columns=USER_COLUMNS, records=[(
+            -1, None, -1, 'common', None, None, generator.today, None, None, None, None, None, None)])
+        await conn.copy_records_to_table('drugs', columns=DRUG_COLUMNS, records=generator.common_drugs())
+        for batch in generator.batches(n_users):
+            # Referenced tables first, in one transaction per batch
+            async with conn.transaction():
+                for table, columns in COLUMNS.items():
+                    await conn.copy_records_to_table(table, columns=columns, records=batch[table])
+                    counts[table] += len(batch[table])
+        # Ids were set explicitly
+        for model in (PainCase, DrugUse, Pressure, Drug):
+            table = model.__tablename__
+            await conn.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), max(id)) FROM {table} "
+                               f"HAVING max(id) IS NOT NULL")
+        await conn.execute('ANALYZE')
+    logger.info(f'Synthetic data for {n_users} users ({years} years) in {time.time() - t0:.1f} sec: {counts}')
+    return counts
+
+
+if __name__ == '__main__':
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    years = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    asyncio.get_event_loop().run_until_complete(fill_database(n_users, years))
@@ -1,13 +1,16 @@
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.redis import RedisStorage2
 
-from src.config import API_TOKEN, IS_TESTING, LOCALES_DIR
-from src.middlewares import CustomI18nMiddleware, ThrottlingMiddleware
+from src.config import API_TOKEN, IS_TESTING, LOCALES_DIR, TELEGRAM_API_SERVER, MAX_CONCURRENT_UPDATES
+from src.middlewares import CustomI18nMiddleware, ThrottlingMiddleware, ConcurrencyLimitMiddleware, \
+    InstrumentationMiddleware
 
 
 # Initialize bot and dispatcher
 validate = False if IS_TESTING else True
-bot = Bot(token=API_TOKEN, validate_token=validate, parse_mode=types.ParseMode.HTML)
+server = TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+bot = Bot(token=API_TOKEN, validate_token=validate, parse_mode=types.ParseMode.HTML, server=server)
 storage = RedisStorage2('redis', 6379, db=0, pool_size=10, prefix='fsm')
 dp = Dispatcher(bot, storage=storage, throttling_rate_limit=0.5)
 
@@ -17,6 +20,11 @@ I18N_DOMAIN = 'messages'
 i18n = CustomI18nMiddleware(I18N_DOMAIN, LOCALES_DIR)
 
 dp.middleware.setup(i18n)
+# Handler durations, SQL / Redis / Bot API time in them (calls are instrumented in on_startup)
+dp.middleware.setup(InstrumentationMiddleware())
 # dp.middleware.setup(ThrottlingMiddleware())   # Works with aiogram 3
+# Should be the last one
+concurrency_limiter = ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES)
+dp.middleware.setup(concurrency_limiter)
 
 _ = i18n.gettext
@@ -26,6 +26,63 @@ POSTGRES_USER = os.getenv('POSTGRES_USER')
 POSTGRES_PASS = os.getenv('POSTGRES_PASS')
 PAYMENTS_TOKEN_RU = os.getenv('PAYMENTS_TOKEN_RU')
 
+# Receiving updates: 'polling' (getUpdates) or 'webhook' (Telegram sends updates to WEBHOOK_HOST + WEBHOOK_PATH)
+BOT_MODE = os.getenv('BOT_MODE', default='polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')            # public https://host[:port], reverse proxy to WEBAPP_HOST:WEBAPP_PORT
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', default='/webhook')   # better to make it hard to guess
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', default='0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', default='8080'))
+# Max number of updates processed at the same time, and how long to wait for them on shutdown
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', default='50'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', default='30'))
+# Number of bot processes (webhook mode only). Scheduled jobs run in one of them, elected with a lease in Redis
+WORKERS = int(os.getenv('WORKERS', default='1'))
+LEADER_LEASE_TTL = float(os.getenv('LEADER_LEASE_TTL', default='30'))   # sec
+# 'running' mark of a job run expires in JOB_RUNNING_TTL if not renewed, then the run is started again
+JOB_RUNNING_TTL = float(os.getenv('JOB_RUNNING_TTL', default='300'))   # sec
+# Bot API server base url, e.g. local Bot API server or the stub from tests/load. Telegram's one if not set
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+# Prometheus metrics of the handlers on http://METRICS_HOST:METRICS_PORT/metrics, port + worker number with WORKERS > 1.
+# 0 to disable. Slowest handlers in the admin /report are found over the last SLOW_HANDLERS_WINDOW
+METRICS_HOST = os.getenv('METRICS_HOST', default='127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', default='9100'))
+SLOW_HANDLERS_WINDOW = float(os.getenv('SLOW_HANDLERS_WINDOW', default='3600'))   # sec
+
+# Mass sending (notifications, announcements). Telegram allows ~30 messages/sec overall and ~1 message/sec per chat
+NOTIFY_RATE = float(os.getenv('NOTIFY_RATE', default='25'))
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', default='8'))
+NOTIFY_FLUSH_EVERY = int(os.getenv('NOTIFY_FLUSH_EVERY', default='100'))
+
+# In-process cache of user languages for i18n middleware, in front of Redis
+LANGUAGE_CACHE_SIZE = int(os.getenv('LANGUAGE_CACHE_SIZE', default='10000'))
+LANGUAGE_CACHE_TTL = float(os.getenv('LANGUAGE_CACHE_TTL', default='600'))   # sec
+
+# Backups: pg_dump output is compressed and streamed to the storage without temporary files
+BACKUP_STORAGE = os.getenv('BACKUP_STORAGE', default='yadisk')            # 'yadisk' or 'local'
+BACKUP_LOCAL_DIR = Path(os.getenv('BACKUP_LOCAL_DIR', default=str(PERSISTENT_DATA_DIR / 'backups')))
+BACKUP_COMPRESSOR = os.getenv('BACKUP_COMPRESSOR', default='zstd')        # 'zstd' or 'gzip'
+BACKUP_COMPRESSION_LEVEL = int(os.getenv('BACKUP_COMPRESSION_LEVEL', default='6'))
+BACKUP_CHUNK_SIZE = int(os.getenv('BACKUP_CHUNK_SIZE', default=str(1024 * 1024)))   # bytes read from pg_dump at once
+BACKUP_RETENTION_DAYS = int(os.getenv('BACKUP_RETENTION_DAYS', default='180'))
+BACKUP_MODE = os.getenv('BACKUP_MODE', default='incremental')           # 'incremental' or 'full' (pg_dump)
+BACKUP_BASE_EVERY_DAYS = int(os.getenv('BACKUP_BASE_EVERY_DAYS', default='7'))   # full base, deltas between
+BACKUP_MANIFEST_PATH = Path(os.getenv('BACKUP_MANIFEST_PATH',
+                                      default=str(PERSISTENT_DATA_DIR / 'backup_manifest.json')))
+
+# Postgres connection pool. Notification bursts run NOTIFY_WORKERS concurrent senders on top of the usual load
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', default='10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', default='10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', default='30'))         # sec to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', default='1800'))         # sec, -1 to disable
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', default='1') == '1'
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', default='100'))   # asyncpg prepared statements
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', default='60'))   # sec for one query
+# Slow query log (Redis list 'slow_queries'): statements longer than SLOW_QUERY_MS, 0 to disable.
+# A share of them (SLOW_QUERY_EXPLAIN_RATE) is explained, SELECTs with ANALYZE
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', default='0'))
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_RATE', default='0.1'))
+SLOW_QUERY_LOG_LEN = int(os.getenv('SLOW_QUERY_LOG_LEN', default='1000'))
+
 # Setting up Redis connection
 if IS_TESTING:
     db_num = 5
@@ -35,13 +92,16 @@ redis_conn: aioredis.Redis = asyncio.get_event_loop().run_until_complete(
     aioredis.from_url("redis://redis", db=db_num, decode_responses=True))
 
 # Logging
+LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s (%(filename)s:%(lineno)s)'
+LOG_DATEFMT = '%d.%m.%Y_%H:%M:%S'
+redis_log_handler = RedisLogHandler(redis_conn, key='logs', max_len=10000)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s (%(filename)s:%(lineno)s)',
-    datefmt='%d.%m.%Y_%H:%M:%S',
+    format=LOG_FORMAT,
+    datefmt=LOG_DATEFMT,
     handlers=[
         logging.StreamHandler(),
-        RedisLogHandler(redis_conn, key='logs', max_len=10000)
+        redis_log_handler
     ]
 )
 
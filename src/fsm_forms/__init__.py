@@ -6,6 +6,7 @@ from src.fsm_forms.report_druguse_form import *
 from src.fsm_forms.report_paincase_form import *
 from src.fsm_forms.donate_form import *
 from src.fsm_forms.pressure_form import *
+from src.fsm_forms.import_form import *
 from src.fsm_forms._custom import CustomState
 
 
@@ -18,7 +18,7 @@ class Donation(StatesGroup):
 
 async def get_user_desc(message: types.Message):
     user_id = message.from_user.id
-    user = await sql.get_user(telegram_id=user_id)
+    user = await sql.get_user_profile(telegram_id=user_id)
     username = ''
     if user.user_name is not None:
         username = ' t.me/' + user.user_name
@@ -0,0 +1,72 @@
+from aiogram import types
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.filters.state import StatesGroup
+from src.fsm_forms._custom import CustomState as State
+import asyncio
+import html
+import io
+
+from src.bot import dp, _
+from src.config import logger
+from src.misc.pain_import import read_pains_file, TableImportError, MAX_ROWS
+from src.misc.utils import PAIN_COLUMNS
+from db import sql
+from db.redis.crud import remove_user_state
+
+
+MAX_FILE_SIZE = 5 * 1024 * 1024   # bytes
+
+
+## Import of the pains history
+#   | - file (.xlsx or .csv, same columns as the pains statistics export)
+#   | - cancel
+
+class ImportForm(StatesGroup):
+    file = State()
+    # owner_id
+
+
+@dp.message_handler(commands=['import'], state='*')
+async def import_entry(message: types.Message, state: FSMContext = None):
+    """Conversation entrypoint"""
+    if state and await state.get_state():
+        await state.finish()
+    await ImportForm.file.set()
+    text = _('Пришлите файл .xlsx или .csv с историей головных болей, до {max_rows} строк.\n'
+             'Столбцы как в выгрузке статистики головных болей:\n<b>{columns}</b>\n'
+             'Обязательны дата, часы и сила. Строка без даты - ещё одно лекарство к боли выше.\n'
+             'Дни, на которые уже есть запись, пропускаются').format(
+        max_rows=MAX_ROWS,
+        columns=' | '.join(_(col) for col in PAIN_COLUMNS))
+    keyboard = InlineKeyboardMarkup().add(InlineKeyboardButton(_('Отмена'), callback_data='cancel'))
+    await message.reply(text, reply_markup=keyboard)
+
+
+@dp.message_handler(content_types=types.ContentTypes.DOCUMENT, state=ImportForm.file)
+async def process_file(message: types.Message, state: FSMContext):
+    document = message.document
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        return await message.reply(_('Файл слишком большой, максимум {n} МБ').format(n=MAX_FILE_SIZE // 1024 // 1024))
+    buf = io.BytesIO()
+    await document.download(destination_file=buf)
+    try:
+        # Parsing is CPU-bound, thousands of rows would block the other updates
+        pains = await asyncio.to_thread(read_pains_file, buf, document.file_name or '')
+    except TableImportError as e:
+        return await message.reply(_('Файл не загружен:\n{errors}\n\nИсправьте и пришлите ещё раз').format(errors=html.escape(str(e))))
+    if not pains:
+        return await message.reply(_('В файле нет записей'))
+    stats = await sql.import_paincases(owner_id=message.from_user.id, pains=pains)
+    logger.info(f'User {message.from_user.id} imported {stats.n_pains} pains, {stats.n_druguses} druguses, '
+                f'{stats.n_skipped} skipped')
+    await message.reply(_('Загружено записей о боли: <b>{n_pains}</b>, приёмов лекарств: <b>{n_druguses}</b>\n'
+                          'Пропущено (на эти дни уже были записи): <b>{n_skipped}</b>').format(
+        n_pains=stats.n_pains, n_druguses=stats.n_druguses, n_skipped=stats.n_skipped))
+    await state.finish()
+    await remove_user_state(message.from_user.id)
+
+
+@dp.message_handler(state=ImportForm.file)
+async def process_file_invalid(message: types.Message):
+    return await message.reply(_('Нужен файл .xlsx или .csv, пришлите его документом'))
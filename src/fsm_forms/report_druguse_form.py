@@ -24,7 +24,7 @@ async def du_add_drug_entry(message: types.Message, state: FSMContext = None):
     if state and await state.get_state():
         await state.finish()
     user_id = message.from_user.id
-    user = await sql.get_user(telegram_id=user_id)
+    user = await sql.get_user_profile(telegram_id=user_id)
     if not user:
         logger.error(f"User {user_id} not found in the database!")
     tz = user.timezone
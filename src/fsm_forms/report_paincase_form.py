@@ -42,7 +42,7 @@ async def add_paincase_entry(message_or_query: types.Message | types.CallbackQue
     wtf_words = _('Ну вот.|Ёмаё!|Тфу!|Ого, надеюсь, не слишком сильно!|Тысяча чертей!').split('|')
     wtf_words += ['😱', '😔', '😢', '😞', '😦']
     user_id = message_or_query.from_user.id
-    user = await sql.get_user(telegram_id=user_id)
+    user = await sql.get_user_profile(telegram_id=user_id)
     if not user:
         logger.error(f"User {user_id} not found in the database!")
     tz = user.timezone
@@ -1,58 +1,70 @@
 from aiogram import executor
-import aioschedule
 
 from src.routes import *
 from db import sql
-from db.models import User
-from db.redis.crud import init_states, update_everyday_report
+from sqlalchemy import Row
+from db.redis.crud import register_states, update_everyday_report, add_to_purge_queue
 from src.fsm_forms import available_fsm_states
 from src.misc.utils import notify_me
-from src.misc.db_backup import do_backup
+from src.misc.broadcaster import Broadcaster
+from src.misc.purger import purger
+from src.middlewares.language_middleware import language_invalidation_listener
+from src.misc.incremental_backup import run_backup
 from src.misc.service_reports import everyday_report
 from src.misc.init_bot_description import set_bot_name, set_bot_description, set_bot_commands
-from src.config import logger
+from src.misc.leader import LeaderElection
+from src.misc.jobs import Job, JobScheduler
+from src.misc.metrics import instrument, start_metrics_server
+from src.config import logger, redis_conn, redis_log_handler, BOT_MODE, WEBHOOK_HOST, WEBHOOK_PATH, WEBAPP_HOST, \
+    WEBAPP_PORT, MAX_CONCURRENT_UPDATES, SHUTDOWN_TIMEOUT, WORKERS, METRICS_PORT
+from src.bot import bot, dp, concurrency_limiter
+from db.database import get_engine
+from db.slow_query_log import slow_query_handler
 import datetime
+import multiprocessing
+import signal
 from time import time
 
 
+leader_election = LeaderElection()
+worker_number = 0   # of this process with WORKERS > 1, each one serves metrics on its own port
+
+
 # Schedule notification task
-async def notify_users_hourly():
+async def notify_users_hourly(slot: datetime.datetime = None):
     """
     Ask if there was a headache during missing period, defined in notify_every attribute
+    Users are notified concurrently by Broadcaster, 'last_notified' is changed chunk by chunk,
+    so a rerun within the same hour skips already notified users
+    :param slot: hour (UTC) to notify users of, current one by default. Earlier if the hour was missed
     """
-    utc_hour = datetime.datetime.utcnow().hour
-    # Get users who should be notified at this hour
-    user_list: list[User] = await sql.users_by_notif_hour(utc_hour)
-    # if user_list:
-    #     logger.info(f'Notifying {len([el for el in user_list if el.notify_every != -1])} users')
-    t = datetime.datetime.today()
-    time_notified = datetime.datetime.now()
-    notified_users_ids = []
-    for user in user_list:
-        notification_period_days = user.notify_every
-        if notification_period_days == -1:   # If user did not specify it yet
-            continue
-        # Check if user should be notified
-        notification_period_minutes = notification_period_days * 24 * 60  # Notification period in minutes
-        dt = (t - user.last_notified).total_seconds() / 60   # How many minutes since last notification
-        if dt >= notification_period_minutes - 65:   # Check if notif. period has passed (safety interval 65 mins incl.)
-            try:
-                # Ask user about pains during the day(s)
-                await regular_report(user_instance=user, missing_days=notification_period_days)
-                notified_users_ids.append(user.telegram_id)
-            except (BotBlocked, UserDeactivated):   # user blocked the bot - delete user
-                result = await sql.delete_user(user.telegram_id)
-                if not result:
-                    await notify_me(f'Error while deleting user {user.telegram_id} ({user.user_name} / {user.first_name})')
-            except NetworkError:
-                await notify_me(f'User {user.telegram_id} Network Error')
-        await asyncio.sleep(0.1)   # As Telegram does not allow more than 30 messages/sec
-
-    # Change 'last_notified' for notified users
-    if notified_users_ids:
+    # Get users whose notification time has come at this hour
+    # A caught up slot counts as notified at the slot, so the next notification is not moved a day later
+    time_notified = slot or datetime.datetime.utcnow()
+    users_to_notify: list[Row] = await sql.users_due_for_notification(time_notified)
+    if not users_to_notify:
+        return
+
+    async def send(user: Row):
+        # Ask user about pains during the day(s)
+        await regular_report(user_instance=user, missing_days=user.notify_every)
+
+    async def on_flush(notified_users_ids: list[int]):
+        # Change 'last_notified' for notified users
         await sql.batch_change_last_notified(notified_users_ids, time_notified)
         await update_everyday_report(n_notified_users=len(notified_users_ids))
 
+    broadcaster = Broadcaster(name='Hourly notification',
+                              send=send,
+                              chat_id=lambda user: user.telegram_id,
+                              on_flush=on_flush,
+                              on_gone=add_to_purge_queue)   # user blocked the bot - delete user in background
+    stats = await broadcaster.run(users_to_notify)
+    logger.info(stats.summary())
+    logger.info(f'DB pool after notification: {sql.pool_stats()}')
+    if stats.n_failed:
+        await notify_me(stats.summary())
+
 
 async def db_healthcheck():
     if not await sql.healthcheck():
@@ -60,32 +72,139 @@ async def db_healthcheck():
         await notify_me(err)
 
 
-async def scheduler():
+HOUR = 3600
+DAY = 24 * HOUR
+
+# TZ in docker = UTC
+job_scheduler = JobScheduler([
+    # Each missed hour has its own users to notify
+    Job('notify_users_hourly', notify_users_hourly, every=HOUR, catch_up=24),
+    Job('everyday_report', lambda slot: everyday_report(), every=DAY, offset=21.5 * HOUR),
+    Job('db_healthcheck', lambda slot: db_healthcheck(), every=10 * 60),
+    Job('do_backup', lambda slot: run_backup(), every=DAY, offset=3.5 * HOUR),
+])
+
+
+async def on_elected() -> list[asyncio.Task]:
     """
-    TZ in docker = UTC
+    Called when this worker becomes the leader, starts what must run only once for all the workers
+    :return: tasks to cancel if the leadership is lost
     """
-    aioschedule.every().hour.at(":00").do(notify_users_hourly)
-    aioschedule.every().day.at("21:30").do(everyday_report)
-    aioschedule.every(10).minutes.do(db_healthcheck)
-    aioschedule.every().day.at("03:30").do(do_backup)
-    while True:
-        await aioschedule.run_pending()
-        await asyncio.sleep(30)
+    # Other workers may be serving users (e.g. a rolling restart), so their states are kept.
+    # All the states are reset with the everyday report
+    await register_states(available_fsm_states)
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_HOST:
+            # Pending updates are kept, Telegram delivers them once the bot is up again
+            await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH,
+                                  drop_pending_updates=False,
+                                  max_connections=min(MAX_CONCURRENT_UPDATES * WORKERS, 100))
+        else:
+            logger.warning('WEBHOOK_HOST is not set, webhook is not registered in Telegram')
+    return [asyncio.create_task(job_scheduler.run())]
 
 
 async def on_startup(__):
-    await init_states(available_fsm_states)
     # await set_bot_name()
     # await set_bot_description()
     await set_bot_commands()
-    asyncio.create_task(scheduler())
+    # Not at import of src.bot, the scripts importing it don't need the engine
+    instrument(get_engine(), redis_conn, bot)
+    asyncio.create_task(leader_election.run(on_elected))
+    asyncio.create_task(purger())
+    asyncio.create_task(language_invalidation_listener())
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + worker_number)
     await notify_me('Bot restarted')
 
 
+async def on_shutdown(__):
+    """
+    Stop receiving updates and let the handlers in process finish
+    """
+    await leader_election.release()
+    if BOT_MODE == 'polling':
+        dp.stop_polling()
+    await concurrency_limiter.drain(SHUTDOWN_TIMEOUT)
+    logger.info(f'Updates processing stats: {concurrency_limiter.stats()}')
+    # Queued log records would be lost with the process
+    await slow_query_handler.aclose()
+    await redis_log_handler.aclose()
+
+
+def run_webhook(reuse_port: bool = False, worker: int = 0):
+    global worker_number
+    worker_number = worker
+    # Webhook stays set on shutdown, so Telegram keeps updates until the bot is up again
+    executor.start_webhook(dispatcher=dp,
+                           webhook_path=WEBHOOK_PATH,
+                           on_startup=on_startup,
+                           on_shutdown=on_shutdown,
+                           skip_updates=False,
+                           host=WEBAPP_HOST,
+                           port=WEBAPP_PORT,
+                           reuse_port=reuse_port)
+
+
+def run_workers():
+    """
+    Start WORKERS webhook processes and wait for them. SIGTERM / SIGINT of the parent (docker stop) is passed
+    to the workers, so each one drains its updates in on_shutdown; those still alive after the timeout are killed
+    """
+    # Workers share the port, the kernel distributes connections between them
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=run_webhook, kwargs={'reuse_port': True, 'worker': i})
+               for i in range(WORKERS)]
+    stopping = False
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
+        logger.info(f'Got signal {signum}, stopping {WORKERS} workers...')
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.start()
+    while any(worker.is_alive() for worker in workers) and not stopping:
+        for worker in workers:
+            worker.join(timeout=1)
+    # Shutdown of a worker: drain (SHUTDOWN_TIMEOUT) + releasing the lease and closing connections
+    deadline = time() + SHUTDOWN_TIMEOUT + 10
+    for worker in workers:
+        worker.join(timeout=max(deadline - time(), 0))
+        if worker.is_alive():
+            logger.error(f'Worker {worker.pid} did not stop in time, killing it')
+            worker.kill()
+            worker.join()
+
+
+def exit_on_sigterm():
+    # Polling executor stops and runs on_shutdown only on KeyboardInterrupt / SystemExit, SIGTERM would kill it
+    def handler(signum, frame):
+        logger.info(f'Got signal {signum}, stopping...')
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
 if __name__ == '__main__':
     try:
-        logger.info('Starting bot...')
-        executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+        logger.info(f'Starting bot ({BOT_MODE})...')
+        if BOT_MODE == 'webhook' and WORKERS > 1:
+            run_workers()
+        elif BOT_MODE == 'webhook':
+            run_webhook()
+        else:
+            if WORKERS > 1:
+                logger.warning('Only one worker can get updates with polling, set BOT_MODE=webhook for more')
+            exit_on_sigterm()
+            executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
     except:
         logger.error(traceback.format_exc())
         asyncio.run(notify_me(traceback.format_exc()))
@@ -1,2 +1,4 @@
 from src.middlewares.language_middleware import CustomI18nMiddleware, get_user_language
 from src.middlewares.throttling_middleware import ThrottlingMiddleware, rate_limit
+from src.middlewares.concurrency_middleware import ConcurrencyLimitMiddleware
+from src.middlewares.instrumentation_middleware import InstrumentationMiddleware
@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from src.config import logger
+
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Limits the number of updates processed at the same time and keeps track of in-flight ones,
+    so they can be waited for on shutdown (see drain)
+
+    Should be set up the last one: if a next middleware cancels the update in pre_process,
+    post_process is not called and the slot is not released
+    """
+    def __init__(self, limit: int):
+        super().__init__()
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # Metrics
+        self.n_processed = 0
+        self.n_waited = 0       # updates that waited for a free slot
+        self.processing_time = 0.
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if self.semaphore.locked():
+            self.n_waited += 1
+        await self.semaphore.acquire()
+        self.in_flight += 1
+        self.idle.clear()
+        data['_started_at'] = time.monotonic()
+
+    async def on_post_process_update(self, update: types.Update, results: list, data: dict):
+        if '_started_at' not in data:
+            return
+        self.processing_time += time.monotonic() - data.pop('_started_at')
+        self.n_processed += 1
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.idle.set()
+        self.semaphore.release()
+
+    async def drain(self, timeout: float) -> bool:
+        """
+        Wait for in-flight updates to be processed
+        :return: False if some of them are still in process after timeout
+        """
+        if self.in_flight:
+            logger.info(f'Waiting for {self.in_flight} updates in process...')
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'{self.in_flight} updates are still in process after {timeout} sec')
+            return False
+        return True
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            'in_flight': self.in_flight,
+            'processed': self.n_processed,
+            'waited': self.n_waited,
+            'avg_time': self.processing_time / self.n_processed if self.n_processed else 0.
+        }
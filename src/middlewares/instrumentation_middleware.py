@@ -0,0 +1,48 @@
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from src.misc import metrics
+
+
+class InstrumentationMiddleware(BaseMiddleware):
+    """
+    Times message and callback handlers: total duration and the time spent in SQL, Redis and Bot API calls
+    (see src/misc/metrics.py). Updates without a handler are observed as "unhandled"
+    """
+    @staticmethod
+    def start() -> None:
+        metrics.current_timings.set(metrics.UpdateTimings())
+
+    @staticmethod
+    def set_handler() -> None:
+        timings = metrics.current_timings.get()
+        handler = current_handler.get()
+        if timings is not None and handler is not None:
+            timings.handler = handler.__name__
+
+    @staticmethod
+    def finish() -> None:
+        timings = metrics.current_timings.get()
+        if timings is None:
+            return
+        metrics.current_timings.set(None)
+        metrics.observe(timings)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self.start()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self.set_handler()
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self.finish()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self.start()
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self.set_handler()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results: list, data: dict):
+        self.finish()
@@ -1,22 +1,90 @@
 from aiogram import types
 from aiogram.contrib.middlewares.i18n import I18nMiddleware
+from collections import OrderedDict
+import asyncio
+import time
 import traceback
 
-from db.sql import get_user
-from db.models import User
-from src.config import redis_conn, logger
+from db.sql import get_user_profile
+from db.redis.crud import get_cached_language, cache_language
+from db.redis.models import UserProfile
+from src.config import logger, redis_conn, LANGUAGE_CACHE_SIZE, LANGUAGE_CACHE_TTL
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with TTL, least recently used entries are evicted first
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[int, tuple[float, str]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int) -> str | None:
+        item = self.data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: int, value: str) -> None:
+        if self.maxsize <= 0:
+            return
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key: int) -> None:
+        self.data.pop(key, None)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+
+language_cache = LRUCache(maxsize=LANGUAGE_CACHE_SIZE, ttl=LANGUAGE_CACHE_TTL)
+
+
+async def language_invalidation_listener():
+    """
+    Drops languages from the in-process cache, when they are changed by any of the workers (see 'channel:language')
+    Runs forever, resubscribes on Redis errors
+    """
+    while True:
+        try:
+            pubsub = redis_conn.pubsub()
+            await pubsub.subscribe('channel:language')
+            # Updates, missed while not subscribed, are unknown
+            language_cache.clear()
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    language_cache.invalidate(int(message['data']))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(f'Error in language invalidation listener:\n{traceback.format_exc()}')
+            await asyncio.sleep(5)
 
 
 async def get_user_language(curr_user: types.User) -> str:
     """
-    Get user language from Redis or DB if not found in Redis
+    Get user language from in-process cache, then from Redis or DB if not found in Redis
     :param curr_user: User object
     :return: user language 2-letter code (or maybe 3)
     """
     user_id = curr_user.id
-    language = await redis_conn.get(str(user_id))
+    language = language_cache.get(user_id)
+    if language is not None:
+        return language
+    language = await get_cached_language(user_id)
     if language is None:
-        user: User = await get_user(user_id)
+        user: UserProfile = await get_user_profile(user_id)   # caches the language along with the profile
         if user:
             language = user.language
         else:
@@ -29,30 +97,35 @@ async def get_user_language(curr_user: types.User) -> str:
                     language = 'ru'
                 else:
                     language = 'en'
-        await redis_conn.set(str(user_id), language)
+            await cache_language(user_id, language)
+    language_cache.set(user_id, language)
     return language
 
 
 async def get_user_language_by_id(user_id: int) -> str:
     """
-    Get user language from Redis or DB if not found in Redis
+    Get user language from in-process cache, then from Redis or DB if not found in Redis
     :param user_id: User ID
     :return: user language 2(3)-letter code
     """
-    language = await redis_conn.get(str(user_id))
+    language = language_cache.get(user_id)
+    if language is not None:
+        return language
+    language = await get_cached_language(user_id)
     if language is None:
-        user: User = await get_user(user_id)
+        user: UserProfile = await get_user_profile(user_id)
         if user:
             language = user.language
         else:
             language = 'ru'
             logger.warning(f'User {user_id} not found in DB, setting language to default: {language}')
-        await redis_conn.set(str(user_id), language)
+            await cache_language(user_id, language)
+    language_cache.set(user_id, language)
     return language
 
 
 class CustomI18nMiddleware(I18nMiddleware):
-    """Custom I18n middleware with get_user_locale method overriden to get user locale from Redis"""
+    """Custom I18n middleware with get_user_locale method overriden to get user locale from the cache or Redis"""
     async def get_user_locale(self, action: str, args: tuple) -> str:
         """
         User locale getter
@@ -0,0 +1,211 @@
+import asyncio
+import time
+import traceback
+from typing import Any, Awaitable, Callable, Iterable
+
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, UserDeactivated
+from pydantic import BaseModel
+
+from src.config import logger, NOTIFY_RATE, NOTIFY_WORKERS, NOTIFY_FLUSH_EVERY
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter
+    Refills with `rate` tokens per second, allows bursts up to `capacity` tokens
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        """
+        Empty the bucket and do not refill it for `seconds` (used on RetryAfter from Telegram)
+        """
+        self.tokens = 0
+        self.updated_at = max(self.updated_at, time.monotonic() + seconds)
+
+
+class ChatRateLimiter:
+    """
+    Keeps at least `interval` seconds between two messages to the same chat
+    """
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.last_sent: dict[int, float] = {}
+
+    async def wait(self, chat_id: int) -> None:
+        now = time.monotonic()
+        send_at = max(now, self.last_sent.get(chat_id, 0) + self.interval)
+        self.last_sent[chat_id] = send_at
+        if send_at > now:
+            await asyncio.sleep(send_at - now)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class BroadcastStats(BaseModel):
+    """
+    Result of a mass sending
+    """
+    name: str
+    n_total: int = 0
+    n_sent: int = 0
+    n_gone: int = 0       # BotBlocked / UserDeactivated
+    n_failed: int = 0
+    n_retries: int = 0    # RetryAfter received
+    duration: float = 0
+    latencies: list[float] = []
+
+    @property
+    def throughput(self) -> float:
+        return self.n_sent / self.duration if self.duration else 0
+
+    def summary(self) -> str:
+        return f'{self.name}: {self.n_sent}/{self.n_total} sent, {self.n_gone} gone, {self.n_failed} failed, ' \
+               f'{self.n_retries} retries in {self.duration:.1f} sec ({self.throughput:.1f} msg/sec, ' \
+               f'p50 {percentile(self.latencies, 0.5) * 1000:.0f} ms, ' \
+               f'p95 {percentile(self.latencies, 0.95) * 1000:.0f} ms)'
+
+
+class Broadcaster:
+    """
+    Sends a message to each of the given items with a bounded pool of concurrent workers.
+    Respects the global (token bucket) and per-chat Telegram limits, waits on RetryAfter.
+
+    Chat ids of delivered messages are passed to `on_flush` in chunks of `flush_every` as sending goes,
+    so if the process dies in the middle, everything flushed before is already saved
+    and a rerun only picks up the rest of the items (at most one chunk is sent twice)
+    """
+    def __init__(self,
+                 name: str,
+                 send: Callable[[Any], Awaitable],
+                 chat_id: Callable[[Any], int],
+                 on_flush: Callable[[list[int]], Awaitable] = None,
+                 on_gone: Callable[[int], Awaitable] = None,
+                 rate: float = NOTIFY_RATE,
+                 workers: int = NOTIFY_WORKERS,
+                 flush_every: int = NOTIFY_FLUSH_EVERY,
+                 per_chat_interval: float = 1.0,
+                 max_retries: int = 3):
+        """
+        :param name: name for logs
+        :param send: coroutine function sending a message for the item
+        :param chat_id: function returning chat_id of the item
+        :param on_flush: called with the list of chat_ids, delivered since the previous flush
+        :param on_gone: called with chat_id if the user blocked the bot or was deactivated
+        :param rate: global limit, messages per second
+        :param workers: number of concurrent senders
+        :param flush_every: chunk size for on_flush
+        :param per_chat_interval: min seconds between messages to the same chat
+        :param max_retries: how many times to retry after RetryAfter
+        """
+        self.name = name
+        self.send = send
+        self.chat_id = chat_id
+        self.on_flush = on_flush
+        self.on_gone = on_gone
+        self.workers = max(1, workers)
+        self.flush_every = max(1, flush_every)
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate)
+        self.chat_limiter = ChatRateLimiter(per_chat_interval)
+        self._pending: list[int] = []
+        self._chunk_latencies: list[float] = []
+        self._chunk_started = time.monotonic()
+        self._n_batch = 0
+
+    async def run(self, items: Iterable[Any]) -> BroadcastStats:
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        stats = BroadcastStats(name=self.name, n_total=queue.qsize())
+        t0 = time.monotonic()
+        self._chunk_started = t0
+        try:
+            await asyncio.gather(*[self._worker(queue, stats) for _ in range(min(self.workers, stats.n_total))])
+        finally:
+            await self._flush()
+            stats.duration = time.monotonic() - t0
+        return stats
+
+    async def _worker(self, queue: asyncio.Queue, stats: BroadcastStats) -> None:
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            await self._deliver(item, stats)
+
+    async def _deliver(self, item: Any, stats: BroadcastStats) -> None:
+        chat_id = self.chat_id(item)
+        for attempt in range(self.max_retries + 1):
+            await self.chat_limiter.wait(chat_id)
+            await self.bucket.acquire()
+            t0 = time.monotonic()
+            try:
+                await self.send(item)
+            except RetryAfter as e:
+                stats.n_retries += 1
+                logger.warning(f'{self.name}: RetryAfter {e.timeout} sec for {chat_id}, attempt {attempt + 1}')
+                self.bucket.pause(e.timeout)
+                await asyncio.sleep(e.timeout)
+                continue
+            except (BotBlocked, UserDeactivated):
+                stats.n_gone += 1
+                if self.on_gone:
+                    await self.on_gone(chat_id)
+                return
+            except Exception:
+                stats.n_failed += 1
+                logger.error(f'{self.name}: error while sending to {chat_id}\n{traceback.format_exc()}')
+                return
+            latency = time.monotonic() - t0
+            stats.latencies.append(latency)
+            stats.n_sent += 1
+            self._chunk_latencies.append(latency)
+            self._pending.append(chat_id)
+            if len(self._pending) >= self.flush_every:
+                await self._flush()
+            return
+        stats.n_failed += 1
+        logger.error(f'{self.name}: giving up on {chat_id} after {self.max_retries} retries')
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        chunk, self._pending = self._pending, []
+        latencies, self._chunk_latencies = self._chunk_latencies, []
+        now = time.monotonic()
+        elapsed, self._chunk_started = now - self._chunk_started, now
+        self._n_batch += 1
+        logger.info(f'{self.name}: batch {self._n_batch} of {len(chunk)} messages in {elapsed:.1f} sec '
+                    f'({len(chunk) / elapsed if elapsed else 0:.1f} msg/sec, '
+                    f'p50 {percentile(latencies, 0.5) * 1000:.0f} ms, '
+                    f'p95 {percentile(latencies, 0.95) * 1000:.0f} ms)')
+        if self.on_flush:
+            try:
+                await self.on_flush(chunk)
+            except Exception:
+                logger.error(f'{self.name}: error while flushing {len(chunk)} chat_ids\n{traceback.format_exc()}')
@@ -0,0 +1,355 @@
+"""
+Incremental backups
+
+A base is a CSV export (COPY) of all the tables. A delta has only the rows written since the previous backup
+of the chain, found by the `xmin` system column, and all primary keys of each table to replay deletions.
+All the tables of a backup are exported in one snapshot, the files are compressed and streamed to the backup
+storage as they go (see db_backup). Bases and deltas are listed in the manifest (BACKUP_MANIFEST_PATH),
+a new base is made every BACKUP_BASE_EVERY_DAYS.
+
+Usage:
+    python -m src.misc.incremental_backup restore   # latest chain into the database in use, replaces its data
+    python -m src.misc.incremental_backup verify    # latest chain into db_test (drops all tables), check row counts
+"""
+import argparse
+import asyncio
+import datetime
+import pathlib
+import sys
+import time
+import traceback
+from typing import AsyncIterator
+
+import asyncpg
+from sqlalchemy import Table, func, select
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.config import logger, IS_TESTING, \
+    BACKUP_MODE, BACKUP_BASE_EVERY_DAYS, BACKUP_MANIFEST_PATH, BACKUP_CHUNK_SIZE
+from src.misc.utils import notify_me
+from src.misc.leader import lease
+from src.misc.db_backup import BackupStats, BackupEntry, BackupManifest, YandexDiskStorage, LocalDirStorage, \
+    BACKUP_TIME_FORMAT, MANIFEST_NAME, BACKUP_LOCK_KEY, do_backup, get_backup_storage, get_compressor, \
+    get_decompressor, delete_old_backups, save_manifest
+from db.database import get_engine
+from db.models import Base
+
+
+TABLES: list[Table] = Base.metadata.sorted_tables   # referenced tables first
+XID_EPOCH = 2 ** 32   # xmin column is a 32-bit transaction id
+
+
+def _columns(table: Table) -> list[str]:
+    return [column.name for column in table.columns]
+
+
+def _pk(table: Table) -> str:
+    return table.primary_key.columns.values()[0].name
+
+
+def _quoted(columns: list[str]) -> str:
+    return ', '.join(f'"{column}"' for column in columns)
+
+
+def _file_name(entry: BackupEntry, table: Table, part: str, extension: str) -> str:
+    # part: 'rows' - exported rows, 'ids' - all primary keys of the table
+    return f'{entry.name}.{entry.kind}.{table.name}.{part}.csv.{extension}'
+
+
+def _find_file(entry: BackupEntry, table: Table, part: str) -> str | None:
+    prefix = f'{entry.name}.{entry.kind}.{table.name}.{part}.csv.'
+    return next((name for name in entry.files if name.startswith(prefix)), None)
+
+
+async def _raw_connection(sa_conn) -> asyncpg.Connection:
+    return (await sa_conn.get_raw_connection()).driver_connection
+
+
+async def copy_chunks(conn: asyncpg.Connection,
+                      query: str,
+                      *args,
+                      stats: BackupStats,
+                      chunk_size: int = BACKUP_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    COPY the query results to CSV and yield them compressed, like stream_pg_dump
+    The queue is bounded, so the query is not read further than the upload goes
+    """
+    compressor = get_compressor()
+    queue: asyncio.Queue[bytes | Exception | None] = asyncio.Queue(maxsize=4)
+
+    async def copy() -> str:
+        try:
+            status = await conn.copy_from_query(query, *args, output=queue.put, format='csv')
+        except Exception as e:
+            await queue.put(e)
+            raise
+        await queue.put(None)
+        return status
+
+    task = asyncio.create_task(copy())
+    buffer = bytearray()
+    try:
+        while (data := await queue.get()) is not None:
+            if isinstance(data, Exception):
+                await task   # raises it
+            stats.raw_size += len(data)
+            buffer += data
+            if len(buffer) >= chunk_size:
+                compressed = await asyncio.to_thread(compressor.compress, bytes(buffer))
+                buffer.clear()
+                if compressed:
+                    stats.compressed_size += len(compressed)
+                    yield compressed
+        status = await task   # 'COPY <n>'
+        stats.n_rows += int(status.split()[-1])
+        compressed = await asyncio.to_thread(compressor.compress, bytes(buffer)) + compressor.flush()
+        stats.compressed_size += len(compressed)
+        yield compressed
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+async def decompressed_chunks(storage: YandexDiskStorage | LocalDirStorage, name: str) -> AsyncIterator[bytes]:
+    decompressor = get_decompressor(name)
+    async for chunk in storage.download(name):
+        if data := await asyncio.to_thread(decompressor.decompress, chunk):
+            yield data
+    if data := decompressor.flush():
+        yield data
+
+
+def previous_entry(manifest: BackupManifest,
+                   now: datetime.datetime,
+                   xmin: int,
+                   base_every_days: int = BACKUP_BASE_EVERY_DAYS) -> BackupEntry | None:
+    """
+    The latest backup of the current chain, which a new delta goes on. None if a new base is due
+    """
+    chain = latest_chain(manifest)
+    if chain is None:
+        return None
+    base, previous = chain[0], chain[-1]
+    if (now - base.created).days >= base_every_days:
+        return None
+    # xmin column wraps around every 2^32 transactions, or the database could be recreated
+    if previous.xmin // XID_EPOCH != xmin // XID_EPOCH or previous.xmin > xmin:
+        return None
+    return previous
+
+
+def latest_chain(manifest: BackupManifest) -> list[BackupEntry] | None:
+    """
+    The latest base with its deltas
+    """
+    return next((chain for chain in reversed(manifest.chains()) if chain[0].kind == 'base'), None)
+
+
+async def do_incremental_backup(storage: YandexDiskStorage | LocalDirStorage = None,
+                                manifest_path: pathlib.Path = BACKUP_MANIFEST_PATH,
+                                base_every_days: int = BACKUP_BASE_EVERY_DAYS) -> bool:
+    """
+    Make a delta on top of the latest backup, or a new base if it's time
+    :return: True if backup was successful, False otherwise
+    """
+    async with lease(BACKUP_LOCK_KEY) as acquired:
+        if not acquired:
+            logger.warning('Backup is skipped, another backup is running')
+            return False
+        storage = storage or get_backup_storage()
+        logger.info(f'Starting incremental backup to {storage}')
+        if err := await storage.check():
+            logger.error(err)
+            await notify_me(err)
+            return False
+
+        manifest = BackupManifest.load(manifest_path)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        extension = get_compressor().extension
+        uploaded = []
+        t0 = time.time()
+        try:
+            async with get_engine().connect() as sa_conn:
+                conn = await _raw_connection(sa_conn)
+                # All the tables are exported in the same snapshot
+                async with conn.transaction(isolation='repeatable_read', readonly=True):
+                    # Transactions from xmin on may be not visible in the snapshot yet, the next delta will take them
+                    xmin = await conn.fetchval('SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint')
+                    previous = previous_entry(manifest, now, xmin, base_every_days)
+                    entry = BackupEntry(name=now.strftime(BACKUP_TIME_FORMAT),
+                                        kind='delta' if previous else 'base',
+                                        created=now,
+                                        base=(previous.base or previous.name) if previous else None,
+                                        xmin=xmin)
+                    stats = BackupStats(name=f'{entry.name} ({entry.kind})')
+                    for table in TABLES:
+                        query = f'SELECT {_quoted(_columns(table))} FROM {table.name}'
+                        args = ()
+                        if previous:
+                            query += ' WHERE xmin::text::bigint >= $1'
+                            args = (previous.xmin % XID_EPOCH,)
+                        exports = [(_file_name(entry, table, 'rows', extension), query, args)]
+                        if previous:
+                            ids_query = f'SELECT "{_pk(table)}" FROM {table.name}'
+                            exports.append((_file_name(entry, table, 'ids', extension), ids_query, ()))
+                        for name, query, args in exports:
+                            uploaded.append(name)
+                            chunks = copy_chunks(conn, query, *args, stats=stats)
+                            try:
+                                await storage.upload(name, chunks)
+                            finally:   # stops COPY if the upload failed
+                                await chunks.aclose()
+                        entry.n_rows[table.name] = await conn.fetchval(f'SELECT count(*) FROM {table.name}')
+                    if previous:   # primary keys are not rows
+                        stats.n_rows -= sum(entry.n_rows.values())
+            entry.files = uploaded
+            entry.size = stats.compressed_size
+            stats.duration = time.time() - t0
+            logger.info(stats.summary())
+            await notify_me(stats.summary())
+            manifest.entries.append(entry)
+            await delete_old_backups(storage, manifest)
+            await save_manifest(storage, manifest, manifest_path)
+            return True
+        except Exception:
+            logger.error(err := f'Error while doing incremental backup\n{traceback.format_exc()}')
+            await notify_me(err)
+            for name in uploaded:
+                try:
+                    await storage.remove(name)
+                except Exception:
+                    logger.error(f'Could not remove {name} of the failed backup')
+            return False
+
+
+async def run_backup() -> bool:
+    """
+    Backup of the kind set by BACKUP_MODE
+    """
+    if BACKUP_MODE == 'full':
+        return await do_backup()
+    return await do_incremental_backup()
+
+
+async def load_manifest(storage: YandexDiskStorage | LocalDirStorage,
+                        manifest_path: pathlib.Path = BACKUP_MANIFEST_PATH) -> BackupManifest:
+    """
+    Local manifest, or its copy in the storage, e.g. on a new server
+    """
+    if manifest_path.exists():
+        return BackupManifest.load(manifest_path)
+    return BackupManifest.parse_raw(b''.join([chunk async for chunk in storage.download(MANIFEST_NAME)]))
+
+
+async def _restore_table(conn: asyncpg.Connection,
+                         storage: YandexDiskStorage | LocalDirStorage,
+                         entry: BackupEntry,
+                         table: Table) -> None:
+    name = _find_file(entry, table, 'rows')
+    if name is None:   # the table didn't exist yet
+        return
+    columns = _columns(table)
+    if entry.kind == 'base':
+        await conn.copy_to_table(table.name, source=decompressed_chunks(storage, name), columns=columns, format='csv')
+        return
+    # Rows of a delta are new or updated
+    pk = _pk(table)
+    updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in columns if column != pk)
+    await conn.execute(f'CREATE TEMP TABLE _restore (LIKE {table.name}) ON COMMIT DROP')
+    await conn.copy_to_table('_restore', source=decompressed_chunks(storage, name), columns=columns, format='csv')
+    await conn.execute(f'INSERT INTO {table.name} ({_quoted(columns)}) '
+                       f'SELECT {_quoted(columns)} FROM _restore '
+                       f'ON CONFLICT ("{pk}") DO ' + (f'UPDATE SET {updates}' if updates else 'NOTHING'))
+    await conn.execute('DROP TABLE _restore')
+
+
+async def _replay_deletions(conn: asyncpg.Connection,
+                            storage: YandexDiskStorage | LocalDirStorage,
+                            entry: BackupEntry,
+                            table: Table) -> None:
+    name = _find_file(entry, table, 'ids')
+    if name is None:
+        return
+    pk = _pk(table)
+    await conn.execute(f'CREATE TEMP TABLE _restore_ids ON COMMIT DROP AS '
+                       f'SELECT "{pk}" FROM {table.name} WITH NO DATA')
+    await conn.copy_to_table('_restore_ids', source=decompressed_chunks(storage, name), columns=[pk], format='csv')
+    await conn.execute(f'DELETE FROM {table.name} t '
+                       f'WHERE NOT EXISTS (SELECT 1 FROM _restore_ids i WHERE i."{pk}" = t."{pk}")')
+    await conn.execute('DROP TABLE _restore_ids')
+
+
+async def restore_chain(chain: list[BackupEntry],
+                        storage: YandexDiskStorage | LocalDirStorage,
+                        engine: AsyncEngine) -> None:
+    """
+    Replace the data in the database with the base of the chain and replay its deltas
+    Runs in one transaction, the database is left as it was if anything fails
+    """
+    async with engine.connect() as sa_conn:
+        conn = await _raw_connection(sa_conn)
+        async with conn.transaction():
+            await conn.execute(f'TRUNCATE {", ".join(table.name for table in TABLES)}')
+            for entry in chain:
+                logger.info(f'Restoring {entry.name} ({entry.kind})')
+                for table in TABLES:
+                    await _restore_table(conn, storage, entry, table)
+                for table in reversed(TABLES):
+                    await _replay_deletions(conn, storage, entry, table)
+            # Serial ids continue after the restored ones
+            for table in TABLES:
+                pk = _pk(table)
+                sequence = await conn.fetchval('SELECT pg_get_serial_sequence($1, $2)', table.name, pk)
+                if sequence:
+                    await conn.execute(f'SELECT setval($1, max("{pk}")) FROM {table.name} '
+                                       f'HAVING max("{pk}") IS NOT NULL', sequence)
+
+
+async def restore(testing: bool = IS_TESTING) -> bool:
+    storage = get_backup_storage()
+    chain = latest_chain(await load_manifest(storage))
+    if chain is None:
+        logger.error('No incremental backups in the manifest')
+        return False
+    await restore_chain(chain, storage, get_engine(testing))
+    logger.info(f'Restored {chain[-1].name} to {get_engine(testing).url.database}')
+    return True
+
+
+async def verify() -> bool:
+    """
+    Restore the latest chain into db_test and compare row counts with the ones at the moment of the backup
+    """
+    storage = get_backup_storage()
+    chain = latest_chain(await load_manifest(storage))
+    if chain is None:
+        logger.error('No incremental backups in the manifest')
+        return False
+    test_engine = get_engine(testing=True)
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    t0 = time.time()
+    await restore_chain(chain, storage, test_engine)
+    logger.info(f'Restored {chain[0].name} + {len(chain) - 1} deltas in {time.time() - t0:.1f} sec')
+
+    passed = True
+    async with test_engine.connect() as conn:
+        for table in TABLES:
+            n_rows = (await conn.execute(select(func.count()).select_from(table))).scalar()
+            expected = chain[-1].n_rows.get(table.name)
+            if expected is not None and n_rows != expected:
+                passed = False
+                logger.error(f'{table.name}: {n_rows} rows restored, {expected} expected')
+            else:
+                logger.info(f'{table.name}: OK ({n_rows} rows)')
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Restore incremental backups')
+    parser.add_argument('command', choices=['restore', 'verify'])
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    ok = loop.run_until_complete(restore() if args.command == 'restore' else verify())
+    sys.exit(0 if ok else 1)
@@ -43,6 +43,7 @@ async def set_bot_commands():
                 types.bot_command.BotCommand('medications', _('список лекарств', locale=locale)),
                 types.bot_command.BotCommand('calendar', _('изменить записи', locale=locale)),
                 types.bot_command.BotCommand('statistics', _('статистика', locale=locale)),
+                types.bot_command.BotCommand('import', _('импорт дневника', locale=locale)),
                 types.bot_command.BotCommand('settings', _('настройки', locale=locale)),
                 types.bot_command.BotCommand('donate', _('поблагодарить', locale=locale)),
             ], language_code=locale)
@@ -0,0 +1,201 @@
+import asyncio
+import datetime
+import math
+import time
+import traceback
+from typing import Awaitable, Callable
+
+from src.config import logger, redis_conn, JOB_RUNNING_TTL
+
+
+### Redis keys:
+# 'jobs:schedule' - sorted set, member is the job name, score is the next run time (unix timestamp, slot)
+# 'job:{name}:{slot}' - idempotency key of the run, 'running', 'done' or 'failed'. The slot is not run twice,
+#                       even if several workers or a restarted leader pick it up. 'running' expires in
+#                       RUNNING_TTL unless renewed by the run, so a slot of a dead worker is run again
+# 'jobs:pending' - sorted set of '{name}:{slot}' runs in progress. Those without 'job:{name}:{slot}' were
+#                  interrupted (the worker died or lost the lease) and are run again by the leader
+# 'jobs:metrics:{name}' - hash with metrics of the job: n_runs, n_failed, n_skipped, total_duration, total_lag,
+#                         last_slot, last_duration, last_lag, last_status
+SCHEDULE_KEY = 'jobs:schedule'
+PENDING_KEY = 'jobs:pending'
+IDEMPOTENCY_TTL = 7 * 24 * 3600
+RUNNING_TTL = JOB_RUNNING_TTL
+
+
+class Job:
+    """
+    Job run every `every` seconds, at slots aligned to unix epoch + `offset` (UTC)
+    E.g. every=3600 - at the start of each hour, every=86400, offset=3.5 * 3600 - every day at 03:30 UTC
+    """
+    def __init__(self,
+                 name: str,
+                 func: Callable[[datetime.datetime], Awaitable],
+                 every: float,
+                 offset: float = 0,
+                 catch_up: int = 1,
+                 max_concurrency: int = 1):
+        """
+        :param name: unique name of the job
+        :param func: coroutine function, called with the slot (naive UTC datetime) the run is for
+        :param every: interval between slots, sec
+        :param offset: shift of the slots, sec
+        :param catch_up: how many of the latest missed slots to run, e.g. after the bot was down.
+            Earlier missed slots are skipped
+        :param max_concurrency: how many runs of the job can go at the same time
+        """
+        self.name = name
+        self.func = func
+        self.every = every
+        self.offset = offset
+        self.catch_up = max(1, catch_up)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    def next_slot(self, now: float) -> float:
+        """
+        The first slot after now
+        """
+        return self.offset + (math.floor((now - self.offset) / self.every) + 1) * self.every
+
+    def due_slots(self, run_at: float, now: float) -> list[float]:
+        """
+        Slots from run_at up to now
+        """
+        n_slots = math.floor((now - run_at) / self.every) + 1
+        return [run_at + i * self.every for i in range(max(n_slots, 0))]
+
+
+class JobScheduler:
+    """
+    Runs jobs at their slots. The schedule is kept in Redis, so slots missed while the bot was down
+    are run on startup (see Job.catch_up). Each run is a separate task, long jobs do not delay the others
+    Should be run in one worker only (the leader). When run() is cancelled (the leadership is lost),
+    the runs in progress are cancelled too, and the new leader runs their slots again
+    """
+    def __init__(self, jobs: list[Job], tick: float = 5):
+        self.jobs = {job.name: job for job in jobs}
+        self.tick = tick
+        self._running: set[asyncio.Task] = set()
+
+    async def run(self) -> None:
+        now = time.time()
+        # Jobs already in the schedule keep their run time, so missed slots are caught up
+        await redis_conn.zadd(SCHEDULE_KEY, {name: job.next_slot(now) for name, job in self.jobs.items()}, nx=True)
+        try:
+            while True:
+                try:
+                    await self.run_due(time.time())
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.error(f'Error in job scheduler:\n{traceback.format_exc()}')
+                await asyncio.sleep(self.tick)
+        finally:
+            for task in list(self._running):
+                task.cancel()
+
+    async def run_due(self, now: float) -> list[asyncio.Task]:
+        """
+        Start runs of the jobs, whose slots have come, and move them to the next slots.
+        Interrupted runs are started again
+        """
+        tasks = []
+        for member in await redis_conn.zrange(PENDING_KEY, 0, -1):
+            name, slot = member.rsplit(':', 1)
+            job = self.jobs.get(name)
+            if job is None:
+                await redis_conn.zrem(PENDING_KEY, member)
+                continue
+            if await redis_conn.exists(f'job:{member}'):   # still running
+                continue
+            logger.warning(f'Job {name}: run for slot {slot} was interrupted, running it again')
+            tasks.append(self.start(job, float(slot)))
+        for name, run_at in await redis_conn.zrangebyscore(SCHEDULE_KEY, '-inf', now, withscores=True):
+            job = self.jobs.get(name)
+            if job is None:   # removed from the code
+                await redis_conn.zrem(SCHEDULE_KEY, name)
+                continue
+            slots = job.due_slots(run_at, now)
+            if len(slots) > job.catch_up:
+                n_skipped = len(slots) - job.catch_up
+                logger.warning(f'Job {name}: skipping {n_skipped} missed slots')
+                await redis_conn.hincrby(f'jobs:metrics:{name}', 'n_skipped', n_skipped)
+                slots = slots[-job.catch_up:]
+            await redis_conn.zadd(SCHEDULE_KEY, {name: job.next_slot(now)})
+            for slot in slots:
+                tasks.append(self.start(job, slot))
+        return tasks
+
+    def start(self, job: Job, slot: float) -> asyncio.Task:
+        task = asyncio.create_task(self.run_job(job, slot))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+        return task
+
+    async def run_job(self, job: Job, slot: float) -> None:
+        key = f'job:{job.name}:{int(slot)}'
+        if not await redis_conn.set(key, 'running', nx=True, px=int(RUNNING_TTL * 1000)):
+            logger.info(f'Job {job.name}: slot {int(slot)} has already been run')
+            return
+        await redis_conn.zadd(PENDING_KEY, {f'{job.name}:{int(slot)}': slot})
+        heartbeat = asyncio.create_task(self._keep_running(key))
+        try:
+            async with job.semaphore:
+                started_at = time.time()
+                lag = started_at - slot
+                try:
+                    await job.func(datetime.datetime.utcfromtimestamp(slot))
+                    status = 'done'
+                except asyncio.CancelledError:
+                    # The leadership is lost. The run stays pending, drop 'running' for the new leader to run it
+                    logger.warning(f'Job {job.name}: run for slot {int(slot)} was cancelled')
+                    try:
+                        await redis_conn.delete(key)
+                    except Exception:
+                        logger.error(f'Could not delete {key}:\n{traceback.format_exc()}')
+                    raise
+                except Exception:
+                    status = 'failed'
+                    logger.error(f'Job {job.name} failed for slot {int(slot)}:\n{traceback.format_exc()}')
+                duration = time.time() - started_at
+        finally:
+            heartbeat.cancel()
+        logger.info(f'Job {job.name}: {status} in {duration:.1f} sec, lag {lag:.1f} sec')
+        metrics_key = f'jobs:metrics:{job.name}'
+        async with redis_conn.pipeline(transaction=True) as pipe:
+            pipe.set(key, status, ex=IDEMPOTENCY_TTL)
+            pipe.zrem(PENDING_KEY, f'{job.name}:{int(slot)}')
+            pipe.hincrby(metrics_key, 'n_runs', 1)
+            if status == 'failed':
+                pipe.hincrby(metrics_key, 'n_failed', 1)
+            pipe.hincrbyfloat(metrics_key, 'total_duration', duration)
+            pipe.hincrbyfloat(metrics_key, 'total_lag', lag)
+            pipe.hset(metrics_key, mapping={
+                'last_slot': int(slot),
+                'last_duration': round(duration, 3),
+                'last_lag': round(lag, 3),
+                'last_status': status
+            })
+            await pipe.execute()
+
+    @staticmethod
+    async def _keep_running(key: str) -> None:
+        # Renew 'running' while the job runs. If the worker dies, the key expires and the slot can be run again
+        while True:
+            await asyncio.sleep(RUNNING_TTL / 3)
+            try:
+                await redis_conn.pexpire(key, int(RUNNING_TTL * 1000))
+            except Exception:
+                logger.error(f'Could not renew {key}:\n{traceback.format_exc()}')
+
+
+async def get_job_metrics() -> dict[str, dict[str, str]]:
+    """
+    Metrics of the scheduled jobs, by job name
+    """
+    names = await redis_conn.zrange(SCHEDULE_KEY, 0, -1)
+    async with redis_conn.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.hgetall(f'jobs:metrics:{name}')
+        results = await pipe.execute()
+    return dict(zip(names, results))
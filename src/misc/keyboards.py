@@ -3,15 +3,16 @@ import datetime
 from typing import Any, Callable
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, \
     InlineKeyboardMarkup, InlineKeyboardButton
-from src.bot import _
-from src.misc.utils import get_user_language, month_name
+from src.bot import _, i18n
+from src.misc.utils import month_name
 
 
 def ten_things(list_of_el: list[Any],
                back_callback: str,
                navigation_callback: str,
                callback_data_func: Callable[[Any], str],
-               page: int = 0) -> InlineKeyboardMarkup:
+               page: int = 0,
+               n_total: int = None) -> InlineKeyboardMarkup:
     """
     Return keyboard with 10 buttons in 2 rows for a given medications, added by the user
     Allows to choose a thing by its number
@@ -21,6 +22,7 @@ def ten_things(list_of_el: list[Any],
     :param navigation_callback: callback_data for navigation buttons, pages should be postfixed as _{page}
     :param callback_data_func: function for callback_data for each of 10 buttons, argument is an element from list_of_el
     :param page: int[Optional] page number
+    :param n_total: int[Optional] total number of elements, if list_of_el is already the page (paged in DB)
 
     :return: InlineKeyboardMarkup
     """
@@ -28,8 +30,12 @@ def ten_things(list_of_el: list[Any],
     # otherwise provide additional row with "back", "next" and "1/3"(pages) buttons
     keyboard = InlineKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     keyboard.row(InlineKeyboardButton(_('<< Назад'), callback_data=back_callback))
-    n_pages = len(list_of_el) // 10
-    sliced_list = list_of_el[page * 10: (page + 1) * 10]
+    if n_total is None:
+        n_total = len(list_of_el)
+        sliced_list = list_of_el[page * 10: (page + 1) * 10]
+    else:
+        sliced_list = list_of_el[:10]
+    n_pages = (n_total - 1) // 10 if n_total else 0
     # Filling keyboard with number buttons: 2 rows of 5 buttons max
     keyboard.row(*[
         InlineKeyboardButton(str(i + 1), callback_data=callback_data_func(el))
@@ -42,7 +48,7 @@ def ten_things(list_of_el: list[Any],
         ])
 
     # If there are less than 10 elements, return keyboard
-    if len(list_of_el) <= 10:
+    if n_total <= 10:
         return keyboard
 
     # If more, add navigation buttons
@@ -96,8 +102,8 @@ async def calendar_kb(callback_prefix: str,
     empty buttons for empty days
     """
     keyboard = InlineKeyboardMarkup(row_width=7)
-    # First row - month and year
-    language = await get_user_language(user_id)
+    # First row - month and year. Locale is already defined by i18n middleware for the current update
+    language = i18n.ctx_locale.get()
     keyboard.row(InlineKeyboardButton(f'{month_name(month, language)} {year}', callback_data='ignore'))
     # NOTE 2 letters for each day of the week
     keyboard.row(*[InlineKeyboardButton(day, callback_data="ignore") for day in _('Пн Вт Ср Чт Пт Сб Вс').split()])
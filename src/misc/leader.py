@@ -0,0 +1,131 @@
+import asyncio
+import os
+import socket
+import traceback
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable
+
+from src.config import logger, redis_conn, LEADER_LEASE_TTL
+
+
+LEADER_KEY = 'leader'
+
+# Prolongs the lease if it is still held by this worker
+# KEYS: lease key
+# ARGV: holder id, ttl in ms
+_RENEW_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_renew_lease = redis_conn.register_script(_RENEW_LEASE_LUA)
+
+# Releases the lease if it is still held by this worker
+# KEYS: lease key
+# ARGV: holder id
+_RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+_release_lease = redis_conn.register_script(_RELEASE_LEASE_LUA)
+
+
+class LeaderElection:
+    """
+    Elects one of the bot workers to run the jobs, that must not be run twice (scheduler, init of states)
+    The leader holds the 'leader' key in Redis with a TTL and renews it every ttl / 3 seconds.
+    If the leader dies, the key expires and another worker takes it over in at most `ttl` seconds
+    """
+    def __init__(self, ttl: float = LEADER_LEASE_TTL):
+        self.ttl = ttl
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.is_leader = False
+        self._leader_tasks: list[asyncio.Task] = []
+
+    async def try_acquire(self) -> bool:
+        if self.is_leader:
+            self.is_leader = bool(await _renew_lease(keys=[LEADER_KEY], args=[self.worker_id, int(self.ttl * 1000)]))
+        else:
+            self.is_leader = bool(await redis_conn.set(LEADER_KEY, self.worker_id, nx=True, px=int(self.ttl * 1000)))
+        return self.is_leader
+
+    async def run(self, on_elected: Callable[[], Awaitable[list[asyncio.Task]]]) -> None:
+        """
+        Background task, keeps trying to become the leader
+        :param on_elected: called when the worker becomes the leader, returns tasks to cancel if leadership is lost
+        """
+        while True:
+            was_leader = self.is_leader
+            try:
+                await self.try_acquire()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Can't be sure the lease is still ours
+                logger.error(f'Error in leader election:\n{traceback.format_exc()}')
+                self.is_leader = False
+            if self.is_leader and not was_leader:
+                logger.info(f'Worker {self.worker_id} is the leader')
+                try:
+                    self._leader_tasks = await on_elected()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Holding the lease without the leader tasks would stop the jobs on all the workers
+                    logger.error(f'Error while starting the leader tasks, leadership is given away:\n'
+                                 f'{traceback.format_exc()}')
+                    try:
+                        await self.release()
+                    except Exception:
+                        logger.error(f'Error while releasing the leadership:\n{traceback.format_exc()}')
+                    self.is_leader = False
+            elif was_leader and not self.is_leader:
+                logger.warning(f'Worker {self.worker_id} lost the leadership')
+                self._cancel_leader_tasks()
+            await asyncio.sleep(self.ttl / 3)
+
+    def _cancel_leader_tasks(self) -> None:
+        for task in self._leader_tasks:
+            task.cancel()
+        self._leader_tasks = []
+
+    async def release(self) -> None:
+        """
+        Give the leadership away on shutdown, so another worker does not wait for the lease to expire
+        """
+        self._cancel_leader_tasks()
+        if self.is_leader:
+            await _release_lease(keys=[LEADER_KEY], args=[self.worker_id])
+            self.is_leader = False
+
+
+@asynccontextmanager
+async def lease(key: str, ttl: float = LEADER_LEASE_TTL) -> AsyncIterator[bool]:
+    """
+    Hold `key` while the block runs, for the tasks that must not run on two workers at once.
+    The key is renewed every ttl / 3 seconds and expires in `ttl` seconds if the worker dies
+    Yields False if the key is held by another worker, the block should do nothing then
+    """
+    holder_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+    if not await redis_conn.set(key, holder_id, nx=True, px=int(ttl * 1000)):
+        yield False
+        return
+
+    async def keep():
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                await _renew_lease(keys=[key], args=[holder_id, int(ttl * 1000)])
+            except Exception:
+                logger.error(f'Could not renew {key}:\n{traceback.format_exc()}')
+
+    renew = asyncio.create_task(keep())
+    try:
+        yield True
+    finally:
+        renew.cancel()
+        await _release_lease(keys=[key], args=[holder_id])
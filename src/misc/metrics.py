@@ -0,0 +1,257 @@
+"""
+Metrics of the handlers: duration of each, split into the time spent in SQL, Redis and Telegram API calls
+
+SQL statements are timed with the engine events, Redis commands and Bot API requests - by wrapping
+redis_conn and bot (see instrument). Time is attributed to the update being processed (see UpdateTimings),
+InstrumentationMiddleware observes the histograms when the handler is done.
+Exposed in Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics
+"""
+import collections
+import time
+from contextvars import ContextVar
+
+import aioredis
+from aiogram import Bot
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.config import logger, METRICS_HOST, SLOW_HANDLERS_WINDOW
+from src.misc.broadcaster import percentile
+
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+KINDS = ('sql', 'redis', 'api')
+
+
+class UpdateTimings:
+    """
+    Time spent in SQL, Redis and Bot API calls while processing the current update
+    """
+    def __init__(self):
+        self.handler = 'unhandled'
+        self.started_at = time.perf_counter()
+        self.seconds = dict.fromkeys(KINDS, 0.)
+        self.calls = dict.fromkeys(KINDS, 0)
+
+    def add(self, kind: str, duration: float) -> None:
+        self.seconds[kind] += duration
+        self.calls[kind] += 1
+
+
+# Set by InstrumentationMiddleware for each update. Tasks, created by the handler, share the object
+current_timings: ContextVar[UpdateTimings | None] = ContextVar('current_timings', default=None)
+
+
+def record(kind: str, duration: float) -> None:
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(kind, duration)
+
+
+def _label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Prometheus histogram with the `handler` label
+    """
+    def __init__(self, name: str, documentation: str, buckets: tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.counts: dict[str, list[int]] = {}   # per bucket, not cumulative
+        self.sums: dict[str, float] = {}
+
+    def observe(self, handler: str, value: float) -> None:
+        if handler not in self.counts:
+            self.counts[handler] = [0] * (len(self.buckets) + 1)
+            self.sums[handler] = 0.
+        i = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[handler][i] += 1
+        self.sums[handler] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for handler, counts in self.counts.items():
+            label = f'handler="{_label(handler)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {sum(counts)}')
+            lines.append(f'{self.name}_sum{{{label}}} {self.sums[handler]}')
+            lines.append(f'{self.name}_count{{{label}}} {sum(counts)}')
+        return lines
+
+
+class Counter:
+    """
+    Prometheus counter with the `handler` label
+    """
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values: dict[str, int] = collections.defaultdict(int)
+
+    def inc(self, handler: str, value: int = 1) -> None:
+        self.values[handler] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for handler, value in self.values.items():
+            lines.append(f'{self.name}{{handler="{_label(handler)}"}} {value}')
+        return lines
+
+
+class SlowestHandlers:
+    """
+    Handler runs for the last `window` seconds, to find the slowest handlers
+    """
+    def __init__(self, window: float = SLOW_HANDLERS_WINDOW, maxlen: int = 100_000):
+        self.window = window
+        self.runs: collections.deque[tuple[float, str, float, dict[str, float]]] = collections.deque(maxlen=maxlen)
+
+    def add(self, handler: str, duration: float, seconds: dict[str, float]) -> None:
+        now = time.monotonic()
+        self.runs.append((now, handler, duration, seconds))
+        while self.runs and self.runs[0][0] < now - self.window:
+            self.runs.popleft()
+
+    def summary(self, top: int = 5) -> str:
+        """
+        Handlers with the highest p95 duration
+        """
+        now = time.monotonic()
+        by_handler: dict[str, list[tuple[float, dict[str, float]]]] = collections.defaultdict(list)
+        for at, handler, duration, seconds in self.runs:
+            if at >= now - self.window:
+                by_handler[handler].append((duration, seconds))
+        if not by_handler:
+            return 'No handler runs'
+        p95 = {handler: percentile([duration for duration, __ in runs], 0.95) for handler, runs in by_handler.items()}
+        lines = []
+        for handler in sorted(p95, key=p95.get, reverse=True)[:top]:
+            runs = by_handler[handler]
+            split = ', '.join(f'{kind} {sum(seconds[kind] for __, seconds in runs) / len(runs) * 1000:.0f}'
+                              for kind in KINDS)
+            lines.append(f'{handler}: {len(runs)} runs, p95 {p95[handler] * 1000:.0f} ms (avg ms: {split})')
+        return '\n'.join(lines)
+
+
+handler_duration = Histogram('bot_handler_duration_seconds', 'Time from receiving an update to the handler end')
+handler_seconds = {kind: Histogram(f'bot_handler_{kind}_seconds', f'Time spent in {kind} calls by the handler')
+                   for kind in KINDS}
+handler_calls = {kind: Counter(f'bot_handler_{kind}_calls_total', f'Number of {kind} calls by the handler')
+                 for kind in KINDS}
+slowest_handlers = SlowestHandlers()
+
+
+def observe(timings: UpdateTimings) -> None:
+    handler = timings.handler
+    duration = time.perf_counter() - timings.started_at
+    handler_duration.observe(handler, duration)
+    for kind in KINDS:
+        handler_seconds[kind].observe(handler, timings.seconds[kind])
+        handler_calls[kind].inc(handler, timings.calls[kind])
+    slowest_handlers.add(handler, duration, timings.seconds)
+
+
+def render() -> str:
+    lines = handler_duration.render()
+    for kind in KINDS:
+        lines += handler_seconds[kind].render()
+        lines += handler_calls[kind].render()
+    return '\n'.join(lines) + '\n'
+
+
+### Instrumentation
+def instrument_engine(engine: AsyncEngine) -> None:
+    @event.listens_for(engine.sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        record('sql', time.perf_counter() - conn.info['query_started_at'].pop())
+
+    @event.listens_for(engine.sync_engine, 'handle_error')
+    def handle_error(exception_context):
+        if exception_context.connection is not None and exception_context.connection.info.get('query_started_at'):
+            started_at = exception_context.connection.info['query_started_at'].pop()
+            record('sql', time.perf_counter() - started_at)
+
+
+def instrument_redis(redis: aioredis.Redis) -> None:
+    """
+    Time commands and pipelines of the client. Pub/sub connections are not timed
+    """
+    execute_command = redis.execute_command
+    pipeline = redis.pipeline
+
+    async def timed_execute_command(*args, **options):
+        started_at = time.perf_counter()
+        try:
+            return await execute_command(*args, **options)
+        finally:
+            record('redis', time.perf_counter() - started_at)
+
+    def timed_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        async def timed_execute(*execute_args, **execute_kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await execute(*execute_args, **execute_kwargs)
+            finally:
+                record('redis', time.perf_counter() - started_at)
+
+        pipe.execute = timed_execute
+        return pipe
+
+    redis.execute_command = timed_execute_command
+    redis.pipeline = timed_pipeline
+
+
+def instrument_bot(bot: Bot) -> None:
+    request = bot.request
+
+    async def timed_request(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return await request(*args, **kwargs)
+        finally:
+            record('api', time.perf_counter() - started_at)
+
+    bot.request = timed_request
+
+
+def instrument(engine: AsyncEngine, redis: aioredis.Redis, bot: Bot) -> None:
+    instrument_engine(engine)
+    instrument_redis(redis)
+    instrument_bot(bot)
+
+
+### HTTP endpoint
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type='text/plain', headers={'X-Content-Type-Options': 'nosniff'})
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST) -> web.AppRunner | None:
+    """
+    Serve /metrics in the background, None if the port is not available
+    """
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logger.error(f'Metrics endpoint could not be started on {host}:{port}: {e}')
+        await runner.cleanup()
+        return None
+    logger.info(f'Metrics on http://{host}:{port}/metrics')
+    return runner
@@ -0,0 +1,196 @@
+"""
+Import of the pains history from an xlsx or csv table in the layout of the pains statistics export:
+Дата | Часов | Сила | Аура | Триггеры | Симптомы | Лекарство | Кол-во | Примечания
+Header may be in any language of the bot, other columns are ignored.
+A row without a date continues the pain above with one more druguse, as in the export
+
+Rows are read and validated one at a time (xlsx in openpyxl's read-only mode), nothing is imported
+if there are errors. A date may appear in the file only once. Inserted with db.sql.import_paincases
+"""
+import csv
+import datetime
+import io
+from typing import IO, Any, Iterable, Iterator, Sequence
+
+import openpyxl
+
+from db.sql import ImportedPain
+from src.bot import _
+from src.misc.utils import PAIN_COLUMNS
+
+
+LOCALES = ['ru', 'en', 'uk', 'fr', 'es']
+REQUIRED_COLUMNS = ['Дата', 'Часов', 'Сила']
+MAX_ROWS = 10000
+MAX_ERRORS = 10
+DATE_FORMATS = ['%d.%m.%Y', '%Y-%m-%d', '%d/%m/%Y', '%d.%m.%y']
+TRUE_VALUES = {'1', 'true', 'yes', 'да', 'так', 'oui', 'sí', 'si'}
+FALSE_VALUES = {'', '0', 'false', 'no', 'нет', 'ні', 'non'}
+
+
+class TableImportError(Exception):
+    """
+    File can't be imported, the message is for the user
+    """
+
+
+def column_names() -> dict[str, str]:
+    """
+    Header names in all languages -> column names of PAIN_COLUMNS
+    """
+    return {_(col, locale=locale).strip().lower(): col for col in PAIN_COLUMNS for locale in LOCALES}
+
+
+def xlsx_rows(buf: IO[bytes]) -> Iterator[Sequence[Any]]:
+    workbook = openpyxl.load_workbook(buf, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def csv_rows(buf: IO[bytes]) -> Iterator[Sequence[Any]]:
+    text = io.TextIOWrapper(buf, encoding='utf-8-sig', newline='')
+    try:
+        dialect = csv.Sniffer().sniff(text.read(4096), delimiters=',;\t')
+    except (csv.Error, UnicodeDecodeError):
+        dialect = csv.excel
+    text.seek(0)
+    try:
+        yield from csv.reader(text, dialect)
+    except UnicodeDecodeError:
+        raise TableImportError(_('Файл должен быть в кодировке UTF-8'))
+    finally:
+        text.detach()
+
+
+def _is_empty(value) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+
+def parse_date(value) -> datetime.date:
+    if isinstance(value, datetime.datetime):
+        date = value.date()
+    elif isinstance(value, datetime.date):
+        date = value
+    else:
+        for date_format in DATE_FORMATS:
+            try:
+                date = datetime.datetime.strptime(str(value).strip(), date_format).date()
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(_('неверная дата "{value}", нужна ДД.ММ.ГГГГ').format(value=value))
+    if date > datetime.date.today():
+        raise ValueError(_('дата {date} в будущем').format(date=date.strftime('%d.%m.%Y')))
+    return date
+
+
+def parse_int(value, name: str, min_value: int, max_value: int) -> int:
+    """
+    Clamped to the limits, as in ReportPainCaseForm
+    """
+    try:
+        number = round(float(str(value).strip().replace(',', '.')))
+    except ValueError:
+        raise ValueError(_('"{name}" должно быть числом, а не "{value}"').format(name=_(name), value=value))
+    return max(min_value, min(max_value, number))
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    text = '' if value is None else str(value).strip().lower()
+    if text in TRUE_VALUES or text in {_('Да', locale=locale).lower() for locale in LOCALES}:
+        return True
+    if text in FALSE_VALUES or text in {_('Нет', locale=locale).lower() for locale in LOCALES}:
+        return False
+    raise ValueError(_('"{name}" должно быть "Да" или "Нет", а не "{value}"').format(name=_('Аура'), value=value))
+
+
+def parse_text(value) -> str | None:
+    return None if _is_empty(value) else str(value).strip()
+
+
+def read_pains(rows: Iterable[Sequence[Any]]) -> Iterator[ImportedPain]:
+    """
+    Validate the rows one at a time, yield each pain when its last row is read
+    Raises TableImportError with the first MAX_ERRORS errors after the last row
+    """
+    rows = iter(rows)
+    names = column_names()
+    header = next(rows, None) or []
+    index = {names[str(cell).strip().lower()]: i for i, cell in enumerate(header)
+             if not _is_empty(cell) and str(cell).strip().lower() in names}
+    missing = [_(col) for col in REQUIRED_COLUMNS if col not in index]
+    if missing:
+        raise TableImportError(_('В первой строке не найдены столбцы: {columns}').format(columns=', '.join(missing)))
+
+    errors = []
+    dates = set()   # one pain a day, as in the bot
+    pain: ImportedPain | None = None
+    for row_number, row in enumerate(rows, start=2):
+        if row_number > MAX_ROWS + 1:
+            raise TableImportError(_('Слишком много строк, максимум {n}').format(n=MAX_ROWS))
+        cells = {col: row[i] if i < len(row) else None for col, i in index.items()}
+        if all(_is_empty(value) for value in cells.values()):
+            continue
+        try:
+            drugname = parse_text(cells.get('Лекарство'))
+            druguse = (drugname, parse_text(cells.get('Кол-во')) or '') if drugname else None
+            if _is_empty(cells['Дата']):
+                # Druguse of the pain above
+                if druguse is None:
+                    raise ValueError(_('нет даты'))
+                if pain is None:
+                    if errors:
+                        continue   # the pain above is invalid
+                    raise ValueError(_('нет даты'))
+                pain.druguses.append(druguse)
+                continue
+            new_pain = ImportedPain(
+                date=parse_date(cells['Дата']),
+                durability=parse_int(cells['Часов'], 'Часов', 1, 24 * 7),
+                intensity=parse_int(cells['Сила'], 'Сила', 1, 10),
+                aura=parse_bool(cells.get('Аура')),
+                provocateurs=parse_text(cells.get('Триггеры')),
+                symptoms=parse_text(cells.get('Симптомы')),
+                description=parse_text(cells.get('Примечания')),
+                druguses=[druguse] if druguse else []
+            )
+            if new_pain.date in dates:
+                raise ValueError(_('дата {date} уже есть в файле выше').format(date=new_pain.date.strftime('%d.%m.%Y')))
+            dates.add(new_pain.date)
+        except ValueError as e:
+            pain = None
+            errors.append(_('Строка {n}: {error}').format(n=row_number, error=e))
+            continue
+        if pain is not None and not errors:
+            yield pain
+        pain = new_pain
+    if errors:
+        text = '\n'.join(errors[:MAX_ERRORS])
+        if len(errors) > MAX_ERRORS:
+            text += '\n' + _('и ещё {n} ошибок').format(n=len(errors) - MAX_ERRORS)
+        raise TableImportError(text)
+    if pain is not None:
+        yield pain
+
+
+def read_pains_file(buf: IO[bytes], file_name: str) -> list[ImportedPain]:
+    """
+    Pains from an xlsx or csv file, blocking
+    """
+    if file_name.lower().endswith('.xlsx'):
+        rows = xlsx_rows(buf)
+    elif file_name.lower().endswith('.csv'):
+        rows = csv_rows(buf)
+    else:
+        raise TableImportError(_('Поддерживаются только файлы .xlsx и .csv'))
+    try:
+        return list(read_pains(rows))
+    except TableImportError:
+        raise
+    except Exception as e:   # not a valid xlsx file, etc.
+        raise TableImportError(_('Не удалось прочитать файл: {error}').format(error=e))
@@ -0,0 +1,53 @@
+import asyncio
+import traceback
+
+from db import sql
+from db.redis.crud import pop_from_purge_queue, update_everyday_report
+from db.redis.models import PydanticUser
+from src.config import logger
+from src.misc.utils import notify_me
+
+
+PURGE_INTERVAL = 30      # seconds between checks of the queue
+PURGE_BATCH_SIZE = 50
+PURGE_CONCURRENCY = 3    # users deleted at the same time
+
+
+async def purge_queued_users() -> int:
+    """
+    Delete all users from the purge queue in batches
+    Deleted users are added to the everyday report once per batch
+    :return: number of deleted users
+    """
+    semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+
+    async def delete(telegram_id: int) -> PydanticUser | None:
+        async with semaphore:
+            return await sql.delete_user(telegram_id, report=False)
+
+    n_deleted = 0
+    while telegram_ids := await pop_from_purge_queue(PURGE_BATCH_SIZE):
+        results = await asyncio.gather(*[delete(telegram_id) for telegram_id in telegram_ids])
+        deleted_users = [user for user in results if user is not None]
+        if deleted_users:
+            await update_everyday_report(deleted_users=deleted_users)
+        n_deleted += len(deleted_users)
+        if len(deleted_users) != len(telegram_ids):
+            not_deleted = [telegram_id for telegram_id, user in zip(telegram_ids, results) if user is None]
+            await notify_me(f'Error while deleting users {not_deleted}')
+    if n_deleted:
+        logger.info(f'Purged {n_deleted} users')
+    return n_deleted
+
+
+async def purger() -> None:
+    """
+    Background task, deletes users from the purge queue every PURGE_INTERVAL seconds
+    Users are queued by add_to_purge_queue during mass sendings, so the sending is not slowed down by deletions
+    """
+    while True:
+        await asyncio.sleep(PURGE_INTERVAL)
+        try:
+            await purge_queued_users()
+        except Exception:
+            logger.error(f'Error while purging users:\n{traceback.format_exc()}')
@@ -1,9 +1,13 @@
+import os
+
 from aiogram.utils.exceptions import CantParseEntities
 
 from src.bot import bot
-from src.config import MY_TG_ID
+from src.config import MY_TG_ID, redis_log_handler
+from src.middlewares.language_middleware import language_cache
+from src.misc.jobs import get_job_metrics
+from src.misc.metrics import slowest_handlers
 from src.fsm_forms import available_fsm_states
-from db.models import PainCase, DrugUse, Pressure, Drug
 from db.redis.models import PydanticUser, EverydayReport
 import db.redis.crud as redis_crud
 import db.sql as sql
@@ -11,7 +15,8 @@ import db.sql as sql
 
 async def everyday_report(reset_old_one: bool = True) -> None:
     report: EverydayReport = await redis_crud.get_current_report()
-    text = await get_report_text(report)
+    summary: sql.DBSummary = await sql.get_db_summary()
+    text = await get_report_text(report, summary)
     try:
         await bot.send_message(chat_id=MY_TG_ID, text=text, parse_mode='HTML')
     except CantParseEntities:
@@ -19,22 +24,15 @@ async def everyday_report(reset_old_one: bool = True) -> None:
     if reset_old_one:
         await redis_crud.init_everyday_report()
         await redis_crud.init_states(available_fsm_states)
-        await sql.report_everyday_stats(report)
+        await sql.report_everyday_stats(report, summary)
 
 
-async def get_report_text(report: EverydayReport) -> str:
+async def get_report_text(report: EverydayReport, summary: sql.DBSummary = None) -> str:
     new_users_text = await notif_of_new_users()
     deleted_users: list[PydanticUser] = report.deleted_users
-    # Count users with at least one added row in Pains table - they are active_users
-    active_users = await sql.get_users(active=True)
-
-    # Users who have something recorded within the last 31 days - superactive users
-    n_superactive_users = await sql.get_users(super_active=True, return_count=True)
-
-    # Users who have regular notification
-    not_notifiable_users = await sql.get_users_where(notify_every=-1)
-    n_users = await sql.get_users(return_count=True)
-    n_notifiable_users = n_users - len(not_notifiable_users)
+    # Users, active users and number of rows in Pain, DrugUse, Pressure, Drug tables
+    if summary is None:
+        summary = await sql.get_db_summary()
 
     # Who deleted?
     if not deleted_users:
@@ -53,20 +51,37 @@ async def get_report_text(report: EverydayReport) -> str:
             text_deleted += f'{i + 1}. {user.first_name} {username} {activities} deleted\n'
     text_deleted += '\n'
 
-    # number of rows in Pain, DrugUse, Pressure, Drug tables
-    n_pains = await sql.get_all_(PainCase, return_count=True)
-    n_druguses = await sql.get_all_(DrugUse, return_count=True)
-    n_pressures = await sql.get_all_(Pressure, return_count=True)
-    n_medications = await sql.get_all_(Drug, return_count=True)
-
-    stats = f'Pains: {report.n_pains} / {n_pains}\n' \
-            f'DrugUses: {report.n_druguses} / {n_druguses}\n' \
-            f'Pressures: {report.n_pressures} / {n_pressures}\n' \
-            f'Drugs: {report.n_medications} / {n_medications}\n'
+    stats = f'Pains: {report.n_pains} / {summary.n_pains}\n' \
+            f'DrugUses: {report.n_druguses} / {summary.n_druguses}\n' \
+            f'Pressures: {report.n_pressures} / {summary.n_pressures}\n' \
+            f'Drugs: {report.n_medications} / {summary.n_medications}\n'
+
+    log_stats = redis_log_handler.stats()
+    stats += f'\nLogs: {log_stats["flushed"]} pushed in {log_stats["batches"]} batches, ' \
+             f'{log_stats["dropped"]} dropped, {log_stats["failed"]} failed\n'
+    db_pool = sql.pool_stats()
+    stats += f'DB pool: {db_pool["checked_out"]}/{db_pool["size"]} checked out, ' \
+             f'{db_pool["overflow"]}/{db_pool["max_overflow"]} overflow, ' \
+             f'wait avg {db_pool["wait_avg"] * 1000:.1f} ms, max {db_pool["wait_max"] * 1000:.0f} ms, ' \
+             f'{db_pool["timeouts"]} timeouts\n'
+    user_cache = redis_crud.user_cache_stats
+    stats += f'User cache: {user_cache["hits"]} hits, {user_cache["misses"]} misses\n'
+    stats += f'Language cache: {language_cache.hits} hits, {language_cache.misses} misses\n'
+    for name, metrics in (await get_job_metrics()).items():
+        if not metrics.get('n_runs'):
+            continue
+        n_runs = int(metrics['n_runs'])
+        stats += f'Job {name}: {n_runs} runs, {metrics.get("n_failed", 0)} failed, ' \
+                 f'{metrics.get("n_skipped", 0)} skipped, ' \
+                 f'avg {float(metrics["total_duration"]) / n_runs:.1f} sec, ' \
+                 f'lag {float(metrics["total_lag"]) / n_runs:.1f} sec\n'
+    # Runs are kept in memory of each worker, the report is made by the leader
+    stats += f'\nSlowest handlers of worker {os.getpid()} (last {slowest_handlers.window / 3600:g} h):\n' \
+             f'{slowest_handlers.summary()}\n'
 
     text = f'{new_users_text}\n' \
-           f'{n_notifiable_users}/{n_users} users with notification\n' \
-           f'{len(active_users)} active and {n_superactive_users} superactive users\n\n' \
+           f'{summary.n_notifiable_users}/{summary.n_users} users with notification\n' \
+           f'{summary.n_active_users} active and {summary.n_superactive_users} superactive users\n\n' \
            f'{text_deleted}' \
            f'{stats}'
     return text
@@ -1,4 +1,6 @@
 from xlsxwriter import Workbook
+from typing import IO, AsyncIterable
+import asyncio
 import io
 import datetime
 import pytz
@@ -7,8 +9,10 @@ import gettext
 
 from db import sql
 from src.bot import bot, _
-from src.config import MY_TG_ID, logger, redis_conn
+from src.config import MY_TG_ID, logger
 from db import sql
+import db.redis.crud as redis_crud
+from src.middlewares.language_middleware import language_cache
 
 domain = 'iso3166-1'
 ru = gettext.translation(domain, pycountry.LOCALES_DIR, languages=['ru'])
@@ -44,8 +48,10 @@ async def change_user_language(user_id: str | int,
                                language: str) -> None:
     """
     Changes user language in Redis for i18n middleware
+    In-process caches of all the workers are invalidated through 'channel:language'
     """
-    await redis_conn.set(str(user_id), language)
+    await redis_crud.cache_language(int(user_id), language, publish=True)
+    language_cache.set(int(user_id), language)   # do not wait for the message to this worker
 
 
 async def get_user_language(user_id: str | int) -> str:
@@ -53,11 +59,10 @@ async def get_user_language(user_id: str | int) -> str:
     Gets user language from Redis
     If not found, gets it from DB and sets in Redis
     """
-    language = await redis_conn.get(str(user_id))
+    language = language_cache.get(int(user_id)) or await redis_crud.get_cached_language(int(user_id))
     if language is None:
-        user = await sql.get_user(telegram_id=user_id)
+        user = await sql.get_user_profile(telegram_id=int(user_id))   # caches the language along with the profile
         language = user.language
-        await redis_conn.set(str(user_id), language)
     return language
 
 
@@ -132,35 +137,60 @@ def change_timezone_get_utc(utc_time: datetime.time,
 #     return ax.get_figure(), ax
 
 
-def write_xlsx(buf: io.BytesIO,
-               data: list[dict]) -> None:
+# Columns of the statistics tables, translated in the header (see report_cols_rename).
+# Pains tables in the same layout can be imported (see src/misc/pain_import.py)
+PAIN_COLUMNS = ['Дата', 'Часов', 'Сила', 'Аура', 'Триггеры', 'Симптомы', 'Лекарство', 'Кол-во', 'Примечания']
+MEDICATION_COLUMNS = ['Дата', 'Лекарство', 'Кол-во']
+PRESSURE_COLUMNS = ['Дата', 'Время', 'Систолическое', 'Диастолическое', 'Пульс']
+# Rows passed to the writer thread at once
+XLSX_BATCH_SIZE = 500
+
+
+async def write_xlsx(buf: IO[bytes],
+                     columns: list[str],
+                     rows: AsyncIterable[dict],
+                     batch_size: int = XLSX_BATCH_SIZE) -> int:
     """
-    Writes an xlsx file in buffer 'buf' from the given data.
-    Modifies buffer inplace
+    Writes an xlsx file in buffer 'buf' from the given rows
+    Worksheet is written in xlsxwriter's constant_memory mode, so memory does not grow with the number of rows
+    Rows are collected in batches of batch_size and written in a thread, not to block the event loop
+    Modifies buffer inplace, returns the number of written rows (without header)
+    Errors of 'rows' are re-raised, the buffer is not a complete file then
 
-    :arg data - list of dicts with column names as keys
+    :arg columns - column names in the order of appearance in the table
+    :arg rows - dicts with column names as keys, missing keys are left empty
 
     """
-    wb = Workbook(buf)
+    wb = Workbook(buf, {'constant_memory': True})
     ws = wb.add_worksheet()
 
-    ordered_list = list(data[0].keys())
+    col_index = {col: i for i, col in enumerate(columns)}
+
+    def write_batch(first_row: int, batch: list[list]):
+        for i, values in enumerate(batch):
+            ws.write_row(first_row + i, 0, values)
 
     # Filling header
-    first_row = 0
-    for header in ordered_list:
-        col = ordered_list.index(header)
-        ws.write(first_row, col, report_cols_rename(header))
+    ws.write_row(0, 0, [report_cols_rename(col) for col in columns])
 
     # Filling data
-    row = 1
-    for el in data:
+    n_rows = 0
+    batch = []
+    async for el in rows:
+        values = [None] * len(columns)
         for _key, _value in el.items():
-            col = ordered_list.index(_key)
-            ws.write(row, col, _value)
-        row += 1
-    wb.close()
+            values[col_index[_key]] = _value
+        batch.append(values)
+        if len(batch) == batch_size:
+            await asyncio.to_thread(write_batch, n_rows + 1, batch)
+            n_rows += len(batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(write_batch, n_rows + 1, batch)
+        n_rows += len(batch)
+    await asyncio.to_thread(wb.close)
     buf.seek(0)
+    return n_rows
 
 
 def report_cols_rename(col: str) -> str:
@@ -11,11 +11,14 @@ import os
 import random
 
 from src.bot import dp, bot, _
-from src.config import PERSISTENT_DATA_DIR, logger, MY_TG_ID
+from src.config import PERSISTENT_DATA_DIR, logger, MY_TG_ID, redis_conn
 from src.misc.utils import notify_me
+from src.misc.broadcaster import Broadcaster
 from db.models import User
+from db.redis.crud import add_to_purge_queue
 from src.misc.filters import IsAdmin
-from src.misc.db_backup import do_backup
+from src.misc.incremental_backup import run_backup
+from src.misc.db_backup import BACKUP_LOCK_KEY
 from src.misc.service_reports import everyday_report
 from db import sql
 
@@ -40,8 +43,10 @@ async def update_token(message: types.Message):
 
 @dp.message_handler(IsAdmin(), commands=['backup'], state='*')
 async def manual_backup(message: types.Message):
+    if await redis_conn.exists(BACKUP_LOCK_KEY):
+        return await message.reply('Another backup is running, try later')
     message = await message.reply('Starting backup...')
-    if await do_backup():
+    if await run_backup():
         await message.edit_text('Backup finished successfully')
     else:
         await message.edit_text('Backup failed, check logs')
@@ -241,27 +246,34 @@ async def send_announcement_confirmation(query: types.CallbackQuery):
     elif group == 'superactive':
         users = await sql.get_users(super_active=True)
     await query.message.edit_text(f'Sending to {group} ({len(users)} users)...')
+
     # sending
-    n_sent = 0
-    for i, user in enumerate(users):
+    async def send(user: User):
         lang = user.language
         if lang not in prep_ann:
             if lang in ['fr', 'es']:
                 lang = 'en'
             else:
                 lang = 'ru'
-        try:
-            await bot.send_message(user.telegram_id, prep_ann[lang])
-            n_sent += 1
-        except (BotBlocked, UserDeactivated):
-            await sql.delete_user(user.telegram_id)
-        except NetworkError:
-            await logger.error(err := f'User {user.telegram_id} Network Error')
-            await notify_me(err)
-        await asyncio.sleep(0.1)
-        if i % 100 == 0:
-            await query.message.edit_text(f'Sending to {group} {i}/{len(users)} users...')
-    await query.message.edit_text(f'Sent to {n_sent} users successfully')
+        await bot.send_message(user.telegram_id, prep_ann[lang])
+
+    n_sent = 0
+
+    async def on_flush(sent_ids: list[int]):
+        nonlocal n_sent
+        n_sent += len(sent_ids)
+        await query.message.edit_text(f'Sending to {group} {n_sent}/{len(users)} users...')
+
+    broadcaster = Broadcaster(name='Announcement',
+                              send=send,
+                              chat_id=lambda user: user.telegram_id,
+                              on_flush=on_flush,
+                              on_gone=add_to_purge_queue)   # user blocked the bot - delete user in background
+    stats = await broadcaster.run(users)
+    logger.info(stats.summary())
+    if stats.n_failed:
+        await notify_me(stats.summary())
+    await query.message.edit_text(f'Sent to {stats.n_sent} users successfully')
 
 
 ### delete announcement (show translations)
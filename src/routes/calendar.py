@@ -23,11 +23,12 @@ async def calendar_entry(message: types.Message, state: FSMContext = None):
     if state and await state.get_state():
         await state.finish()
     user_id = message.from_user.id
-    user = await sql.get_user(telegram_id=user_id)
+    user = await sql.get_user_profile(telegram_id=user_id)
     date_today = datetime.datetime.now(tz=pytz.timezone(user.timezone)).date()
     month, year = date_today.month, date_today.year
-    user_pain_days: list[int] = await sql.user_pain_days(user_id, month, year)
-    user_druguse_days: list[int] = await sql.user_druguse_days(user_id, month, year)
+    month_days = await sql.get_user_month_days(user_id, month, year)
+    user_pain_days: list[int] = month_days.pain
+    user_druguse_days: list[int] = month_days.druguse
     text = _('Здесь можно посмотреть свои записи за определённый день и удалить их, при необходимости\n\n')
     text += _('╳ - головная боль\n'
               '⁘ - приём лекарства\n')
@@ -48,21 +49,16 @@ async def show_list_on_date(callback_query: types.CallbackQuery, state: FSMConte
     """
     Display list of entries on the date, allow to delete them with 10 things keyboard
     """
-    def callback_data_func(el: PainCase | DrugUse | Pressure) -> str:
-        if isinstance(el, PainCase):
-            return f'delete_paincase_{el.id}'
-        if isinstance(el, DrugUse):
-            return f'delete_druguse_{el.id}'
-        if isinstance(el, Pressure):
-            return f'delete_pressure_{el.id}'
+    def callback_data_func(entry: sql.DayEntry) -> str:
+        return f'delete_{entry.kind}_{entry.id}'
 
-    def paincase_repr(paincase: PainCase) -> str:
+    def paincase_repr(paincase: sql.DayEntry) -> str:
         medicine_text = ''
-        if paincase.medecine_taken:
-            if len(paincase.medecine_taken) > 1:
-                medicine_text += _('Приняты лекарства: {n_meds} шт.').format(n_meds=len(paincase.medecine_taken))
+        if paincase.n_meds:
+            if paincase.n_meds > 1:
+                medicine_text += _('Приняты лекарства: {n_meds} шт.').format(n_meds=paincase.n_meds)
             else:
-                medicine_text = f'+ {paincase.medecine_taken[0].drugname}'
+                medicine_text = f'+ {paincase.drugname}'
         else:
             medicine_text = _('Без лекарств')
         return _('<b>Головная боль:</b> {durability} ч. | {intensity} из 10 | {medicine_text}').format(
@@ -70,12 +66,12 @@ async def show_list_on_date(callback_query: types.CallbackQuery, state: FSMConte
             intensity=paincase.intensity,
             medicine_text=medicine_text)
 
-    def druguse_repr(druguse: DrugUse) -> str:
+    def druguse_repr(druguse: sql.DayEntry) -> str:
         return _('<b>Приём лекарства:</b> {amount} {drugname}').format(
             drugname=druguse.drugname,
             amount=druguse.amount)
 
-    def pressure_repr(pressure: Pressure) -> str:
+    def pressure_repr(pressure: sql.DayEntry) -> str:
         return _('<b>Давление:</b> {systolic}/{diastolic} {pulse}').format(
             systolic=pressure.systolic,
             diastolic=pressure.diastolic,
@@ -89,12 +85,8 @@ async def show_list_on_date(callback_query: types.CallbackQuery, state: FSMConte
         page = 0
     date = datetime.datetime.strptime(date_str, '%d.%m.%Y').date()
     user_id = callback_query.from_user.id
-    paincases = await sql.get_user_pains(user_id, date=date)
-    druguses = await sql.get_user_druguses(user_id, date=date)
-    pressures = await sql.get_user_pressures(user_id, date=date)
-    # leave only non-assiciated druguses
-    druguses = [druguse for druguse in druguses if druguse.paincase_id is None]
-    items = paincases + druguses + pressures
+    # Only the page is fetched: paincases, non-associated druguses and pressures with one query
+    items, n_total = await sql.get_user_day_entries(user_id, date=date, page=page)
     text = ''
     if len(items) == 0:
         text += _('Нет записей на <b>{date_str}</b>').format(date_str=date_str)
@@ -102,11 +94,11 @@ async def show_list_on_date(callback_query: types.CallbackQuery, state: FSMConte
         text = _('Удаление записей за <b>{date_str}</b>').format(date_str=date_str)
         for i, item in enumerate(items):
             text += f'\n{i + 1}. '
-            if isinstance(item, PainCase):
+            if item.kind == 'paincase':
                 text += paincase_repr(item)
-            elif isinstance(item, DrugUse):
+            elif item.kind == 'druguse':
                 text += druguse_repr(item)
-            elif isinstance(item, Pressure):
+            elif item.kind == 'pressure':
                 text += pressure_repr(item)
     await callback_query.message.edit_text(
         text,
@@ -115,7 +107,8 @@ async def show_list_on_date(callback_query: types.CallbackQuery, state: FSMConte
             back_callback=f'calendar_{date.month}_{date.year}_calendar',
             navigation_callback=f'calendar_{date_str}',
             callback_data_func=callback_data_func,
-            page=page)
+            page=page,
+            n_total=n_total)
     )
 
 
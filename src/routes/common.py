@@ -4,10 +4,9 @@ from aiogram.utils.exceptions import MessageCantBeDeleted
 
 from db import sql
 from db.redis.crud import remove_user_state
-from src.bot import dp, bot, _
+from src.bot import dp, bot, _, i18n
 from src.misc.keyboards import calendar_kb
 from src.misc.utils import month_name, notify_me
-from src.middlewares import get_user_language
 from src.misc.filters import MaintenanceMode
 from src.config import logger
 
@@ -80,8 +79,9 @@ async def display_calendar(callback_query: types.CallbackQuery):
     callback_prefix, month, year, __ = callback_query.data.split('_')
     month, year = int(month), int(year)
     user_id = callback_query.from_user.id
-    user_pain_days: list[int] = await sql.user_pain_days(user_id, month, year)
-    user_druguse_days: list[int] = await sql.user_druguse_days(user_id, month, year)
+    month_days = await sql.get_user_month_days(user_id, month, year)
+    user_pain_days: list[int] = month_days.pain
+    user_druguse_days: list[int] = month_days.druguse
     keyboard = await calendar_kb(callback_prefix=callback_prefix,
                                  user_id=user_id,
                                  month=month,
@@ -89,11 +89,10 @@ async def display_calendar(callback_query: types.CallbackQuery):
                                  days_with_pain=user_pain_days,
                                  days_with_druguse=user_druguse_days)
     if callback_prefix == 'calendar':
-        curr_user: types.User = callback_query.from_user
         text = _('Здесь можно посмотреть свои записи за определённый день и удалить их, при необходимости\n\n')
         text += _('╳ - головная боль\n'
                   '⁘ - приём лекарства\n')
-        text += f'<b>{month_name(month, locale_name= await get_user_language(curr_user))}</b> {year}\n'
+        text += f'<b>{month_name(month, locale_name=i18n.ctx_locale.get())}</b> {year}\n'
         text += _('Количество дней с головной болью:') + f'<b> {len(user_pain_days)}</b>\n'
         text += _('Количество дней приёма лекарств:') + f'<b> {len(user_druguse_days)}</b>\n'
         await callback_query.message.edit_text(text)
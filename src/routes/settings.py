@@ -8,7 +8,7 @@ import datetime
 import orjson
 
 from db import sql
-from db.models import User
+from db.redis.models import UserProfile
 from src.bot import dp, _, i18n
 from src.config import logger
 from src.misc.utils import change_user_language, local_to_utc, change_timezone_get_utc, \
@@ -82,7 +82,7 @@ async def change_settings(message_or_query: types.Message | types.CallbackQuery,
     await i18n.trigger(action='pre_process_callback_query',
                        args=(message_or_query, None))  # kostyl, otherwise does not change language immediately
 
-    user: User = await sql.get_user(telegram_id=message_or_query.from_user.id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=message_or_query.from_user.id)
 
     language: str = user.language
     tz_str = user.timezone
@@ -204,7 +204,7 @@ async def change_timezone_geolocation(callback_query: types.CallbackQuery):
 @dp.message_handler(content_types=['location'])
 async def change_timezone_geolocation_callback(message: types.Message):
     user_id = message.from_user.id
-    user: User = await sql.get_user(telegram_id=user_id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
     tz_list: list[str] = get_tzs(message.location.longitude, message.location.latitude)
     await sql.change_user_props(telegram_id=user_id,
                                 latitude=message.location.latitude, longitude=message.location.longitude)
@@ -247,7 +247,7 @@ async def change_timezone_geolocation_callback(message: types.Message):
 async def change_timezone_manual_callback(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     new_tz = callback_query.data.split('_', maxsplit=4)[-1]
-    user: User = await sql.get_user(telegram_id=user_id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
     old_tz = user.timezone
     old_utc_time = user.utc_notify_at
     new_utc_time = change_timezone_get_utc(old_utc_time, old_tz, new_tz)
@@ -363,7 +363,7 @@ async def change_notif_time(callback_query: types.CallbackQuery):
     keyboard.row(InlineKeyboardButton(_('после полудня'), callback_data='change_notif_time_pm'))
 
     user_id = callback_query.from_user.id
-    user: User = await sql.get_user(telegram_id=user_id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
     utc_notify_at: datetime.time = user.utc_notify_at
     tz = pytz.timezone(user.timezone)
     local_notify_at: str = datetime.datetime.combine(datetime.date.today(), utc_notify_at)\
@@ -407,7 +407,7 @@ async def change_notif_hour_callback(callback_query: types.CallbackQuery):
     """
     hour = int(callback_query.data.split('_')[-1])
     user_id = callback_query.from_user.id
-    user: User = await sql.get_user(telegram_id=user_id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
     local_notify_at: datetime.time = datetime.time(hour, 0)
     utc_notify_at = local_to_utc(local_notify_at, user.timezone)
     await sql.change_user_props(telegram_id=user_id, utc_notify_at=utc_notify_at)
@@ -428,7 +428,7 @@ async def reschedule(callback_query: types.CallbackQuery):
     Change notify_every attr in User instance
     """
     user_id = callback_query.from_user.id
-    user: User = await sql.get_user(telegram_id=user_id)
+    user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
     notification_period = user.notify_every
     period_text = str(notification_period)
     temp = {
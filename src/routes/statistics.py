@@ -1,5 +1,7 @@
 import asyncio
 import io
+import tempfile
+from typing import AsyncIterator
 from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.dispatcher import FSMContext
@@ -7,11 +9,12 @@ from aiogram.utils.exceptions import MessageCantBeDeleted
 import traceback
 
 from db import sql
-from db.models import User, PainCase, DrugUse, Pressure
+from db.models import PainCase, DrugUse, Pressure
+from db.redis.models import UserProfile
 from db import sql
 from src.bot import bot, dp, _
 from src.config import logger
-from src.misc.utils import notify_me, write_xlsx, utc_to_local
+from src.misc.utils import notify_me, write_xlsx, utc_to_local, PAIN_COLUMNS, MEDICATION_COLUMNS, PRESSURE_COLUMNS
 
 
 ## Statistics   (DONT FORGET TO LOCALIZE EVENT TIME TO USER'S TIMEZONE)
@@ -48,6 +51,53 @@ def kb_period(callback_prefix: str):
     return keyboard
 
 
+async def pain_rows(user_id: int, n_days: int) -> AsyncIterator[dict]:
+    """
+    Rows of the pains statistics table
+    Paincase with several druguses takes several rows, the following ones contain only the druguse info
+    """
+    async for event in sql.stream_user_pains(user_id=user_id, period_days=n_days):
+        temp_dict = {
+            'Дата': event.date.strftime('%d.%m.%Y'),
+            'Часов': event.durability,
+            'Сила': event.intensity,
+            'Аура': event.aura,
+            'Триггеры': event.provocateurs,
+            'Симптомы': event.symptoms,
+            'Примечания': event.description
+        }
+        if len(event.medecine_taken) == 0:
+            yield temp_dict
+            continue
+        sub_event: DrugUse
+        for sub_event in event.medecine_taken:
+            temp_dict['Лекарство'] = sub_event.drugname
+            temp_dict['Кол-во'] = sub_event.amount
+            yield temp_dict
+            temp_dict = {}
+
+
+async def medication_rows(user_id: int, n_days: int) -> AsyncIterator[dict]:
+    async for event in sql.stream_user_druguses(user_id=user_id, period_days=n_days):
+        yield {
+            'Дата': event.date.strftime('%d.%m.%Y'),
+            'Лекарство': event.drugname,
+            'Кол-во': event.amount
+        }
+
+
+async def pressure_rows(user_id: int, n_days: int, timezone: str) -> AsyncIterator[dict]:
+    async for event in sql.stream_user_pressures(user_id=user_id, period_days=n_days):
+        event_datetime = utc_to_local(event.datetime, timezone)
+        yield {
+            'Дата': event_datetime.strftime('%d.%m.%Y'),
+            'Время': event_datetime.strftime('%H:%M'),
+            'Систолическое': event.systolic,
+            'Диастолическое': event.diastolic,
+            'Пульс': event.pulse
+        }
+
+
 @dp.callback_query_handler(lambda c: c.data and c.data == 'statistics', state='*')
 @dp.message_handler(commands=['statistics'], state='*')
 async def medications_entry(message_or_query: types.Message | types.CallbackQuery, state: FSMContext = None):
@@ -86,66 +136,21 @@ async def get_pain_statistics_callback(callback_query: types.CallbackQuery):
         return
     try:
         n_days = int(callback_query.data.split('_')[-1])
-        user_paincases: list[PainCase] = await sql.get_user_pains(user_id=user_id, period_days=n_days)
-        pains_statistics = []
-        # Filling data
-        for event in user_paincases:
-            temp_dict = {
-                'Дата': event.date.strftime('%d.%m.%Y'),
-                'Часов': event.durability,
-                'Сила': event.intensity,
-                'Аура': event.aura,
-                'Триггеры': event.provocateurs,
-                'Симптомы': event.symptoms
-            }
-            if len(event.medecine_taken) == 0:
-                temp_dict['Лекарство'] = None
-                temp_dict['Кол-во'] = None
-                temp_dict['Примечания'] = event.description
-                pains_statistics.append(temp_dict)
+        # Send table as xlsx
+        with tempfile.TemporaryFile() as buf:
+            n_rows = await write_xlsx(buf, PAIN_COLUMNS, pain_rows(user_id, n_days))
+            # Period text definition
+            period_text = days_to_period(n_days)
+            if n_rows == 0:
+                await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
+                                                            .format(period_text=period_text),
+                                            reply_markup=InlineKeyboardMarkup(
+                                                InlineKeyboardButton(_('<< Назад'), callback_data='pains_stats')
+                                            ))
             else:
-                sub_event: DrugUse
-                for i, sub_event in enumerate(event.medecine_taken):
-                    # if only one druguse - fill the fields in the same row
-                    if i == 0:
-                        temp_dict['Лекарство'] = sub_event.drugname
-                        temp_dict['Кол-во'] = sub_event.amount
-                        temp_dict['Примечания'] = event.description
-                        pains_statistics.append(temp_dict)
-                    # if >1: second row would be empty, except for the druguse info
-                    else:
-                        temp_dict = {k: None for k in ['Дата', 'Часов', 'Сила', 'Аура', 'Триггеры', 'Симптомы']}
-                        temp_dict['Лекарство'] = sub_event.drugname
-                        temp_dict['Кол-во'] = sub_event.amount
-                        temp_dict['Примечания'] = None
-                        pains_statistics.append(temp_dict)
-
-        # Period text definition
-        period_text = days_to_period(n_days)
-        if len(pains_statistics) == 0:
-            await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
-                                                        .format(period_text=period_text),
-                                        reply_markup=InlineKeyboardMarkup(
-                                            InlineKeyboardButton(_('<< Назад'), callback_data='pains_stats')
-                                        ))
-        elif len(pains_statistics) > 0:
-            # # Send image of a table
-            # try:
-            #     fig, ax = render_mpl_table(pains_statistics[["Дата", "Часов", "Сила", "Аура", "Лекарство", "Кол-во"]])
-            #     with io.BytesIO() as buf:
-            #         fig.savefig(buf, format='png')
-            #         buf.seek(0)
-            #         await bot.send_document(user_id, types.InputFile(buf, 'pains_statistics.png'))
-            # except IndexError:
-            #     await notify_me(f'User {user_id}. IndexError while get_pain_statistics_callback'
-            #                     f'\nTable size is {len(pains_statistics)}')
-
-            # Send table as xlsx
-            with io.BytesIO() as buf:
-                write_xlsx(buf, pains_statistics)
                 await pre_message.edit_text(_('Готово! Высылаю файл с данными...'))
                 await bot.send_document(user_id, types.InputFile(buf, 'pains_statistics.xlsx'))
-                logger.info(f'User {user_id}. Sent PAIN statistics for {n_days} days')
+                logger.info(f'User {user_id}. Sent PAIN statistics for {n_days} days ({n_rows} rows)')
                 try:
                     await bot.delete_message(user_id, pre_message.message_id)
                 except MessageCantBeDeleted:
@@ -177,31 +182,21 @@ async def get_medication_statistics_callback(callback_query: types.CallbackQuery
         return
     try:
         n_days = int(callback_query.data.split('_')[-1])
-        user_druguses: list[DrugUse] = await sql.get_user_druguses(user_id=user_id, period_days=n_days)
-        medications_statistics = []
-        # Filling data
-        for event in user_druguses:
-            temp_dict = {
-                'Дата': event.date.strftime('%d.%m.%Y'),
-                'Лекарство': event.drugname,
-                'Кол-во': event.amount
-            }
-            medications_statistics.append(temp_dict)
-        # Period text definition
-        period_text = days_to_period(n_days)
-        if len(medications_statistics) == 0:
-            await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
-                                                        .format(period_text=period_text),
-                                        reply_markup=InlineKeyboardMarkup(
-                                            InlineKeyboardButton(_('<< Назад'), callback_data='medications_stats')
-                                        ))
-        elif len(medications_statistics) > 0:
-            # Send table as xlsx
-            with io.BytesIO() as buf:
-                write_xlsx(buf, medications_statistics)
+        # Send table as xlsx
+        with tempfile.TemporaryFile() as buf:
+            n_rows = await write_xlsx(buf, MEDICATION_COLUMNS, medication_rows(user_id, n_days))
+            # Period text definition
+            period_text = days_to_period(n_days)
+            if n_rows == 0:
+                await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
+                                                            .format(period_text=period_text),
+                                            reply_markup=InlineKeyboardMarkup(
+                                                InlineKeyboardButton(_('<< Назад'), callback_data='medications_stats')
+                                            ))
+            else:
                 await pre_message.edit_text(_('Готово! Высылаю файл с данными...'))
                 await bot.send_document(user_id, types.InputFile(buf, 'medications_statistics.xlsx'))
-                logger.info(f'User {user_id}. Sent MEDICATION statistics for {n_days} days')
+                logger.info(f'User {user_id}. Sent MEDICATION statistics for {n_days} days ({n_rows} rows)')
                 try:
                     await bot.delete_message(user_id, pre_message.message_id)
                 except MessageCantBeDeleted:
@@ -236,34 +231,22 @@ async def get_pressure_statistics_callback(callback_query: types.CallbackQuery):
         return
     try:
         n_days = int(callback_query.data.split('_')[-1])
-        user: User = await sql.get_user(telegram_id=user_id)
-        user_pressures: list[Pressure] = await sql.get_user_pressures(user_id=user_id, period_days=n_days)
-        # Period text definition
-        period_text = days_to_period(n_days)
-        if len(user_pressures) == 0:
-            await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
-                                                        .format(period_text=period_text),
-                                        reply_markup=InlineKeyboardMarkup(
-                                            InlineKeyboardButton(_('<< Назад'), callback_data='pressure_stats')
-                                        ))
-        elif len(user_pressures) > 0:
-            pressure_stats = []
-            for event in user_pressures:
-                event_datetime = utc_to_local(event.datetime, user.timezone)
-                temp_dict = {
-                    'Дата': event_datetime.strftime('%d.%m.%Y'),
-                    'Время': event_datetime.strftime('%H:%M'),
-                    'Систолическое': event.systolic,
-                    'Диастолическое': event.diastolic,
-                    'Пульс': event.pulse
-                }
-                pressure_stats.append(temp_dict)
-            # Send table as xlsx
-            with io.BytesIO() as buf:
-                write_xlsx(buf, pressure_stats)
+        user: UserProfile = await sql.get_user_profile(telegram_id=user_id)
+        # Send table as xlsx
+        with tempfile.TemporaryFile() as buf:
+            n_rows = await write_xlsx(buf, PRESSURE_COLUMNS, pressure_rows(user_id, n_days, user.timezone))
+            # Period text definition
+            period_text = days_to_period(n_days)
+            if n_rows == 0:
+                await pre_message.edit_text(_("В течение запрошенного периода <b>({period_text})</b> записей нет")
+                                                            .format(period_text=period_text),
+                                            reply_markup=InlineKeyboardMarkup(
+                                                InlineKeyboardButton(_('<< Назад'), callback_data='pressure_stats')
+                                            ))
+            else:
                 await pre_message.edit_text(_('Готово! Высылаю файл с данными...'))
                 await bot.send_document(user_id, types.InputFile(buf, 'pressure_statistics.xlsx'))
-                logger.info(f'User {user_id}. Sent PRESSURE statistics for {n_days} days')
+                logger.info(f'User {user_id}. Sent PRESSURE statistics for {n_days} days ({n_rows} rows)')
                 try:
                     await bot.delete_message(user_id, pre_message.message_id)
                 except MessageCantBeDeleted:
@@ -3,6 +3,7 @@ from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils import exceptions
+from sqlalchemy import Row
 
 from db import sql
 from db.models import User
@@ -22,7 +23,7 @@ async def send_welcome(message: types.Message, state: FSMContext = None):
     if message.from_user.is_bot:
         return
     # Get current user, if not exists - add to the DB
-    user = await sql.get_user(telegram_id=user_id)
+    user = await sql.get_user_profile(telegram_id=user_id)
     if not user:
         # User info
         first_name = message.from_user.first_name
@@ -53,10 +54,11 @@ async def send_welcome(message: types.Message, state: FSMContext = None):
     await message.reply(text)
 
 
-async def regular_report(user_instance: User, missing_days: int):
+async def regular_report(user_instance: User | Row, missing_days: int):
     """
     Ask each user if there was pain during the days
     If so - start report_paincase_form
+    user_instance needs only telegram_id and language attributes
     """
     hi_s = ["Салам алейкум", "Hi", "Hello", "Ahlan wa sahlan", "Marhaba", "Hola", "Прывiтанне", "Здравейте", "Jo napot",
             "Chao", "Aloha", "Hallo", "Geia sou", "Gamarjoba", "Shalom", "Selamat", "Godan daginn", "¡Buenos días",
@@ -0,0 +1,235 @@
+"""
+Load test of the handlers without Telegram: simulated users go through /pain, /druguse, /pressure, /calendar
+and /statistics concurrently, updates are processed by src.bot.dp in this process and Bot API calls go
+to the stub (tests/load/stub_api.py), started here as well.
+Reports handler latency, throughput and DB / Redis / Bot API round-trips per update
+
+Uses the test database and Redis db (IS_TESTING=1), the tables must exist (see tests/test_load.py). Run:
+    python -m tests.load.dispatcher --users 1000 --flows 3 --concurrency 100
+"""
+import os
+
+os.environ["IS_TESTING"] = '1'
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import random
+import time
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+from pydantic import BaseModel
+from sqlalchemy import event
+
+import src.routes   # registers the handlers
+from src.bot import bot, dp
+from src.config import redis_conn
+from src.misc.broadcaster import percentile
+from db.database import get_engine, pool_stats
+from db.models import Base
+from tests.load.stub_api import make_app, calls
+
+
+FIRST_USER_ID = 10 ** 9
+update_ids = itertools.count(1)
+
+
+def pain_flow(date: str) -> list[tuple[str, str]]:
+    return [('message', '/pain'), ('callback', f'pain_{date}'), ('message', '4'), ('message', '6'),
+            ('message', 'Нет'), ('message', 'Стресс'), ('message', 'Следующий вопрос'),
+            ('message', 'Следующий вопрос'), ('message', 'Да'), ('message', 'Аспирин'), ('message', '500'),
+            ('message', 'Следующий вопрос'), ('message', 'Не имеются')]
+
+
+def druguse_flow(date: str) -> list[tuple[str, str]]:
+    return [('message', '/druguse'), ('callback', f'druguse_{date}'), ('message', 'Аспирин'), ('message', '500')]
+
+
+def pressure_flow(date: str) -> list[tuple[str, str]]:
+    return [('message', '/pressure'), ('callback', '120tens'), ('callback', '125ones'),
+            ('callback', '80tens'), ('callback', '85ones'), ('callback', '70tens'), ('callback', '72ones')]
+
+
+def calendar_flow(date: str) -> list[tuple[str, str]]:
+    return [('message', '/calendar'), ('callback', f'calendar_{date}')]
+
+
+def statistics_flow(date: str) -> list[tuple[str, str]]:
+    return [('message', '/statistics'), ('callback', 'pains_stats'), ('callback', 'pains_stats_31'),
+            ('callback', 'pressure_stats_31')]
+
+
+FLOWS = {
+    'pain': pain_flow,
+    'druguse': druguse_flow,
+    'pressure': pressure_flow,
+    'calendar': calendar_flow,
+    'statistics': statistics_flow,
+}
+
+
+def fake_from(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'Load{user_id}', 'language_code': 'ru'}
+
+
+def message_update(user_id: int, text: str) -> types.Update:
+    update_id = next(update_ids)
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': fake_from(user_id),
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return types.Update(update_id=update_id, message=message)
+
+
+def callback_update(user_id: int, data: str) -> types.Update:
+    update_id = next(update_ids)
+    return types.Update(update_id=update_id, callback_query={
+        'id': str(update_id),
+        'from': fake_from(user_id),
+        'chat_instance': str(user_id),
+        'data': data,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Stub'},
+            'text': '.'
+        }
+    })
+
+
+class LoadTestStats(BaseModel):
+    """
+    Result of a load test
+    """
+    n_users: int = 0
+    n_updates: int = 0
+    n_errors: int = 0
+    flows: dict[str, int] = {}       # times each flow was gone through
+    duration: float = 0
+    latencies: list[float] = []      # of dp.process_update, sec
+    db_statements: int = 0
+    db_checkouts: int = 0
+    redis_commands: int = 0
+    api_calls: int = 0
+
+    @property
+    def throughput(self) -> float:
+        return self.n_updates / self.duration if self.duration else 0
+
+    def per_update(self, value: int) -> float:
+        return value / self.n_updates if self.n_updates else 0
+
+    def summary(self) -> str:
+        return f'{self.n_updates} updates from {self.n_users} users, {self.n_errors} errors ' \
+               f'in {self.duration:.1f} sec ({self.throughput:.1f} updates/sec)\n' \
+               f'flows: {self.flows}\n' \
+               f'latency p50 {percentile(self.latencies, 0.5) * 1000:.0f} ms, ' \
+               f'p95 {percentile(self.latencies, 0.95) * 1000:.0f} ms, ' \
+               f'p99 {percentile(self.latencies, 0.99) * 1000:.0f} ms, ' \
+               f'max {max(self.latencies, default=0) * 1000:.0f} ms\n' \
+               f'per update: {self.per_update(self.db_statements):.1f} DB statements, ' \
+               f'{self.per_update(self.db_checkouts):.1f} DB checkouts, ' \
+               f'{self.per_update(self.redis_commands):.1f} Redis commands, ' \
+               f'{self.per_update(self.api_calls):.1f} Bot API calls'
+
+
+async def redis_commands_processed() -> int:
+    # Counted by the server, FSM storage and all the other clients included
+    return int((await redis_conn.info('stats'))['total_commands_processed'])
+
+
+async def run_user(user_id: int, flows: list[str], stats: LoadTestStats) -> None:
+    date = datetime.date.today().strftime('%d.%m.%Y')
+    steps = [('message', '/start')]
+    for flow in flows:
+        steps += FLOWS[flow](date)
+        stats.flows[flow] = stats.flows.get(flow, 0) + 1
+    for kind, payload in steps:
+        update = message_update(user_id, payload) if kind == 'message' else callback_update(user_id, payload)
+        t0 = time.perf_counter()
+        try:
+            await dp.process_update(update)
+        except Exception:
+            stats.n_errors += 1
+        stats.latencies.append(time.perf_counter() - t0)
+        stats.n_updates += 1
+
+
+async def run_load_test(n_users: int,
+                        n_flows: int = 3,
+                        concurrency: int = 100,
+                        api_delay: float = 0.,
+                        seed: int = 0) -> LoadTestStats:
+    """
+    Each of n_users sends /start and goes through n_flows random flows, `concurrency` users at a time
+    """
+    rng = random.Random(seed)
+    users = {FIRST_USER_ID + i: rng.choices(list(FLOWS), k=n_flows) for i in range(n_users)}
+    stats = LoadTestStats(n_users=n_users)
+
+    runner = web.AppRunner(make_app(api_delay))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    server = bot.server
+    bot.server = TelegramAPIServer.from_base(f'http://{host}:{port}')
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+
+    n_statements = 0
+
+    def count_statement(*args):
+        nonlocal n_statements
+        n_statements += 1
+
+    sync_engine = get_engine().sync_engine
+    event.listen(sync_engine, 'before_cursor_execute', count_statement)
+    checkouts_before = pool_stats()['checkouts']
+    redis_before = await redis_commands_processed()
+    api_before = calls.total()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def user_task(user_id: int, flows: list[str]):
+        async with semaphore:
+            await run_user(user_id, flows, stats)
+
+    t0 = time.perf_counter()
+    try:
+        await asyncio.gather(*[user_task(user_id, flows) for user_id, flows in users.items()])
+    finally:
+        stats.duration = time.perf_counter() - t0
+        stats.redis_commands = await redis_commands_processed() - redis_before - 1
+        stats.db_checkouts = pool_stats()['checkouts'] - checkouts_before
+        stats.db_statements = n_statements
+        stats.api_calls = calls.total() - api_before
+        event.remove(sync_engine, 'before_cursor_execute', count_statement)
+        bot.server = server
+        await runner.cleanup()
+    return stats
+
+
+async def main(n_users: int, n_flows: int, concurrency: int, api_delay: float) -> None:
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    stats = await run_load_test(n_users, n_flows, concurrency, api_delay)
+    print(stats.summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the handlers with the stub Bot API')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--flows', type=int, default=3, help='random flows per user')
+    parser.add_argument('--concurrency', type=int, default=100, help='users at a time')
+    parser.add_argument('--api-delay', type=float, default=0., help='latency of each Bot API call, sec')
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.users, args.flows, args.concurrency, args.api_delay))
@@ -0,0 +1,106 @@
+"""
+Replays updates to the bot running in webhook mode and measures end-to-end handler latency
+(aiogram answers the webhook request when the handlers are done)
+
+Run the stub API (tests/load/stub_api.py), start the bot with
+    BOT_MODE=webhook TELEGRAM_API_SERVER=http://<stub host>:8081
+and then:
+    python -m tests.load.replay --url http://localhost:8080/webhook --updates recorded.jsonl --concurrency 20
+or with generated /start, /calendar and /settings messages from 100 users:
+    python -m tests.load.replay --url http://localhost:8080/webhook --generate 2000 --users 100
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import aiohttp
+import orjson
+
+
+COMMANDS = ['/start', '/calendar', '/settings']
+
+
+def percentile(values: list[float], q: float) -> float:
+    # Same as src.misc.broadcaster.percentile, not imported: the script runs without the bot's config and deps
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def load_updates(path: str) -> list[dict]:
+    """
+    Recorded updates, one Update json per line
+    """
+    with open(path, 'rb') as f:
+        return [orjson.loads(line) for line in f if line.strip()]
+
+
+def generate_updates(n_updates: int, n_users: int, first_user_id: int = 10 ** 9) -> list[dict]:
+    updates = []
+    for update_id in range(1, n_updates + 1):
+        user_id = first_user_id + random.randrange(n_users)
+        text = random.choice(COMMANDS)
+        updates.append({
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'Load{user_id}', 'language_code': 'en'},
+                'text': text,
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+            }
+        })
+    return updates
+
+
+async def replay(url: str, updates: list[dict], concurrency: int) -> None:
+    latencies = []
+    n_errors = 0
+    queue = iter(updates)
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal n_errors
+        for update in queue:
+            t0 = time.perf_counter()
+            try:
+                async with session.post(url, data=orjson.dumps(update),
+                                        headers={'Content-Type': 'application/json'}) as response:
+                    await response.read()
+                    if response.status != 200:
+                        n_errors += 1
+                        continue
+            except aiohttp.ClientError:
+                n_errors += 1
+                continue
+            latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*[worker(session) for _ in range(concurrency)])
+    duration = time.perf_counter() - t0
+
+    print(f'{len(latencies)}/{len(updates)} updates in {duration:.1f} sec '
+          f'({len(latencies) / duration:.1f} updates/sec), {n_errors} errors')
+    print(f'latency p50 {percentile(latencies, 0.5) * 1000:.0f} ms, '
+          f'p95 {percentile(latencies, 0.95) * 1000:.0f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.0f} ms, '
+          f'max {max(latencies, default=0) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay updates to the bot webhook')
+    parser.add_argument('--url', default='http://localhost:8080/webhook')
+    parser.add_argument('--updates', help='jsonl file with recorded updates')
+    parser.add_argument('--generate', type=int, default=1000, help='number of updates to generate')
+    parser.add_argument('--users', type=int, default=100, help='number of users for generated updates')
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.updates:
+        updates = load_updates(args.updates)
+    else:
+        updates = generate_updates(args.generate, args.users)
+    asyncio.run(replay(args.url, updates, args.concurrency))
@@ -0,0 +1,73 @@
+"""
+Stub of Telegram Bot API for load tests: answers every method with a successful fake result
+
+Run:
+    python -m tests.load.stub_api --port 8081 --delay 0.05
+and start the bot with TELEGRAM_API_SERVER=http://<stub host>:8081
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+calls = Counter()
+
+
+def fake_user(user_id: int = 1) -> dict:
+    return {'id': user_id, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+
+
+def fake_message(chat_id: int, text: str = '') -> dict:
+    return {
+        'message_id': calls.total(),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': fake_user(),
+        'text': text
+    }
+
+
+async def handle_method(request: web.Request) -> web.Response:
+    method = request.match_info['method']
+    calls[method] += 1
+    if request.content_type == 'application/json':
+        data = await request.json()
+    else:
+        data = await request.post()
+    delay = request.app['delay']
+    if delay:
+        await asyncio.sleep(delay)
+
+    if method == 'getMe':
+        result = fake_user()
+    elif method.startswith('send') or method in ('editMessageText', 'editMessageReplyMarkup', 'forwardMessage'):
+        result = fake_message(int(data.get('chat_id', 0) or 0), str(data.get('text', '')))
+    elif method == 'getUpdates':
+        result = []
+    else:
+        result = True
+    return web.json_response({'ok': True, 'result': result})
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    return web.json_response(dict(calls))
+
+
+def make_app(delay: float = 0.) -> web.Application:
+    app = web.Application()
+    app['delay'] = delay
+    app.router.add_route('*', '/bot{token}/{method}', handle_method)
+    app.router.add_get('/stats', handle_stats)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub Telegram Bot API')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--delay', type=float, default=0., help='latency of each API call, sec')
+    args = parser.parse_args()
+    web.run_app(make_app(args.delay), host=args.host, port=args.port)
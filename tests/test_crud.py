@@ -2,17 +2,33 @@ import asyncio
 import pytest
 import datetime
 import os
-from sqlalchemy import select
+from sqlalchemy import select, func
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import create_async_engine
 import time
+import gzip
+import io
+import zstandard
+import openpyxl
 
 os.environ["IS_TESTING"] = '1'
 
-from db.models import User, Drug, DrugUse, PainCase, SavedUser, SavedDrugUse, SavedPainCase
+from db.models import User, Drug, DrugUse, PainCase, SavedUser, SavedDrugUse, SavedPainCase, SavedPressure
 from db.models import Base
-from db.database import test_engine, database_exists, create_database
+from db.database import test_engine, database_exists, create_database, pool_stats, TimedQueuePool
+from db.slow_query_log import SlowQueryLog, params_shape
 from db import sql
-from db.redis.crud import get_current_report
-from src.config import logger, redis_conn
+from db.redis.crud import get_current_report, add_to_purge_queue, user_cache_stats, cache_month_days, \
+    month_days_version
+from src.misc.purger import purge_queued_users
+from src.misc.db_backup import do_backup, LocalDirStorage, BackupManifest, BACKUP_LOCK_KEY, BACKUP_TIME_FORMAT, \
+    delete_old_backups
+from src.misc.leader import lease
+from src.misc.incremental_backup import do_incremental_backup, restore_chain, latest_chain
+from src.misc.pain_import import read_pains_file, TableImportError
+from src.misc.utils import write_xlsx, PAIN_COLUMNS
+from src.routes.statistics import pain_rows
+from src.config import logger, redis_conn, DB_POOL_SIZE, DB_MAX_OVERFLOW
 
 
 @pytest.fixture(scope="session")
@@ -78,6 +94,25 @@ async def test_change_user_props():
     assert user.notify_every == 2
 
 
+async def test_user_profile_cache():
+    await redis_conn.delete('user:123')
+    misses = user_cache_stats['misses']
+    profile = await sql.get_user_profile(telegram_id=123)
+    assert profile.notify_every == 2 and profile.first_name == 'Lorem'
+    assert user_cache_stats['misses'] == misses + 1
+    assert await redis_conn.hget('user:123', 'language') == 'ru'
+
+    hits = user_cache_stats['hits']
+    assert await sql.get_user_profile(telegram_id=123) == profile
+    assert user_cache_stats['hits'] == hits + 1
+
+    # Changes are not served from the stale cache
+    await sql.change_user_props(telegram_id=123, timezone='Europe/Paris', utc_notify_at=datetime.time(10, 0))
+    profile = await sql.get_user_profile(telegram_id=123)
+    assert profile.timezone == 'Europe/Paris' and profile.utc_notify_at == datetime.time(10, 0)
+    assert await sql.get_user_profile(telegram_id=-100500) is None
+
+
 async def test_batch_change_last_notified():
     # Add second user, 2 users overall
     await sql.create_user(
@@ -98,6 +133,19 @@ async def test_batch_change_last_notified():
     assert len(users) == 2
     for user in users:
         assert user.last_notified == notif_time
+        assert user.next_notify_at == sql.next_notification_time(notif_time, user.notify_every, user.utc_notify_at)
+
+
+async def test_users_due_for_notification():
+    user: User = await sql.get_user(telegram_id=123)   # notify_every=2
+    due_at = user.next_notify_at
+    assert due_at.time() == user.utc_notify_at
+    assert due_at - user.last_notified > datetime.timedelta(days=1)
+
+    due_users = await sql.users_due_for_notification(due_at - datetime.timedelta(days=1))
+    assert due_users == []
+    due_users = await sql.users_due_for_notification(due_at + datetime.timedelta(seconds=30))
+    assert [el.telegram_id for el in due_users] == [123]   # 456 has no notification period
 
 
 async def test_add_drug():
@@ -171,8 +219,58 @@ async def test_druguses():
     assert druguses[-1].drugname == 'ColaZero'
 
 
+async def test_db_summary():
+    summary = await sql.get_db_summary()
+    assert summary.n_users == 2
+    assert summary.n_notifiable_users == 1
+    assert summary.n_active_users == 1
+    assert summary.n_superactive_users == 0   # all the pains are in 2020
+    assert summary.n_pains == 3
+    assert summary.n_druguses == 5
+    assert summary.n_pressures == 0
+    assert summary.n_medications == 1
+
+
+async def test_stream_user_data():
+    # Fetched in batches, same rows as the list functions
+    pains = [pain async for pain in sql.stream_user_pains(123, batch_size=2)]
+    assert {pain.id for pain in pains} == {pain.id for pain in await sql.get_user_pains(123)}
+    assert sorted(len(pain.medecine_taken) for pain in pains) == [0, 1, 2]
+    druguses = [druguse async for druguse in sql.stream_user_druguses(123, batch_size=2)]
+    assert {druguse.id for druguse in druguses} == {druguse.id for druguse in await sql.get_user_druguses(123)}
+    assert [pain async for pain in sql.stream_user_pains(123, period_days=31)] == []   # all in 2020
+    for pulse in (60, 70, 80):
+        await sql.report_pressure(120, 80, pulse, owner_id=123)
+    pressures = [pressure async for pressure in sql.stream_user_pressures(123, period_days=31, batch_size=2)]
+    assert sorted(pressure.pulse for pressure in pressures) == [60, 70, 80]
+
+    # Pains export: a row per druguse, the following ones of a pain without the date
+    buf = io.BytesIO()
+    assert await write_xlsx(buf, PAIN_COLUMNS, pain_rows(123, -1)) == 4
+    rows = list(openpyxl.load_workbook(buf, read_only=True).worksheets[0].iter_rows(values_only=True))
+    assert list(rows[0]) == PAIN_COLUMNS
+    table = [dict(zip(PAIN_COLUMNS, row)) for row in rows[1:]]
+    assert [row['Дата'] for row in table].count('01.01.2020') == 3
+    assert sorted(row['Лекарство'] for row in table if row['Лекарство']) == \
+        sorted(['Aspirin', 'Ibuprofen', TestPaincases.druguse_data_several['drugname'][0]])
+    # Same rows when written in several batches
+    buf = io.BytesIO()
+    assert await write_xlsx(buf, PAIN_COLUMNS, pain_rows(123, -1), batch_size=3) == 4
+    assert len(list(openpyxl.load_workbook(buf, read_only=True).worksheets[0].iter_rows())) == 5
+
+    # A stream broken in the middle is an error, not a shorter file
+    async def broken_rows():
+        async for row in pain_rows(123, -1):
+            yield row
+            raise ConnectionError('Lost connection to the database')
+    with pytest.raises(ConnectionError):
+        await write_xlsx(io.BytesIO(), PAIN_COLUMNS, broken_rows(), batch_size=1)
+
+
 async def test_users_info_after_deletion():
-    await sql.delete_user(telegram_id=123)
+    deleted_user = await sql.delete_user(telegram_id=123)
+    assert (deleted_user.n_paincases, deleted_user.n_druguses, deleted_user.n_pressures, deleted_user.n_medications) \
+        == (3, 5, 3, 1)
     users = await sql.get_users()
     user_paincases = await sql.get_user_pains(user_id=123)
     user_drugs = await sql.get_drugs(owner=123)
@@ -194,6 +292,12 @@ async def test_users_info_after_deletion():
     assert len(saved_users) == 1
     assert len(saved_paincases) == 3
     assert len(saved_druguses) == 5
+    # Druguses of the pains are linked to the saved pains, in the same way
+    assert sorted(sum(druguse.paincase_id == pain.id for druguse in saved_druguses) for pain in saved_paincases) \
+        == [0, 1, 2]
+    assert sum(druguse.paincase_id is None for druguse in saved_druguses) == 2
+    async with sql.get_session() as session:
+        assert await session.scalar(select(func.count()).select_from(SavedPressure)) == 3
 
     # Del 2nd user
     await sql.delete_user(telegram_id=456)
@@ -218,6 +322,11 @@ async def test_deleted_user_in_redis():
     assert report.deleted_users[0].telegram_id == 123
     assert report.deleted_users[1].telegram_id == 456
 
+    # Not deleted, not reported
+    assert await sql.delete_user(telegram_id=789) is None
+    report = await get_current_report()
+    assert len(report.deleted_users) == 2
+
 
 async def test_multiple_connections():
     t0 = time.time()
@@ -237,6 +346,28 @@ async def test_multiple_connections():
     logger.info(f'1000 users created in {consumed_time:.2f} sec ({consumed_time / 1000:.4f} sec per user)')
 
 
+async def test_pool_stats():
+    stats = pool_stats()
+    assert (stats['size'], stats['max_overflow'], stats['checked_out']) == (DB_POOL_SIZE, DB_MAX_OVERFLOW, 0)
+    assert stats['checkouts'] >= 1000   # test_multiple_connections
+    assert stats['wait_max'] >= stats['wait_avg'] >= 0
+    await sql.get_users()
+    assert pool_stats()['checkouts'] == stats['checkouts'] + 1
+
+    # Checkouts, which waited longer than pool_timeout, are counted
+    engine = create_async_engine(test_engine.url, poolclass=TimedQueuePool, pool_size=1, max_overflow=0,
+                                 pool_timeout=0.1)
+    try:
+        async with engine.connect():
+            with pytest.raises(PoolTimeoutError):
+                async with engine.connect():
+                    pass
+        assert (engine.pool.n_checkouts, engine.pool.n_timeouts) == (2, 1)
+        assert engine.pool.wait_max >= 0.1
+    finally:
+        await engine.dispose()
+
+
 async def test_delete_item():
     data = dict(
         date=datetime.date(2020, 1, 1),
@@ -252,5 +383,159 @@ async def test_delete_item():
     assert len(druguses) == 0
 
 
+async def test_month_days_cache():
+    month_days = await sql.get_user_month_days(1000, 1, 2020)
+    assert month_days.druguse == []
+    assert await redis_conn.exists('cal:1000:2020-01')
+
+    # Cache is invalidated on adding
+    await sql.report_druguse(date=datetime.date(2020, 1, 5), amount='100', drugname='ColaZero', owner_id=1000)
+    month_days = await sql.get_user_month_days(1000, 1, 2020)
+    assert month_days.druguse == [5]
+    assert month_days.pain == []
+
+    # and on deleting
+    druguses: list[DrugUse] = await sql.get_user_druguses(user_id=1000)
+    await sql.delete_item(druguses[0])
+    month_days = await sql.get_user_month_days(1000, 1, 2020)
+    assert month_days.druguse == []
+
+    # A month read before a change is not cached after the invalidation
+    version = await month_days_version(1000)
+    await sql.report_druguse(date=datetime.date(2020, 1, 6), amount='100', drugname='ColaZero', owner_id=1000)
+    assert not await cache_month_days(1000, 1, 2020, month_days, version)
+    assert (await sql.get_user_month_days(1000, 1, 2020)).druguse == [6]
+
+
+async def test_day_entries():
+    date = datetime.date(2020, 2, 1)
+    await sql.report_paincase(owner_id=1000, date=date, durability=3, intensity=5, aura=False,
+                              drugname=['Aspirin'], amount=['100'])
+    for i in range(11):
+        await sql.report_druguse(date=date, amount=str(i), drugname='ColaZero', owner_id=1000)
+
+    entries, n_total = await sql.get_user_day_entries(1000, date)
+    assert n_total == 12   # druguse of the paincase is not listed
+    assert len(entries) == 10
+    assert entries[0].kind == 'paincase' and entries[0].n_meds == 1 and entries[0].drugname == 'Aspirin'
+    assert all(entry.kind == 'druguse' for entry in entries[1:])
+
+    entries, n_total = await sql.get_user_day_entries(1000, date, page=1)
+    assert n_total == 12
+    assert [entry.amount for entry in entries] == ['9', '10']
+
+
+async def test_purge_queue():
+    await asyncio.gather(*[add_to_purge_queue(i) for i in [1001, 1002, 1002, 1003]])
+    n_deleted = await purge_queued_users()
+    assert n_deleted == 3
+    assert await sql.get_user(telegram_id=1002) is None
+    report = await get_current_report()
+    assert {user.telegram_id for user in report.deleted_users} >= {1001, 1002, 1003}
+    assert await purge_queued_users() == 0
+
+
+async def test_backup_to_local_dir(tmp_path):
+    assert await do_backup(storage=LocalDirStorage(tmp_path), manifest_path=tmp_path / 'local_manifest.json')
+    backups = list(tmp_path.glob('*.dump.*'))
+    assert len(backups) == 1
+    assert BackupManifest.load(tmp_path / 'local_manifest.json').entries[0].files == [backups[0].name]
+    compressed = backups[0].read_bytes()
+    if backups[0].name.endswith('.zst'):
+        dump = zstandard.ZstdDecompressor().decompressobj().decompress(compressed)
+    else:
+        dump = gzip.decompress(compressed)
+    assert dump.startswith(b'PGDMP')   # pg_dump custom format
+
+    # Only one backup at a time
+    async with lease(BACKUP_LOCK_KEY):
+        assert not await do_backup(storage=LocalDirStorage(tmp_path), manifest_path=tmp_path / 'local_manifest.json')
+        assert not await do_incremental_backup(LocalDirStorage(tmp_path), tmp_path / 'local_manifest.json')
+    assert len(list(tmp_path.glob('*.dump.*'))) == 1
+    assert not await redis_conn.exists(BACKUP_LOCK_KEY)
+
+
+async def test_delete_old_backups_not_in_manifest(tmp_path):
+    # Backups made before the manifest are deleted by the date in the name
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    old_name = f'{(now - datetime.timedelta(days=200)).strftime(BACKUP_TIME_FORMAT)}.gz'
+    recent_name = f'{(now - datetime.timedelta(days=10)).strftime(BACKUP_TIME_FORMAT)}.gz'
+    for name in (old_name, recent_name, 'notes.txt'):
+        (tmp_path / name).write_bytes(b'backup')
+    await delete_old_backups(LocalDirStorage(tmp_path), BackupManifest(), retention_days=180)
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([recent_name, 'notes.txt'])
+
+
+async def test_incremental_backup(tmp_path):
+    storage = LocalDirStorage(tmp_path / 'storage')
+    manifest_path = tmp_path / 'manifest.json'
+    await sql.create_user(telegram_id=2000, first_name='Backup')
+    assert await do_incremental_backup(storage, manifest_path)
+
+    pressures = [await sql.report_pressure(120, 80, 60, owner_id=2000) for _ in range(2)]
+    assert await do_incremental_backup(storage, manifest_path)
+    await sql.delete_item(pressures[0])
+    pressures.append(await sql.report_pressure(130, 90, 70, owner_id=2000))
+    assert await do_incremental_backup(storage, manifest_path)
+    expected_ids = {pressure.id for pressure in await sql.get_user_pressures(2000)}
+    assert expected_ids == {pressures[1].id, pressures[2].id}
+
+    chain = latest_chain(BackupManifest.load(manifest_path))
+    assert [entry.kind for entry in chain] == ['base', 'delta', 'delta']
+    # Not in the backups, disappears after restore
+    await sql.report_pressure(140, 100, 80, owner_id=2000)
+    await restore_chain(chain, storage, test_engine)
+    assert {pressure.id for pressure in await sql.get_user_pressures(2000)} == expected_ids
+    assert (await sql.get_user(telegram_id=2000)).first_name == 'Backup'
+
+
+async def test_slow_query_log():
+    assert params_shape((1, 'a', None)) == '(int, str, NoneType)'
+    assert params_shape([{'id': 1}, {'id': 2}], executemany=True) == '2 x {id: int}'
+
+    await redis_conn.delete('slow_queries')
+    slow_query_log = SlowQueryLog(test_engine, threshold_ms=0, explain_rate=1)
+    slow_query_log.install()
+    try:
+        await sql.get_users()
+        await slow_query_log.explain_task
+    finally:
+        slow_query_log.remove()
+    await asyncio.sleep(1)   # records are pushed in the background
+    entries = await redis_conn.lrange('slow_queries', 0, -1)
+    assert slow_query_log.n_explained == 1
+    assert any('db/sql/users.py:get_users' in entry and 'FROM users' in entry and 'actual time' in entry
+               for entry in entries)
+
+
+async def test_import_paincases():
+    await sql.create_user(telegram_id=777, first_name='Import')
+    report_before = await get_current_report()
+    table = 'Дата;Часов;Сила;Аура;Лекарство;Кол-во\n' \
+            '01.02.2024;4;6;Да;Аспирин;500\n' \
+            ';;;;Ибупрофен;400\n' \
+            '2024-02-03;2;3;Нет;;\n'
+    pains = read_pains_file(io.BytesIO(table.encode()), 'diary.csv')
+    assert [len(pain.druguses) for pain in pains] == [2, 0]
+
+    stats = await sql.import_paincases(owner_id=777, pains=pains)
+    assert (stats.n_pains, stats.n_druguses, stats.n_skipped) == (2, 2, 0)
+    imported = await sql.get_user_pains(777)
+    assert {pain.date for pain in imported} == {datetime.date(2024, 2, 1), datetime.date(2024, 2, 3)}
+    assert sorted(druguse.drugname for pain in imported for druguse in pain.medecine_taken) == ['Аспирин', 'Ибупрофен']
+    report = await get_current_report()
+    assert report.n_pains - report_before.n_pains == 2
+    assert report.n_druguses - report_before.n_druguses == 2
+
+    # The same file again
+    stats = await sql.import_paincases(owner_id=777, pains=pains)
+    assert (stats.n_pains, stats.n_skipped) == (0, 2)
+
+    # Two pains on the same day are not imported
+    table += '03.02.2024;5;7;Нет;;\n'
+    with pytest.raises(TableImportError, match='Строка 5'):
+        read_pains_file(io.BytesIO(table.encode()), 'diary.csv')
+
+
 async def test_active_super_active():
     pass
\ No newline at end of file
@@ -0,0 +1,60 @@
+import os
+
+os.environ["IS_TESTING"] = '1'
+
+import pytest
+import asyncio
+from sqlalchemy import select, func
+
+from db.models import Base, PainCase, Pressure
+from db.database import test_engine, database_exists, create_database
+from db import sql
+from src.config import logger, redis_conn
+from tests.load.dispatcher import run_load_test
+
+
+# Thousands of users take a while, so the load test runs only on demand:
+#   LOAD_TEST_USERS=2000 LOAD_TEST_P95_MS=300 pytest tests/test_load.py
+LOAD_TEST_USERS = int(os.getenv('LOAD_TEST_USERS', default='0'))
+LOAD_TEST_P95_MS = float(os.getenv('LOAD_TEST_P95_MS', default='500'))
+
+pytestmark = pytest.mark.skipif(not LOAD_TEST_USERS, reason='LOAD_TEST_USERS is not set')
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module", autouse=True)
+async def resource():
+    assert redis_conn.connection_pool.connection_kwargs['db'] == 5
+    await redis_conn.flushdb()
+    if not await database_exists(test_engine.url):
+        await create_database(test_engine.url)
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    yield
+
+    async with test_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await redis_conn.flushdb()
+    os.environ["IS_TESTING"] = '0'
+
+
+async def test_handlers_under_load():
+    stats = await run_load_test(LOAD_TEST_USERS, n_flows=3, concurrency=100)
+    logger.info(stats.summary())
+    assert stats.n_errors == 0
+    assert stats.n_updates == len(stats.latencies)
+    # Every completed form is saved
+    async with sql.get_session() as session:
+        n_pains = (await session.execute(select(func.count()).select_from(PainCase))).scalar()
+        n_pressures = (await session.execute(select(func.count()).select_from(Pressure))).scalar()
+    assert n_pains == stats.flows.get('pain', 0)
+    assert n_pressures == stats.flows.get('pressure', 0)
+    assert sorted(stats.latencies)[int(0.95 * len(stats.latencies))] * 1000 < LOAD_TEST_P95_MS
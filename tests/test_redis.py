@@ -4,10 +4,21 @@ os.environ["IS_TESTING"] = '1'
 
 import pytest
 import asyncio
-from db.redis.models import PydanticUser, EverydayReport
-from db.redis.crud import update_everyday_report, get_current_report
+import logging
+import time
+import datetime
+from aiogram import types
+from db.redis.models import PydanticUser, EverydayReport, LogUpdate
+from db.redis.crud import update_everyday_report, get_current_report, init_states, register_states, add_user_to_state, \
+    remove_user_state, get_state_users, cache_language
+from db.redis.logger import RedisLogHandler
 from src.misc.service_reports import notif_of_new_users
-from src.config import redis_conn
+from src.middlewares.language_middleware import language_cache, language_invalidation_listener
+from src.bot import i18n
+from src.misc.leader import LeaderElection, LEADER_KEY
+from src.misc.jobs import Job, JobScheduler, SCHEDULE_KEY, PENDING_KEY, get_job_metrics
+from src.misc import metrics
+from src.config import redis_conn, logger
 
 
 @pytest.fixture(scope="session")
@@ -41,3 +52,290 @@ async def test_send_messages():
 async def test_notification_new_users():
     text = await notif_of_new_users()
     assert "5 new users:\n1. 123123123121" in text and '4QQ' in text
+
+
+async def test_concurrent_report_updates():
+    report: EverydayReport = await get_current_report()
+    await asyncio.gather(
+        *[update_everyday_report(n_pains=1, n_druguses=2) for _ in range(500)]
+    )
+    new_report: EverydayReport = await get_current_report()
+    assert new_report.n_pains == report.n_pains + 500
+    assert new_report.n_druguses == report.n_druguses + 1000
+    assert len(new_report.new_users) == 5
+
+
+async def test_legacy_report_migration():
+    report: EverydayReport = await get_current_report()
+    await redis_conn.delete('everyday_report', 'everyday_report:new_users', 'everyday_report:deleted_users')
+    await redis_conn.set('everyday_report', report.json())
+    await update_everyday_report(n_pains=1)
+    new_report: EverydayReport = await get_current_report()
+    assert new_report.n_pains == report.n_pains + 1
+    assert new_report.new_users == report.new_users
+
+
+async def test_concurrent_state_transitions():
+    states = ['Form:0:first', 'Form:1:second']
+    await init_states(states)
+    assert await redis_conn.smembers('states') == set(states)
+
+    await asyncio.gather(*[add_user_to_state(states[0], user_id) for user_id in range(1000)])
+    assert len(await get_state_users(states[0])) == 1000
+
+    # Move half of users to the next state
+    await asyncio.gather(*[add_user_to_state(states[1], user_id) for user_id in range(500)])
+    assert sorted(await get_state_users(states[0])) == list(range(500, 1000))
+    assert sorted(await get_state_users(states[1])) == list(range(500))
+    assert await redis_conn.get('user_state:1') == states[1]
+
+    # User is not removed if he is not in from_state
+    await remove_user_state(1, from_state=states[0])
+    assert await redis_conn.get('user_state:1') == states[1]
+    await remove_user_state(1)
+    assert await redis_conn.get('user_state:1') is None
+    assert 1 not in await get_state_users(states[1])
+
+    # Each change incremented the value: 1000 sets, 500 unsets + 500 sets, 1 unset
+    assert int(await redis_conn.get('incr_value')) == 2001
+
+
+async def test_register_states_keeps_users():
+    states = ['Form:0:first', 'Form:1:second']
+    await init_states(states)
+    await add_user_to_state(states[0], 42)
+    # A new leader registers the states while the user is in the middle of the form
+    await register_states(states + ['Other:0:third'])
+    assert await redis_conn.smembers('states') == set(states + ['Other:0:third'])
+    assert await redis_conn.get('user_state:42') == states[0]
+    assert 42 in await get_state_users(states[0])
+
+
+async def test_legacy_states():
+    # States used to be json arrays
+    await redis_conn.set('state:Legacy:0:first', '[5, 6]')
+    await redis_conn.set('state:Legacy:1:second', '[]')
+    await add_user_to_state('Legacy:0:first', 7)
+    assert sorted(await get_state_users('Legacy:0:first')) == [5, 6, 7]
+    await redis_conn.set('state:Legacy:2:third', '[8]')
+    assert await get_state_users('Legacy:1:second') == []
+    assert await redis_conn.type('state:Legacy:2:third') == 'set'
+    # and on the election of a leader
+    await redis_conn.set('state:Legacy:3:fourth', '[9]')
+    await register_states(['Legacy:3:fourth'])
+    assert await redis_conn.type('state:Legacy:3:fourth') == 'set'
+    assert await get_state_users('Legacy:3:fourth') == [9]
+
+
+async def test_log_handler_batches():
+    handler = RedisLogHandler(redis_conn, key='test_logs', max_len=200, batch_size=100, max_queue_len=300)
+    test_logger = logging.getLogger('test_log_handler')
+    test_logger.propagate = False
+    test_logger.addHandler(handler)
+    for i in range(350):
+        test_logger.error(f'record {i}')
+    await asyncio.sleep(1)
+
+    assert handler.n_dropped == 50
+    assert handler.n_flushed == 300
+    assert handler.n_batches == 3
+    assert await redis_conn.llen('test_logs') == 200   # trimmed
+    assert await redis_conn.lindex('test_logs', 0) == 'record 299'
+
+    # Queued records are pushed on shutdown without waiting for the flush interval
+    for i in range(350, 355):
+        test_logger.error(f'record {i}')
+    await handler.aclose()
+    assert handler.n_flushed == 305
+    assert await redis_conn.lindex('test_logs', 0) == 'record 354'
+    test_logger.removeHandler(handler)
+
+
+async def test_language_cache_overhead():
+    """
+    Locale lookup per update: Redis round-trip only (as before) vs in-process cache
+    """
+    types.User.set_current(types.User(id=777, is_bot=False, first_name='Q', language_code='ru'))
+    await cache_language(777, 'en')
+    n_updates = 1000
+    maxsize = language_cache.maxsize
+
+    language_cache.maxsize = 0
+    language_cache.clear()
+    hits, misses = language_cache.hits, language_cache.misses
+    t0 = time.perf_counter()
+    for _ in range(n_updates):
+        assert await i18n.get_user_locale('pre_process_message', ()) == 'en'
+    redis_only = (time.perf_counter() - t0) / n_updates
+    # Every lookup goes to Redis
+    assert (language_cache.hits - hits, language_cache.misses - misses) == (0, n_updates)
+
+    language_cache.maxsize = maxsize
+    hits, misses = language_cache.hits, language_cache.misses
+    t0 = time.perf_counter()
+    for _ in range(n_updates):
+        assert await i18n.get_user_locale('pre_process_message', ()) == 'en'
+    cached = (time.perf_counter() - t0) / n_updates
+    # Only the first one does
+    assert (language_cache.hits - hits, language_cache.misses - misses) == (n_updates - 1, 1)
+
+    logger.info(f'Locale lookup per update: {redis_only * 1e6:.0f} us with Redis, {cached * 1e6:.1f} us cached')
+
+
+async def test_language_invalidation():
+    listener = asyncio.create_task(language_invalidation_listener())
+    await asyncio.sleep(0.1)
+    language_cache.set(777, 'en')
+    await cache_language(777, 'fr', publish=True)
+    await asyncio.sleep(0.1)
+    assert language_cache.get(777) is None
+    assert await i18n.get_user_locale('pre_process_message', ()) == 'fr'
+    listener.cancel()
+
+
+async def test_leader_election():
+    workers = [LeaderElection(ttl=1) for _ in range(5)]
+    acquired = await asyncio.gather(*[worker.try_acquire() for worker in workers])
+    assert sum(acquired) == 1
+    leader = workers[acquired.index(True)]
+    assert await leader.try_acquire()   # renewed
+
+    # Another worker takes over after the leader is gone
+    await leader.release()
+    assert await workers[acquired.index(False)].try_acquire()
+    assert not await leader.try_acquire()
+
+
+async def test_leader_election_failed_start():
+    await redis_conn.delete(LEADER_KEY)
+    worker = LeaderElection(ttl=0.3)
+    n_calls = 0
+
+    async def on_elected():
+        nonlocal n_calls
+        n_calls += 1
+        if n_calls == 1:
+            raise RuntimeError('set_webhook failed')
+        return []
+
+    election = asyncio.create_task(worker.run(on_elected))
+    await asyncio.sleep(0.5)
+    election.cancel()
+    # The lease was given away and taken again on the next pass
+    assert n_calls == 2
+    assert worker.is_leader
+    await worker.release()
+
+
+async def test_logs_incr_value_shared():
+    handlers = [RedisLogHandler(redis_conn, key='test_logs_shared', max_len=100) for _ in range(2)]
+    incr_value = int(await redis_conn.get('log_incr_value') or 0)
+    for handler in handlers:
+        handler.queue.extend(['record'] * 10)
+    await asyncio.gather(*[handler.flush_batch() for handler in handlers])
+    assert int(await redis_conn.get('log_incr_value')) >= incr_value + 20
+
+
+async def test_logs_channel_message_per_record():
+    handler = RedisLogHandler(redis_conn, key='test_logs_channel', max_len=100, incr_key='test_logs_channel_incr',
+                              channel='channel:test_logs')
+    pubsub = redis_conn.pubsub()
+    await pubsub.subscribe('channel:test_logs')
+    await pubsub.get_message(timeout=1)   # subscribe confirmation
+    handler.queue.extend(['first', 'second'])
+    await handler.flush_batch()
+    updates = []
+    for _ in range(10):
+        if len(updates) == 2:
+            break
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+        if message:
+            updates.append(LogUpdate.parse_raw(message['data']))
+    await pubsub.unsubscribe('channel:test_logs')
+    assert [(update.log_record, update.log_incr_value) for update in updates] == [('first', 1), ('second', 2)]
+
+
+async def test_job_scheduler_catch_up():
+    slots = []
+
+    async def func(slot):
+        slots.append(slot)
+
+    job = Job('test_job', func, every=3600, catch_up=2)
+    scheduler = JobScheduler([job])
+    now = time.time()
+    # The bot was down for 3 hours
+    await redis_conn.zadd(SCHEDULE_KEY, {'test_job': job.next_slot(now) - 4 * 3600})
+    await asyncio.gather(*await scheduler.run_due(now))
+    assert len(slots) == 2   # only the latest ones
+    assert slots[1] - slots[0] == datetime.timedelta(hours=1)
+    assert await redis_conn.zscore(SCHEDULE_KEY, 'test_job') == job.next_slot(now)
+    assert await scheduler.run_due(now) == []
+
+    # Slot is not run twice
+    await scheduler.run_job(job, job.next_slot(now) - 3600)
+    assert len(slots) == 2
+    metrics = (await get_job_metrics())['test_job']
+    assert metrics['n_runs'] == '2' and metrics['n_skipped'] == '2'
+
+
+async def test_job_scheduler_interrupted_run():
+    slots = []
+
+    async def func(slot):
+        slots.append(slot)
+
+    job = Job('test_interrupted_job', func, every=3600)
+    scheduler = JobScheduler([job])
+    slot = job.next_slot(time.time()) - 3600
+    # The worker died while running the slot: 'running' key has expired, the run is still pending
+    await redis_conn.zadd(PENDING_KEY, {f'test_interrupted_job:{int(slot)}': slot})
+    await asyncio.gather(*await scheduler.run_due(time.time()))
+    assert slots == [datetime.datetime.utcfromtimestamp(slot)]
+    assert await redis_conn.get(f'job:test_interrupted_job:{int(slot)}') == 'done'
+    assert await redis_conn.zscore(PENDING_KEY, f'test_interrupted_job:{int(slot)}') is None
+
+
+async def test_job_scheduler_cancelled_run():
+    started = asyncio.Event()
+
+    async def func(slot):
+        started.set()
+        await asyncio.sleep(60)
+
+    job = Job('test_cancelled_job', func, every=3600)
+    scheduler = JobScheduler([job], tick=0.1)
+    await redis_conn.zadd(SCHEDULE_KEY, {'test_cancelled_job': job.next_slot(time.time()) - 3600})
+    scheduler_task = asyncio.create_task(scheduler.run())
+    await asyncio.wait_for(started.wait(), 1)
+    [member] = [m for m in await redis_conn.zrange(PENDING_KEY, 0, -1) if m.startswith('test_cancelled_job:')]
+    # The leadership is lost: the run is cancelled and stays pending for the new leader
+    scheduler_task.cancel()
+    await asyncio.sleep(0.1)
+    assert not scheduler._running
+    assert not await redis_conn.exists(f'job:{member}')
+    assert await redis_conn.zscore(PENDING_KEY, member) is not None
+
+
+async def test_handler_metrics():
+    # Done in on_startup of the bot
+    metrics.instrument_redis(redis_conn)
+    timings = metrics.UpdateTimings()
+    token = metrics.current_timings.set(timings)
+    try:
+        await redis_conn.set('metrics_test', 1)
+        async with redis_conn.pipeline() as pipe:
+            await pipe.incr('metrics_test').get('metrics_test').execute()
+    finally:
+        metrics.current_timings.reset(token)
+    await redis_conn.get('metrics_test')   # outside of an update, not counted
+    assert timings.calls == {'sql': 0, 'redis': 2, 'api': 0}
+    assert timings.seconds['redis'] > 0
+
+    timings.handler = 'test_handler'
+    metrics.observe(timings)
+    text = metrics.render()
+    assert 'bot_handler_duration_seconds_count{handler="test_handler"} 1' in text
+    assert 'bot_handler_redis_calls_total{handler="test_handler"} 2' in text
+    assert 'bot_handler_sql_seconds_bucket{handler="test_handler",le="0.005"} 1' in text
+    assert metrics.slowest_handlers.summary().startswith('test_handler: 1 runs')
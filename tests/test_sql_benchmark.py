@@ -0,0 +1,236 @@
+import os
+
+os.environ["IS_TESTING"] = '1'
+
+import pytest
+import asyncio
+import datetime
+import itertools
+from sqlalchemy import text
+
+from db.models import Base, PainCase, DrugUse
+from db.database import test_engine, database_exists, create_database
+from db.synthetic import fill_database
+from db import sql
+from db.redis.crud import invalidate_month_days
+from src.config import redis_conn
+
+
+# Filling the database takes a while, so the benchmarks run only on demand, at each of the scales:
+#   BENCHMARK_USERS=1000,10000,100000 pytest tests/test_sql_benchmark.py --benchmark-autosave
+# Results are saved to .benchmarks/ as JSON, named by the commit. To compare with the previous run:
+#   BENCHMARK_USERS=1000,10000 pytest tests/test_sql_benchmark.py --benchmark-compare --benchmark-group-by=param
+SCALES = [int(n) for n in os.getenv('BENCHMARK_USERS', default='').split(',') if n]
+
+pytestmark = pytest.mark.skipif(not SCALES, reason='BENCHMARK_USERS is not set')
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.get_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="module", params=SCALES or [0])
+def n_users(request, event_loop):
+    """
+    Database filled with synthetic data of n_users, recreated for each scale
+    """
+    assert redis_conn.connection_pool.connection_kwargs['db'] == 5
+    event_loop.run_until_complete(redis_conn.flushdb())
+    if not event_loop.run_until_complete(database_exists(test_engine.url)):
+        event_loop.run_until_complete(create_database(test_engine.url))
+    event_loop.run_until_complete(fill_database(request.param))
+
+    yield request.param
+
+    async def drop_all():
+        async with test_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+    event_loop.run_until_complete(drop_all())
+    event_loop.run_until_complete(redis_conn.flushdb())
+
+
+@pytest.fixture(scope="module")
+def user_id(n_users, event_loop) -> int:
+    """
+    A fairly active user: 95th percentile by the number of pains
+    """
+    async def get_user_id():
+        async with sql.get_session() as session:
+            return await session.scalar(text(
+                "SELECT owner_id FROM pains GROUP BY owner_id ORDER BY count(*) DESC LIMIT 1 OFFSET :n"),
+                {'n': n_users // 20})
+    return event_loop.run_until_complete(get_user_id())
+
+
+@pytest.fixture
+def run(benchmark, event_loop, n_users):
+    """
+    Benchmark a coroutine function: run(sql.get_user, telegram_id=1)
+    """
+    benchmark.extra_info['n_users'] = n_users
+
+    def run_coroutine(func, *args, **kwargs):
+        return benchmark(lambda: event_loop.run_until_complete(func(*args, **kwargs)))
+    return run_coroutine
+
+
+async def consume(stream) -> list:
+    return [item async for item in stream]
+
+
+TODAY = datetime.date.today()
+
+
+### Reads
+def test_healthcheck(run):
+    run(sql.healthcheck)
+
+
+def test_get_user(run, user_id):
+    run(sql.get_user, telegram_id=user_id)
+
+
+def test_get_user_profile(run, user_id):
+    run(sql.get_user_profile, telegram_id=user_id)
+
+
+def test_get_users(run):
+    run(sql.get_users)
+
+
+def test_get_users_active(run):
+    run(sql.get_users, active=True)
+
+
+def test_get_users_super_active_count(run):
+    run(sql.get_users, super_active=True, return_count=True)
+
+
+def test_get_users_where(run):
+    run(sql.get_users_where, notify_every=1, language='en')
+
+
+def test_users_by_notif_hour(run):
+    run(sql.users_by_notif_hour, 18)
+
+
+def test_users_due_for_notification(run):
+    run(sql.users_due_for_notification, datetime.datetime.utcnow())
+
+
+def test_get_user_pains(run, user_id):
+    run(sql.get_user_pains, user_id, period_days=31)
+
+
+def test_get_user_pains_all(run, user_id):
+    run(sql.get_user_pains, user_id)
+
+
+def test_stream_user_pains(run, user_id):
+    run(lambda: consume(sql.stream_user_pains(user_id)))
+
+
+def test_user_pain_days(run, user_id):
+    run(sql.user_pain_days, user_id, TODAY.month, TODAY.year)
+
+
+def test_get_user_druguses(run, user_id):
+    run(sql.get_user_druguses, user_id, period_days=31)
+
+
+def test_stream_user_druguses(run, user_id):
+    run(lambda: consume(sql.stream_user_druguses(user_id)))
+
+
+def test_user_druguse_days(run, user_id):
+    run(sql.user_druguse_days, user_id, TODAY.month, TODAY.year)
+
+
+def test_get_user_pressures(run, user_id):
+    run(sql.get_user_pressures, user_id, period_days=31)
+
+
+def test_stream_user_pressures(run, user_id):
+    run(lambda: consume(sql.stream_user_pressures(user_id)))
+
+
+def test_get_user_month_days(run, user_id):
+    async def uncached():
+        # Cached in Redis after the first call, the cache miss is measured
+        await invalidate_month_days(user_id)
+        return await sql.get_user_month_days(user_id, TODAY.month, TODAY.year)
+    run(uncached)
+
+
+def test_get_user_day_entries(run, user_id):
+    run(sql.get_user_day_entries, user_id, TODAY)
+
+
+def test_get_drugs(run, user_id):
+    run(sql.get_drugs, owner=user_id)
+
+
+def test_get_item_by_id(run):
+    run(sql.get_item_by_id, 'paincase', 1)
+
+
+def test_get_all_pains_count(run):
+    run(sql.get_all_, PainCase, date_gt=TODAY - datetime.timedelta(days=31), return_count=True)
+
+
+def test_get_all_druguses(run):
+    run(sql.get_all_, DrugUse, date_gt=TODAY - datetime.timedelta(days=1))
+
+
+def test_get_db_summary(run):
+    run(sql.get_db_summary)
+
+
+### Writes
+def test_report_paincase(run, user_id):
+    run(sql.report_paincase, owner_id=user_id, date=TODAY, durability=4, intensity=6, aura=False,
+        drugname=['Ибупрофен'], amount=['400'])
+
+
+def test_report_druguse(run, user_id):
+    run(sql.report_druguse, date=TODAY, amount='400', owner_id=user_id, drugname='Ибупрофен')
+
+
+def test_report_pressure(run, user_id):
+    run(sql.report_pressure, 120, 80, 70, owner_id=user_id)
+
+
+def test_change_user_props(run, user_id):
+    run(sql.change_user_props, telegram_id=user_id, notify_every=2, utc_notify_at=datetime.time(9))
+
+
+def test_batch_change_last_notified(run, n_users):
+    run(sql.batch_change_last_notified, list(range(1, min(n_users, 1000) + 1)), datetime.datetime.utcnow())
+
+
+def test_create_user(benchmark, event_loop, n_users):
+    new_ids = itertools.count(n_users + 1)
+    benchmark.extra_info['n_users'] = n_users
+    benchmark.pedantic(lambda telegram_id: event_loop.run_until_complete(sql.create_user(telegram_id)),
+                       setup=lambda: ((next(new_ids),), {}), rounds=100)
+
+
+def test_delete_item(benchmark, event_loop, user_id, n_users):
+    def setup():
+        druguse = event_loop.run_until_complete(
+            sql.report_druguse(date=TODAY, amount='400', owner_id=user_id, drugname='Ибупрофен'))
+        return (druguse,), {}
+
+    benchmark.extra_info['n_users'] = n_users
+    benchmark.pedantic(lambda item: event_loop.run_until_complete(sql.delete_item(item)), setup=setup, rounds=100)
+
+
+def test_delete_user(benchmark, event_loop, n_users):
+    # Users with their history are moved to saved_* tables, each round deletes another one
+    user_ids = iter(range(n_users, 0, -1))
+    benchmark.extra_info['n_users'] = n_users
+    benchmark.pedantic(lambda telegram_id: event_loop.run_until_complete(sql.delete_user(telegram_id)),
+                       setup=lambda: ((next(user_ids),), {}), rounds=min(n_users, 50))